@@ -9,8 +9,11 @@ import serial.tools.list_ports
 import logging
 import sys
 import pydantic
-from redvypr.data_packets import check_for_command
+import typing
+from redvypr.data_packets import check_for_command, create_datadict
 from redvypr.devices.plot import XYPlotWidget
+from .leitenberger_protocol import LeitenbergerProtocol, LeitenbergerBath, LeitenbergerMultiplexer, PollVariable
+from .leitenberger_sequencer import SetpointSequencer
 #from redvypr.redvypr_packet_statistic import do_data_statistics, create_data_statistic_dict
 
 
@@ -19,7 +22,6 @@ description = 'Device to connect to a Leitenberger temperature calibration bath'
 
 logging.basicConfig(stream=sys.stderr)
 logger = logging.getLogger('leitenberger')
-logger.setLevel(logging.DEBUG)
 
 class DeviceBaseConfig(pydantic.BaseModel):
     publishes: bool = True
@@ -28,80 +30,145 @@ class DeviceBaseConfig(pydantic.BaseModel):
     gui_tablabel_display: str = 'Data'
 
 
+class BathVariableConfig(pydantic.BaseModel):
+    variable: int = pydantic.Field(description='The number of the bath variable, e.g. 100 for RVAR100')
+    name: str = pydantic.Field(description='The key of the value in the data packet')
+    parse: typing.Literal['float', 'int', 'str'] = 'float'
+    period: float = pydantic.Field(default=1.0, description='Poll period while the bath is ramping [s]')
+    period_steady: float = pydantic.Field(default=10.0, description='Poll period while the bath is steady [s]')
+
+
+default_variables = [BathVariableConfig(variable=0, name='temp_set', period=1.0, period_steady=10.0),
+                     BathVariableConfig(variable=100, name='temp', period=0.5, period_steady=2.0),
+                     BathVariableConfig(variable=29, name='temp_steady', parse='int', period=1.0, period_steady=2.0),
+                     BathVariableConfig(variable=28, name='temp_stability', period=1.0, period_steady=10.0)]
+
+
+class BathConfig(pydantic.BaseModel):
+    comport: str = ''
+    baud: int = 9600
+    address: int = 1
+    packetid: str = pydantic.Field(default='', description="The packetid of the data of the bath, '' for bath<n> with n the number of the bath (1 for the first additional bath)")
+
+
+def bath_packetids(baths):
+    """
+    Returns the packetids of the additional baths, a bath without a packetid gets 'bath<n>' with
+    n the number of the bath. The bath at comport is bath 0, it publishes with the packetid of
+    the device.
+
+    Raises:
+        ValueError: If two baths have the same packetid
+    """
+    packetids = []
+    for i, bath in enumerate(baths):
+        packetid = dict(bath).get('packetid', '')
+        packetids.append(packetid if len(packetid) > 0 else 'bath{}'.format(i + 1))
+    duplicates = sorted(set(p for p in packetids if packetids.count(p) > 1))
+    if len(duplicates) > 0:
+        raise ValueError('Duplicate packetids of the baths: {}'.format(duplicates))
+    return packetids
+
+
+class SequencerConfig(pydantic.BaseModel):
+    setpoints: typing.List[float] = pydantic.Field(default=[], description='The setpoints of a calibration run [degC]')
+    window: float = pydantic.Field(default=120.0, description='Length of the window of the stability statistics [s]')
+    max_std: float = pydantic.Field(default=0.005, description='Maximum standard deviation of temp in the window [K]')
+    max_drift: float = pydantic.Field(default=0.005, description='Maximum drift of temp in the window [K/min]')
+    max_offset: typing.Optional[float] = pydantic.Field(default=0.1, description='Maximum difference of the mean of temp to the setpoint [K], None to disable')
+    require_steady: bool = pydantic.Field(default=True, description='Require the steadiness flag of the bath')
+    min_time: float = pydantic.Field(default=60.0, description='Minimum time at a setpoint [s]')
+    hold_time: float = pydantic.Field(default=60.0, description='Time temp has to be stable before the next setpoint [s]')
+    max_time: typing.Optional[float] = pydantic.Field(default=None, description='Maximum time at a setpoint [s], None for no limit')
+
+
 class DeviceCustomConfig(pydantic.BaseModel):
     baud: int = 9600
     parity: int = serial.PARITY_NONE
     stopbits: int = serial.STOPBITS_ONE
     bytesize: int = serial.EIGHTBITS
-    dt_poll: float = 0.05
+    dt_poll: float = pydantic.Field(default=0.05, description='Time between two update ticks, the shortest possible poll period [s]')
     chunksize: int = pydantic.Field(default=1000, description='The maximum amount of bytes read with one chunk')
     packetdelimiter: str = pydantic.Field(default='\n', description='The delimiter to distinuish packets')
     comport: str = ''
+    timeout: float = pydantic.Field(default=1.0, description='Time to wait for the answer of the bath [s]')
+    variables: typing.List[BathVariableConfig] = pydantic.Field(default=default_variables, description='The polled bath variables')
+    steady_variable: str = pydantic.Field(default='temp_steady', description='Name of the variable telling if the bath is steady (not 0), the slow poll periods are used while steady')
+    baths: typing.List[BathConfig] = pydantic.Field(default=[], description='Additional baths served by the same device, each with its own serial port and packetid')
+    sequencer: SequencerConfig = pydantic.Field(default=SequencerConfig(), description='Setpoint sequencer for calibration runs')
+
+    @pydantic.field_validator('baths')
+    @classmethod
+    def check_bath_packetids(cls, baths):
+        bath_packetids(baths)
+        return baths
 
 redvypr_devicemodule = True
 
 def start(device_info, config={}, dataqueue=None, datainqueue=None, statusqueue=None):
     """
-
+    Polls the bath variables with a LeitenbergerProtocol. The next request is sent as soon as
+    the answer of the previous one arrived, a data packet is published when all variables of an
+    update are answered or timed out. 'set' commands are sent with priority, the bath is chosen
+    with the 'bath' key of the command (index, name or packetid), default is the first bath.
+    The bath at comport and all baths in config['baths'] are served by one
+    LeitenbergerMultiplexer in this thread, each additional bath publishes with its own
+    packetid, see bath_packetids(). Each variable in config['variables'] is polled with
+    its own period, the periods are short while the bath is ramping and long while it is steady.
+    The command 'sequence_start' starts a SetpointSequencer for a bath (optional keys 'bath' and
+    'setpoints', default config['sequencer']['setpoints']), 'sequence_stop' stops it.
     """
     funcname = __name__ + '.start()'
     logger.debug(funcname + ':Starting reading serial data')
-    chunksize   = config['chunksize'] #The maximum amount of bytes read with one chunk
-    serial_name = config['comport']
-    baud        = config['baud']
     parity      = config['parity']
     stopbits    = config['stopbits']
     bytesize    = config['bytesize']
-    dt_poll     = config['dt_poll']
-
-    print('Starting',config)
-    
-    newpacket   = config['packetdelimiter']
-    # Check if a delimiter shall be used (\n, \r\n, etc ...)
-    if(len(newpacket)>0):
-        FLAG_DELIMITER = True
-    else:
-        FLAG_DELIMITER = False
-    if(type(newpacket) is not bytes):
-        newpacket = newpacket.encode('utf-8')
-        
-    rawdata_all    = b''
-    dt_update      = 1 # Update interval in seconds
-    bytes_read     = 0
-    sentences_read = 0
-    bytes_read_old = 0 # To calculate the amount of bytes read per second
-    t_update       = time.time()
-    serial_device = False
-    if True:
+    timeout     = config.get('timeout', 1.0)
+
+    dt_update   = config.get('dt_poll', 0.05)
+    steady_name = config.get('steady_variable', 'temp_steady')
+    sequencer_config = dict(config.get('sequencer', {}))
+    variables_config = config.get('variables', None)
+    if variables_config is None:
+        variables_config = default_variables
+    variables = []
+    for v in variables_config:
+        v = dict(v)
+        variables.append(PollVariable(v['variable'], v['name'], parse=v.get('parse', 'float'),
+                                      period=v.get('period', 1.0), period_steady=v.get('period_steady')))
+    baths_config = [{'comport': config['comport'], 'baud': config['baud'], 'address': 1, 'packetid': ''}]
+    baths_additional = config.get('baths', [])
+    for bath_config, packetid in zip(baths_additional, bath_packetids(baths_additional)):
+        baths_config.append({**dict(bath_config), 'packetid': packetid})
+    multiplexer = LeitenbergerMultiplexer(dt_update=dt_update)
+    for bath_config in baths_config:
+        serial_name = bath_config['comport']
+        baud = bath_config['baud']
         try:
             serial_device = serial.Serial(serial_name,baud,parity=parity,stopbits=stopbits,bytesize=bytesize,timeout=0)
-            #print('Serial device 0',serial_device)
-            #serial_device.timeout(0.05)
-            #print('Serial device 1',serial_device)                        
         except Exception as e:
-            #print('Serial device 2',serial_device)
             logger.debug(funcname + ': Exception open_serial_device {:s} {:d}: '.format(serial_name,baud) + str(e))
+            multiplexer.close()
             return False
 
-    got_dollar = False    
+        protocol = LeitenbergerProtocol(serial_device, address=bath_config.get('address', 1), timeout=timeout)
+        multiplexer.add_bath(LeitenbergerBath(protocol, variables, name=serial_name,
+                                              packetid=bath_config.get('packetid', ''),
+                                              steady_name=steady_name))
+
+    sequencers = {}
     while True:
-        # TODO, here commands could be send as well
         try:
             data = datainqueue.get(block=False)
-            print("Leitenberger: Got data", data)
         except:
             data = None
 
-
         if (data is not None):
             command = check_for_command(data, thread_uuid=device_info['thread_uuid'])
-
-
             if (command is not None):
                 logger.debug('Got a command: {:s}'.format(str(data)))
-                #print('Command', command)
                 if command == 'stop':
-                    serial_device.close()
+                    multiplexer.close()
                     sstr = funcname + ': Command is for me: {:s}'.format(str(command))
                     logger.debug(sstr)
                     try:
@@ -110,121 +177,64 @@ def start(device_info, config={}, dataqueue=None, datainqueue=None, statusqueue=
                         pass
                     return
                 elif command == 'set':
-                    print('Set temperature')
                     temp = data['temp']
-                    WRITE_SET_TEMP_COM = '$1WVAR0 {}'.format(temp)
-                    WRITE_SET_TEMP_COM = WRITE_SET_TEMP_COM.replace('.',',')
-                    print('Write command',WRITE_SET_TEMP_COM)
-                    serial_device.write(WRITE_SET_TEMP_COM.encode() + b' \r')
-                    time.sleep(0.1)
-                    ndata = serial_device.inWaiting()
                     try:
-                        rawdata_tmp = serial_device.read(ndata)
-                    except Exception as e:
-                        print(e)
-                        # print('rawdata_tmp', rawdata_tmp)
-
-        if((time.time() - t_update) > dt_update):
-            # Read the set temperature value
-            READ_SET_TEMP_COM = b'$1RVAR0 \r'
-            print('Writing', READ_SET_TEMP_COM)
-            serial_device.write(READ_SET_TEMP_COM)
-            time.sleep(0.1)
-            ndata = serial_device.inWaiting()
-            try:
-                rawdata_tmp = serial_device.read(ndata)
-            except Exception as e:
-                print(e)
-                # print('rawdata_tmp', rawdata_tmp)
-
-            data = {}
-            print('SET TEMP', rawdata_tmp)
-            try:
-                rawstr = rawdata_tmp.decode('UTF-8')
-                temp_set = float(rawstr.split()[1])
-                data['temp_set'] = temp_set
-            except:
-                logger.warning('Could not parse String:{}'.format(rawstr), exc_info=True)
-                temp_set = None
-
-
-            # And now the real temperature
-            READ_TEMP_COM = b'$1RVAR100 \r'
-            print('Writing', READ_TEMP_COM)
-            serial_device.write(READ_TEMP_COM)
-            time.sleep(0.1)
-            ndata = serial_device.inWaiting()
-            try:
-                rawdata_tmp = serial_device.read(ndata)
-            except Exception as e:
-                print(e)
-                #print('rawdata_tmp', rawdata_tmp)
-
-            print('READ TEMP', rawdata_tmp)
-            #b'*1 +0023.18\r'
-
-            try:
-                rawstr = rawdata_tmp.decode('UTF-8')
-                temp = float(rawstr.split()[1])
-                data['temp'] = temp
-            except:
-                logger.warning('Could not parse String:{}'.format(rawstr),exc_info=True)
-                temp = None
-
-            # Read the symbol of steadiness
-            READ_TEMP_COM = b'$1RVAR29 \r'
-            print('Writing', READ_TEMP_COM)
-            serial_device.write(READ_TEMP_COM)
-            time.sleep(0.1)
-            ndata = serial_device.inWaiting()
-            try:
-                rawdata_tmp = serial_device.read(ndata)
-            except Exception as e:
-                print(e)
-                # print('rawdata_tmp', rawdata_tmp)
-
-            print('READ Steadiness', rawdata_tmp)
-            # b'*1 1\r'
-
-            try:
-                rawstr = rawdata_tmp.decode('UTF-8')
-                steady = int(rawstr.split()[1])
-                data['temp_steady'] = steady
-            except:
-                logger.warning('Could not parse String:{}'.format(rawstr), exc_info=True)
-
-            # Read the stability range
-            READ_TEMP_COM = b'$1RVAR28 \r'
-            print('Writing', READ_TEMP_COM)
-            serial_device.write(READ_TEMP_COM)
-            time.sleep(0.1)
-            ndata = serial_device.inWaiting()
-            try:
-                rawdata_tmp = serial_device.read(ndata)
-            except Exception as e:
-                print(e)
-                # print('rawdata_tmp', rawdata_tmp)
-
-            print('READ Stability', rawdata_tmp)
-            # b'*1 1\r'
-
-            try:
-                rawstr = rawdata_tmp.decode('UTF-8')
-                stability = float(rawstr.split()[1])
-                data['temp_stability'] = stability
-            except:
-                logger.warning('Could not parse String:{}'.format(rawstr), exc_info=True)
-
-
-            print('Data',data)
-            dataqueue.put(data)
-            t_update = time.time()
-
-            
-                
-
-
+                        bath = multiplexer.get_bath(data.get('bath', None))
+                    except (KeyError, IndexError):
+                        logger.warning('Unknown bath {}'.format(data.get('bath')))
+                        continue
+                    logger.info('Setting temperature of {} to {}'.format(bath.name, temp))
+                    bath.write_variable(0, temp, name='set')
+                elif command in ('sequence_start', 'sequence_stop'):
+                    try:
+                        bath = multiplexer.get_bath(data.get('bath', None))
+                    except (KeyError, IndexError):
+                        logger.warning('Unknown bath {}'.format(data.get('bath')))
+                        continue
+                    sequencer = sequencers.pop(bath.name, None)
+                    if sequencer is not None:
+                        sequencer.stop()
+                    if command == 'sequence_start':
+                        kwargs = dict(sequencer_config)
+                        setpoints_default = kwargs.pop('setpoints', [])
+                        setpoints = data.get('setpoints', setpoints_default)
+                        sequencer = SetpointSequencer(setpoints, steady_name=steady_name, **kwargs)
+                        setpoint = sequencer.start(time.time())
+                        if setpoint is not None:
+                            sequencers[bath.name] = sequencer
+                            bath.write_variable(0, setpoint, name='set')
+                        sstr = 'Sequence of {} with setpoints {}'.format(bath.name, setpoints)
+                    else:
+                        sstr = 'Sequence of {} stopped'.format(bath.name)
+                    logger.info(sstr)
+                    try:
+                        statusqueue.put_nowait(sstr)
+                    except:
+                        pass
 
+        for bath, values in multiplexer.step():
+            if len(values) == 0:
+                continue
+            sequencer = sequencers.get(bath.name, None)
+            if sequencer is not None:
+                setpoint = sequencer.update(time.time(), values)
+                if setpoint is not None:
+                    bath.write_variable(0, setpoint, name='set')
+                values.update({k: v for k, v in sequencer.status().items() if v is not None})
+                if sequencer.state == 'done':
+                    sequencers.pop(bath.name)
+                    sstr = 'Sequence of {} done: {}'.format(bath.name, sequencer.results)
+                    logger.info(sstr)
+                    try:
+                        statusqueue.put_nowait(sstr)
+                    except:
+                        pass
+            if len(bath.packetid) > 0:
+                data = create_datadict(packetid=bath.packetid)
+                data.update(values)
+            else:
+                data = values
+            dataqueue.put(data)
 
 
 class initDeviceWidget(QtWidgets.QWidget):
@@ -400,6 +410,14 @@ class displayDeviceWidget(QtWidgets.QWidget):
         self.tempSpinBox.setMaximum(200.0)
         self.buttonSendcom = QtWidgets.QPushButton('Send')
         self.buttonSendcom.clicked.connect(self.sendcom_clicked)
+        self.setpointsEdit = QtWidgets.QLineEdit()
+        self.setpointsEdit.setPlaceholderText('Setpoints, e.g. 5, 10, 20')
+        setpoints = device.custom_config.sequencer.setpoints
+        self.setpointsEdit.setText(', '.join([str(t) for t in setpoints]))
+        self.buttonSequence = QtWidgets.QPushButton('Start sequence')
+        self.buttonSequence.clicked.connect(self.sequence_clicked)
+        self.buttonSequenceStop = QtWidgets.QPushButton('Stop sequence')
+        self.buttonSequenceStop.clicked.connect(self.sequence_stop_clicked)
         config = XYPlotWidget.ConfigXYplot(automatic_subscription=False)
         self.device = device
         self.plotWidget = XYPlotWidget.XYPlotWidget(config=config, redvypr_device=self.device)
@@ -409,14 +427,29 @@ class displayDeviceWidget(QtWidgets.QWidget):
         self.plotWidget.config.lines[1].unit = 'degC'
         hlayout.addWidget(self.tempSpinBox)
         hlayout.addWidget(self.buttonSendcom)
+        hlayout.addWidget(self.setpointsEdit)
+        hlayout.addWidget(self.buttonSequence)
+        hlayout.addWidget(self.buttonSequenceStop)
         layout.addLayout(hlayout)
         layout.addWidget(self.plotWidget)
         layout.addStretch()
 
     def sendcom_clicked(self):
-        print('Sending command')
         temp = self.tempSpinBox.value()
+        logger.debug('Sending set command with temperature {}'.format(temp))
         self.device.thread_command('set',data={'temp':temp})
+
+    def sequence_clicked(self):
+        try:
+            setpoints = [float(t) for t in self.setpointsEdit.text().replace(';', ',').split(',') if len(t.strip()) > 0]
+        except ValueError:
+            logger.warning('Could not parse setpoints: {}'.format(self.setpointsEdit.text()))
+            return
+        self.device.custom_config.sequencer.setpoints = setpoints
+        self.device.thread_command('sequence_start', data={'setpoints': setpoints})
+
+    def sequence_stop_clicked(self):
+        self.device.thread_command('sequence_stop')
     def update_data(self,data):
         funcname = __name__ + '.update():'
         #print('Got data',data)
@@ -0,0 +1,502 @@
+"""
+Request/response engine for the serial protocol of Leitenberger temperature calibration baths.
+
+Commands are sent as "$<address><command> \\r", e.g. "$1RVAR100 \\r", the bath answers with
+"*<address> <value>\\r", e.g. "*1 +0023.18\\r". The answers do not repeat the variable, they are
+matched to the outstanding requests in the order the requests were sent. A request is sent as
+soon as the answer of the previous one arrived, instead of waiting a fixed time, requests that
+are not answered within their timeout are completed with an error. Write requests are put into
+a priority lane and are sent before all pending read requests.
+
+A LeitenbergerMultiplexer serves several baths, each with its own serial port and protocol
+engine, from one thread.
+"""
+import collections
+import logging
+import math
+import selectors
+import time
+
+logger = logging.getLogger('leitenberger.protocol')
+
+
+def parse_float(valuestr):
+    """
+    Parses a float, the bath uses a comma or a point as the decimal separator
+    """
+    return float(valuestr.replace(',', '.'))
+
+
+def parse_int(valuestr):
+    return int(valuestr)
+
+
+parse_functions = {'float': parse_float, 'int': parse_int, 'str': str}
+
+
+class LeitenbergerRequest:
+    """
+    A command sent to the bath and its answer.
+
+    After completion either value is set (the parsed answer) or error is a string describing
+    why there is no value ('timeout', 'parse', 'address').
+    """
+
+    def __init__(self, command, name=None, parse=None, timeout=1.0, priority=False):
+        if type(command) is not bytes:
+            command = command.encode('utf-8')
+        self.command = command
+        self.name = name
+        self.parse = parse
+        self.timeout = timeout
+        self.priority = priority
+        self.t_queued = time.time()
+        self.t_sent = None
+        self.t_done = None
+        self.response = None
+        self.value = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.t_done is not None
+
+    @property
+    def turnaround(self):
+        """
+        Time between sending the request and receiving the answer, None if not answered
+        """
+        if self.t_sent is None or self.t_done is None or self.error is not None:
+            return None
+        return self.t_done - self.t_sent
+
+    def __repr__(self):
+        return 'LeitenbergerRequest({}, name={}, value={}, error={})'.format(
+            self.command, self.name, self.value, self.error)
+
+
+class LeitenbergerProtocol:
+    """
+    Non blocking protocol engine for one bath.
+
+    Requests are queued with read_variable(), write_variable() or request(), poll() has to be
+    called regularly and returns the completed requests. poll() reads the available bytes,
+    completes a request as soon as the terminator of its answer arrived, checks the timeouts and
+    sends the next pending requests.
+
+    Args:
+        serial_device: An open serial.Serial (or an object with write(), read(), in_waiting and
+            reset_input_buffer())
+        address: The address of the bath
+        timeout: Default timeout of a request [s]
+        max_outstanding: Number of requests sent without having received their answer. The
+            answers are matched by their order, a value larger than one only works with baths
+            that answer every command.
+        terminator: The end of an answer
+    """
+
+    def __init__(self, serial_device, address=1, timeout=1.0, max_outstanding=1, terminator=b'\r'):
+        self.serial_device = serial_device
+        self.address = address
+        self.timeout = timeout
+        self.max_outstanding = max_outstanding
+        self.terminator = terminator
+        self.prefix = '*{:d}'.format(address).encode('utf-8')
+        self.pending = collections.deque()
+        self.pending_priority = collections.deque()
+        self.outstanding = collections.deque()
+        self.buffer = b''
+        self.nsent = 0
+        self.nanswered = 0
+        self.ntimeout = 0
+        self.nerror = 0
+        self.nunsolicited = 0
+
+    def request(self, command, name=None, parse=None, timeout=None, priority=False):
+        """
+        Queues a command, the address prefix and the terminator are added
+
+        Args:
+            command: The command without address, e.g. 'RVAR100'
+            name: Name of the request, e.g. the key of the value in the data packet
+            parse: Function converting the answer string into the value, None keeps the string
+            timeout: Timeout [s], None for the default timeout
+            priority: Send the request before all non priority requests
+
+        Returns:
+            LeitenbergerRequest
+        """
+        if timeout is None:
+            timeout = self.timeout
+        command = '${:d}{} \r'.format(self.address, command)
+        request = LeitenbergerRequest(command, name=name, parse=parse, timeout=timeout,
+                                      priority=priority)
+        if priority:
+            self.pending_priority.append(request)
+        else:
+            self.pending.append(request)
+        return request
+
+    def read_variable(self, variable, name=None, parse=parse_float, timeout=None):
+        """
+        Queues the read of bath variable, e.g. read_variable(100, 'temp')
+        """
+        return self.request('RVAR{:d}'.format(variable), name=name, parse=parse, timeout=timeout)
+
+    def write_variable(self, variable, value, name=None, timeout=None):
+        """
+        Queues the write of a bath variable into the priority lane, floats are written with a
+        decimal comma
+        """
+        valuestr = '{}'.format(value).replace('.', ',')
+        return self.request('WVAR{:d} {}'.format(variable, valuestr), name=name, timeout=timeout,
+                            priority=True)
+
+    @property
+    def idle(self):
+        """
+        True if no request is pending or waiting for its answer
+        """
+        return not (self.pending or self.pending_priority or self.outstanding)
+
+    def deadline(self):
+        """
+        Returns the time the oldest outstanding request times out, None if nothing is outstanding
+        """
+        if len(self.outstanding) == 0:
+            return None
+        return self.outstanding[0].t_sent + self.outstanding[0].timeout
+
+    def npending(self):
+        return len(self.pending) + len(self.pending_priority) + len(self.outstanding)
+
+    def poll(self, t_now=None):
+        """
+        Reads the available bytes, completes the answered and timed out requests and sends the
+        next pending requests
+
+        Returns:
+            list of the requests completed in this call
+        """
+        completed = []
+        self.send_pending(time.time() if t_now is None else t_now)
+        data = self.read()
+        if t_now is None:
+            t_now = time.time()
+        if data:
+            completed.extend(self.feed(data, t_now))
+        completed.extend(self.check_timeouts(t_now))
+        self.send_pending(t_now)
+        return completed
+
+    def read(self):
+        """
+        Reads the bytes available at the serial device, if none are available the read waits up
+        to the timeout of the serial device for the first byte
+        """
+        try:
+            nbytes = self.serial_device.in_waiting
+            if nbytes == 0:
+                nbytes = 1
+            return self.serial_device.read(nbytes)
+        except Exception:
+            logger.warning('Could not read from serial device', exc_info=True)
+            return b''
+
+    def feed(self, data, t_now=None):
+        """
+        Adds received bytes and completes the requests whose answer is complete
+
+        Returns:
+            list of the completed requests
+        """
+        if t_now is None:
+            t_now = time.time()
+        completed = []
+        self.buffer += data
+        while True:
+            iterm = self.buffer.find(self.terminator)
+            if iterm < 0:
+                break
+            line = self.buffer[:iterm].strip()
+            self.buffer = self.buffer[iterm + len(self.terminator):]
+            if len(line) == 0:
+                continue
+            if len(self.outstanding) == 0:
+                self.nunsolicited += 1
+                logger.debug('Unsolicited answer %s', line)
+                continue
+            request = self.outstanding.popleft()
+            self.complete(request, line, t_now)
+            completed.append(request)
+        return completed
+
+    def complete(self, request, line, t_now):
+        request.t_done = t_now
+        request.response = line
+        self.nanswered += 1
+        parts = line.split(None, 1)
+        if parts[0] != self.prefix:
+            request.error = 'address'
+            self.nerror += 1
+            logger.warning('Unexpected answer %s to %s', line, request.command)
+            return
+        valuestr = parts[1].decode('utf-8', errors='replace') if len(parts) > 1 else ''
+        if request.parse is None:
+            request.value = valuestr
+            return
+        try:
+            request.value = request.parse(valuestr)
+        except Exception:
+            request.error = 'parse'
+            self.nerror += 1
+            logger.warning('Could not parse answer %s to %s', line, request.command)
+
+    def check_timeouts(self, t_now):
+        """
+        Completes the timed out requests. All bytes received so far are discarded, a late
+        answer would otherwise be matched to the next request.
+        """
+        completed = []
+        if self.outstanding and (t_now - self.outstanding[0].t_sent) > self.outstanding[0].timeout:
+            while self.outstanding:
+                request = self.outstanding.popleft()
+                request.t_done = t_now
+                request.error = 'timeout'
+                self.ntimeout += 1
+                completed.append(request)
+                logger.warning('Timeout of %s', request.command)
+            self.buffer = b''
+            try:
+                self.serial_device.reset_input_buffer()
+            except Exception:
+                pass
+        return completed
+
+    def send_pending(self, t_now):
+        while len(self.outstanding) < self.max_outstanding:
+            if self.pending_priority:
+                request = self.pending_priority.popleft()
+            elif self.pending:
+                request = self.pending.popleft()
+            else:
+                break
+            request.t_sent = t_now
+            self.serial_device.write(request.command)
+            self.outstanding.append(request)
+            self.nsent += 1
+
+
+class PollVariable:
+    """
+    A bath variable polled by a LeitenbergerBath
+
+    Args:
+        variable: The variable number, e.g. 100 for RVAR100
+        name: Key of the value in the data packet
+        parse: Function converting the answer, or its name in parse_functions
+        period: Poll period while the bath is ramping [s], 0 polls at every update tick
+        period_steady: Poll period while the bath is steady [s], None for period
+    """
+
+    def __init__(self, variable, name, parse=parse_float, period=0.0, period_steady=None):
+        if isinstance(parse, str):
+            parse = parse_functions[parse]
+        self.variable = variable
+        self.name = name
+        self.parse = parse
+        self.period = period
+        self.period_steady = period if period_steady is None else period_steady
+
+    def __repr__(self):
+        return 'PollVariable({}, {}, period={}, period_steady={})'.format(
+            self.variable, self.name, self.period, self.period_steady)
+
+
+class LeitenbergerBath:
+    """
+    A bath served by a LeitenbergerMultiplexer: its protocol engine, the polled variables and
+    the requests of the running update.
+
+    Every variable is polled with its own period, the short one while the bath is ramping and
+    the long one while it is steady. The bath counts as steady if the last value of the
+    variable steady_name is not 0. After a write the bath counts as ramping until the steady
+    variable is read again.
+
+    Args:
+        protocol: The LeitenbergerProtocol of the bath
+        variables: list of PollVariable or of (variable number, key in the data packet, parse
+            function) tuples, polled at every update tick
+        name: Name of the bath, used to address commands
+        packetid: The packetid of the data of the bath, '' for the packetid of the device
+        steady_name: Name of the variable telling if the bath is steady
+    """
+
+    def __init__(self, protocol, variables, name='', packetid='', steady_name='temp_steady'):
+        self.protocol = protocol
+        self.variables = [v if isinstance(v, PollVariable) else PollVariable(*v) for v in variables]
+        self.name = name
+        self.packetid = packetid
+        self.steady_name = steady_name
+        self.steady = False
+        self.t_last = {}
+        self.update_requests = []
+        self.t_update = None
+        self.nupdates = 0
+        self.nskipped = 0
+
+    def due_variables(self, t_update):
+        """
+        Returns the variables whose period passed at t_update
+        """
+        due = []
+        for v in self.variables:
+            period = v.period_steady if self.steady else v.period
+            # Tolerance for the rounding of the tick times
+            if (t_update - self.t_last.get(v.name, -math.inf)) >= (period - 1e-6):
+                due.append(v)
+        return due
+
+    def start_update(self, t_update):
+        """
+        Queues the reads of the due variables, skipped if the previous update is still running
+        or if no variable is due
+        """
+        if self.update_requests:
+            self.nskipped += 1
+            return False
+        due = self.due_variables(t_update)
+        if len(due) == 0:
+            return False
+        self.t_update = t_update
+        for v in due:
+            self.t_last[v.name] = t_update
+            self.update_requests.append(self.protocol.read_variable(v.variable, name=v.name, parse=v.parse))
+        return True
+
+    def write_variable(self, variable, value, name=None):
+        """
+        Writes a bath variable with priority, the bath is polled as ramping afterwards
+        """
+        self.steady = False
+        return self.protocol.write_variable(variable, value, name=name)
+
+    def collect(self):
+        """
+        Returns the values of the update if all its requests are done, otherwise None
+        """
+        if len(self.update_requests) == 0 or not all([r.done for r in self.update_requests]):
+            return None
+        data = {}
+        for request in self.update_requests:
+            if request.error is None:
+                data[request.name] = request.value
+        self.update_requests = []
+        self.nupdates += 1
+        if self.steady_name in data:
+            steady = data[self.steady_name] != 0
+            if steady != self.steady:
+                logger.info('Bath %s is %s', self.name, 'steady' if steady else 'ramping')
+            self.steady = steady
+        return data
+
+
+class LeitenbergerMultiplexer:
+    """
+    Serves several baths from one thread. The updates of all baths start at the same ticks, a
+    multiple of dt_update, the requests to the different baths are in flight at the same time.
+    wait() blocks until one of the serial ports has data, the next tick or the next timeout is
+    due. The serial devices are registered with a selector if they provide a fileno() (posix),
+    otherwise wait() sleeps in steps of dt_sleep.
+
+    Args:
+        dt_update: Time between two update ticks [s], at a tick each bath polls its due
+            variables
+        dt_wait: Maximum time wait() blocks [s]
+        dt_sleep: Sleep time if the serial devices cannot be selected [s]
+    """
+
+    def __init__(self, dt_update=1.0, dt_wait=0.1, dt_sleep=0.005):
+        self.dt_update = dt_update
+        self.dt_wait = dt_wait
+        self.dt_sleep = dt_sleep
+        self.baths = []
+        self.t_next = None
+        self.selector = selectors.DefaultSelector()
+        self.selectable = True
+
+    def add_bath(self, bath):
+        self.baths.append(bath)
+        try:
+            self.selector.register(bath.protocol.serial_device, selectors.EVENT_READ, bath)
+        except Exception:
+            logger.debug('Serial device of bath %s cannot be selected', bath.name)
+            self.selectable = False
+        return bath
+
+    def get_bath(self, bath=None):
+        """
+        Returns a bath by its index or name, the first bath if bath is None
+        """
+        if bath is None:
+            return self.baths[0]
+        if isinstance(bath, int):
+            return self.baths[bath]
+        for b in self.baths:
+            if b.name == bath or b.packetid == bath:
+                return b
+        raise KeyError('No bath {}'.format(bath))
+
+    def next_deadline(self, t_now):
+        deadlines = [d for d in (b.protocol.deadline() for b in self.baths) if d is not None]
+        if self.t_next is not None:
+            deadlines.append(self.t_next)
+        if len(deadlines) == 0:
+            return t_now + self.dt_wait
+        return min(deadlines)
+
+    def wait(self):
+        t_now = time.time()
+        timeout = min(max(self.next_deadline(t_now) - t_now, 0.0), self.dt_wait)
+        if self.selectable and self.baths:
+            self.selector.select(timeout)
+        else:
+            time.sleep(min(timeout, self.dt_sleep))
+
+    def process(self, t_now=None):
+        """
+        Starts the updates at a tick, polls the protocols of all baths
+
+        Returns:
+            list of (bath, data) of the baths that finished an update
+        """
+        if t_now is None:
+            t_now = time.time()
+        if self.t_next is None:
+            self.t_next = math.ceil(t_now / self.dt_update) * self.dt_update
+        if t_now >= self.t_next:
+            for bath in self.baths:
+                bath.start_update(self.t_next)
+            # Missed ticks are skipped, the updates stay on the grid
+            self.t_next += (math.floor((t_now - self.t_next) / self.dt_update) + 1) * self.dt_update
+        results = []
+        for bath in self.baths:
+            for request in bath.protocol.poll(t_now):
+                if request.priority and request.error is not None:
+                    logger.warning('Bath %s: %s failed: %s', bath.name, request.command, request.error)
+            data = bath.collect()
+            if data is not None:
+                results.append((bath, data))
+        return results
+
+    def step(self):
+        self.wait()
+        return self.process()
+
+    def close(self):
+        self.selector.close()
+        for bath in self.baths:
+            try:
+                bath.protocol.serial_device.close()
+            except Exception:
+                pass
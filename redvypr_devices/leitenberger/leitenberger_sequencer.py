@@ -0,0 +1,248 @@
+"""
+Setpoint sequencer for calibration runs with a Leitenberger bath.
+
+The sequencer steps through a list of setpoints. After a setpoint was sent, the bath temperature
+is checked with running statistics over a time window (standard deviation and drift, the slope
+of a linear fit). A setpoint counts as reached when the window is filled, standard deviation and
+drift are below their limits, the mean is close to the setpoint and the bath reports itself as
+steady. After the temperature was stable for the hold time, the next setpoint is sent.
+"""
+import collections
+import logging
+import math
+
+logger = logging.getLogger('leitenberger.sequencer')
+
+
+class RunningWindowStatistics:
+    """
+    Mean, standard deviation and linear drift of the samples of the last window seconds. The sums
+    are updated with every added and removed sample, time and value are relative to a reference
+    sample to keep the sums small.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.samples = collections.deque()
+        self.t_ref = None
+        self.x_ref = None
+        self.st = 0.0
+        self.sx = 0.0
+        self.stt = 0.0
+        self.sxx = 0.0
+        self.stx = 0.0
+
+    def _accumulate(self, t, x, sign):
+        t = t - self.t_ref
+        x = x - self.x_ref
+        self.st += sign * t
+        self.sx += sign * x
+        self.stt += sign * t * t
+        self.sxx += sign * x * x
+        self.stx += sign * t * x
+
+    def _rereference(self):
+        samples = list(self.samples)
+        self.reset()
+        for t, x in samples:
+            self.add(t, x)
+
+    def add(self, t, x):
+        if self.t_ref is None:
+            self.t_ref = t
+            self.x_ref = x
+        self.samples.append((t, x))
+        self._accumulate(t, x, 1)
+        while self.samples[0][0] < (t - self.window):
+            t_old, x_old = self.samples.popleft()
+            self._accumulate(t_old, x_old, -1)
+        # The reference sample left the window long ago, the sums are recomputed
+        if (t - self.t_ref) > (100 * self.window):
+            self._rereference()
+
+    @property
+    def n(self):
+        return len(self.samples)
+
+    @property
+    def span(self):
+        if self.n == 0:
+            return 0.0
+        return self.samples[-1][0] - self.samples[0][0]
+
+    @property
+    def mean(self):
+        if self.n == 0:
+            return None
+        return self.x_ref + self.sx / self.n
+
+    @property
+    def std(self):
+        """
+        Sample standard deviation, None for less than two samples
+        """
+        n = self.n
+        if n < 2:
+            return None
+        var = (self.sxx - self.sx * self.sx / n) / (n - 1)
+        return math.sqrt(max(var, 0.0))
+
+    @property
+    def slope(self):
+        """
+        Slope of the least squares line through the samples [units/s], None if undefined
+        """
+        n = self.n
+        denom = n * self.stt - self.st * self.st
+        if n < 2 or denom <= 0:
+            return None
+        return (n * self.stx - self.st * self.sx) / denom
+
+
+class SetpointSequencer:
+    """
+    Steps through a list of setpoints, see the module documentation.
+
+    start() returns the first setpoint, update() is called with every data packet of the bath
+    and returns the next setpoint to be sent, None otherwise. The states are 'idle', 'settling'
+    (waiting for the stability criteria), 'hold' (stable, waiting for the hold time) and 'done'.
+
+    Args:
+        setpoints: list of setpoints [degC]
+        window: Length of the statistics window [s]
+        max_std: Maximum standard deviation of the temperature in the window [K]
+        max_drift: Maximum absolute drift of the temperature [K/min]
+        max_offset: Maximum difference between the mean temperature and the setpoint [K], None
+            to not check it
+        require_steady: Require the steadiness flag of the bath
+        min_time: Minimum time after sending a setpoint before it can count as reached [s]
+        hold_time: Time the temperature has to be stable before the next setpoint [s]
+        max_time: Time after which the next setpoint is sent even if not stable [s], None for
+            no limit
+        temp_name: Key of the temperature in the data packets
+        steady_name: Key of the steadiness flag in the data packets
+    """
+
+    def __init__(self, setpoints, window=120.0, max_std=0.005, max_drift=0.005, max_offset=0.1,
+                 require_steady=True, min_time=60.0, hold_time=60.0, max_time=None,
+                 temp_name='temp', steady_name='temp_steady'):
+        self.setpoints = list(setpoints)
+        self.max_std = max_std
+        self.max_drift = max_drift
+        self.max_offset = max_offset
+        self.require_steady = require_steady
+        self.min_time = min_time
+        self.hold_time = hold_time
+        self.max_time = max_time
+        self.temp_name = temp_name
+        self.steady_name = steady_name
+        self.statistics = RunningWindowStatistics(window)
+        self.state = 'idle'
+        self.istep = -1
+        self.steady = None
+        self.t_step = None
+        self.t_stable = None
+        self.results = []
+
+    @property
+    def setpoint(self):
+        if 0 <= self.istep < len(self.setpoints):
+            return self.setpoints[self.istep]
+        return None
+
+    def start(self, t):
+        """
+        Starts the sequence, returns the first setpoint
+        """
+        self.results = []
+        self.istep = -1
+        return self.next_step(t)
+
+    def stop(self):
+        self.state = 'idle'
+        self.istep = -1
+
+    def next_step(self, t):
+        self.istep += 1
+        self.statistics.reset()
+        self.steady = None
+        self.t_stable = None
+        if self.istep >= len(self.setpoints):
+            self.state = 'done'
+            logger.info('Sequence done')
+            return None
+        self.state = 'settling'
+        self.t_step = t
+        logger.info('Step %d: setpoint %s', self.istep, self.setpoint)
+        return self.setpoint
+
+    def is_stable(self, t):
+        """
+        Returns True if all stability criteria are fulfilled
+        """
+        stats = self.statistics
+        if (t - self.t_step) < self.min_time:
+            return False
+        if stats.span < (0.9 * stats.window) or stats.std is None or stats.slope is None:
+            return False
+        if stats.std > self.max_std or abs(stats.slope * 60.0) > self.max_drift:
+            return False
+        if self.max_offset is not None and abs(stats.mean - self.setpoint) > self.max_offset:
+            return False
+        if self.require_steady and not self.steady:
+            return False
+        return True
+
+    def update(self, t, data):
+        """
+        Adds the data of a bath packet
+
+        Returns:
+            The next setpoint if it has to be sent, otherwise None
+        """
+        if self.state in ('idle', 'done'):
+            return None
+        if self.steady_name in data:
+            self.steady = data[self.steady_name] != 0
+        if self.temp_name not in data:
+            return None
+        self.statistics.add(t, data[self.temp_name])
+        if self.is_stable(t):
+            if self.state == 'settling':
+                self.state = 'hold'
+                self.t_stable = t
+                logger.info('Step %d: stable after %.0f s', self.istep, t - self.t_step)
+            if (t - self.t_stable) >= self.hold_time:
+                return self.finish_step(t, 'stable')
+        elif self.state == 'hold':
+            logger.info('Step %d: not stable anymore', self.istep)
+            self.state = 'settling'
+            self.t_stable = None
+
+        if self.max_time is not None and (t - self.t_step) > self.max_time:
+            logger.warning('Step %d: not stable within %.0f s', self.istep, self.max_time)
+            return self.finish_step(t, 'timeout')
+        return None
+
+    def finish_step(self, t, reason):
+        stats = self.statistics
+        self.results.append({'setpoint': self.setpoint, 't_start': self.t_step,
+                             't_stable': self.t_stable, 't_end': t, 'reason': reason,
+                             'mean': stats.mean, 'std': stats.std,
+                             'drift': stats.slope * 60.0 if stats.slope is not None else None})
+        return self.next_step(t)
+
+    def status(self):
+        """
+        Returns the state of the sequencer as a dict for the data packets
+        """
+        stats = self.statistics
+        status = {'sequence_state': self.state,
+                  'sequence_step': self.istep,
+                  'sequence_stable': int(self.state == 'hold'),
+                  'temp_window_std': stats.std,
+                  'temp_window_drift': stats.slope * 60.0 if stats.slope is not None else None}
+        return status
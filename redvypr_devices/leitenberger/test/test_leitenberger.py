@@ -0,0 +1,21 @@
+import pydantic
+import pytest
+
+pytest.importorskip("PyQt6.QtWidgets")
+from redvypr_devices.leitenberger import leitenberger
+
+
+def test_bath_packetids():
+    baths = [leitenberger.BathConfig(comport='COM2'),
+             leitenberger.BathConfig(comport='COM3', packetid='lb_ref'),
+             leitenberger.BathConfig(comport='COM4')]
+    assert leitenberger.bath_packetids(baths) == ['bath1', 'lb_ref', 'bath3']
+    assert leitenberger.bath_packetids([b.model_dump() for b in baths]) == ['bath1', 'lb_ref', 'bath3']
+    config = leitenberger.DeviceCustomConfig(baths=baths)
+    assert len(config.baths) == 3
+    # Additional baths cannot publish to the same address
+    with pytest.raises(pydantic.ValidationError):
+        leitenberger.DeviceCustomConfig(baths=[{'comport': 'COM2', 'packetid': 'lb'},
+                                               {'comport': 'COM3', 'packetid': 'lb'}])
+    with pytest.raises(pydantic.ValidationError):
+        leitenberger.DeviceCustomConfig(baths=[{'comport': 'COM2'}, {'comport': 'COM3', 'packetid': 'bath1'}])
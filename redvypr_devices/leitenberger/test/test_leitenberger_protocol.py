@@ -0,0 +1,159 @@
+from redvypr_devices.leitenberger.leitenberger_protocol import LeitenbergerProtocol, LeitenbergerBath, LeitenbergerMultiplexer, PollVariable, parse_float, parse_int
+
+
+class FakeBath:
+    """
+    Serial device answering the RVAR/WVAR commands of a bath, the answers are delivered in
+    pieces of chunksize bytes
+    """
+
+    def __init__(self, variables, chunksize=3, silent=()):
+        self.variables = dict(variables)
+        self.chunksize = chunksize
+        self.silent = silent
+        self.written = []
+        self.output = b''
+
+    @property
+    def in_waiting(self):
+        return min(len(self.output), self.chunksize)
+
+    def read(self, n):
+        data = self.output[:n]
+        self.output = self.output[n:]
+        return data
+
+    def reset_input_buffer(self):
+        self.output = b''
+
+    def write(self, data):
+        self.written.append(data)
+        command = data.decode().strip()[2:]
+        if command.startswith('RVAR'):
+            variable = int(command[4:])
+            if variable in self.silent:
+                return
+            self.output += '*1 {}\r'.format(self.variables[variable]).encode()
+        elif command.startswith('WVAR'):
+            variable, value = command[4:].split()
+            self.variables[int(variable)] = '+{:07.2f}'.format(float(value.replace(',', '.')))
+            self.output += b'*1 OK\r'
+
+
+def run(protocol, t_start=0.0, dt=0.01, n=100):
+    completed = []
+    for i in range(n):
+        completed.extend(protocol.poll(t_now=t_start + i * dt))
+        if protocol.idle:
+            break
+    return completed
+
+
+def test_protocol_read_variables():
+    bath = FakeBath({0: '+0020.00', 100: '+0023.18', 29: '1', 28: '0,05'})
+    protocol = LeitenbergerProtocol(bath)
+    requests = [protocol.read_variable(0, 'temp_set'),
+                protocol.read_variable(100, 'temp'),
+                protocol.read_variable(29, 'temp_steady', parse=parse_int),
+                protocol.read_variable(28, 'temp_stability')]
+    completed = run(protocol)
+    assert completed == requests
+    assert [r.value for r in requests] == [20.0, 23.18, 1, 0.05]
+    assert all([r.error is None for r in requests])
+    # One request at a time
+    assert bath.written == [b'$1RVAR0 \r', b'$1RVAR100 \r', b'$1RVAR29 \r', b'$1RVAR28 \r']
+    assert protocol.nanswered == 4
+
+
+def test_protocol_priority_and_timeout():
+    bath = FakeBath({0: '+0020.00', 100: '+0023.18', 29: '0'}, silent=(29,))
+    protocol = LeitenbergerProtocol(bath, timeout=0.1)
+    protocol.read_variable(0, 'temp_set')
+    protocol.read_variable(29, 'temp_steady', parse=parse_int)
+    protocol.read_variable(100, 'temp')
+    protocol.poll(t_now=0.0)  # Sends RVAR0
+    write = protocol.write_variable(0, 12.5, name='set')
+    completed = run(protocol, t_start=0.01)
+    # The write goes before the pending reads
+    assert bath.written[1] == b'$1WVAR0 12,5 \r'
+    assert write.value == 'OK'
+    byname = {r.name: r for r in completed}
+    assert byname['temp_steady'].error == 'timeout'
+    assert byname['temp'].value == 23.18
+    assert protocol.ntimeout == 1
+    # Bytes received until a timeout are discarded
+    request = protocol.read_variable(0, 'temp_set', parse=parse_float)
+    bath.silent = (0,)
+    protocol.poll(t_now=20.0)
+    protocol.feed(b'*1 +00', t_now=20.0)
+    bath.output = b'99.00\r'
+    assert protocol.check_timeouts(21.0) == [request]
+    assert protocol.buffer == b'' and bath.output == b''
+
+
+def test_protocol_parse_error():
+    bath = FakeBath({100: 'ERR'})
+    protocol = LeitenbergerProtocol(bath)
+    request = protocol.read_variable(100, 'temp')
+    run(protocol)
+    assert request.error == 'parse'
+    assert request.value is None
+
+
+def test_multiplexer():
+    variables = [(0, 'temp_set', parse_float), (100, 'temp', parse_float), (29, 'temp_steady', parse_int)]
+    multiplexer = LeitenbergerMultiplexer(dt_update=1.0)
+    fakes = []
+    for i in range(3):
+        fakes.append(FakeBath({0: '+0020.00', 100: '+002{}.00'.format(i), 29: '1'}))
+        protocol = LeitenbergerProtocol(fakes[-1])
+        multiplexer.add_bath(LeitenbergerBath(protocol, variables, name='bath{}'.format(i),
+                                              packetid='lb{}'.format(i)))
+    assert not multiplexer.selectable
+    multiplexer.get_bath('lb2').protocol.write_variable(0, 5.0)
+    results = []
+    t_updates = []
+    for i in range(305):
+        for bath, data in multiplexer.process(t_now=100.5 + i * 0.01):
+            results.append((bath.name, data))
+            t_updates.append(bath.t_update)
+    # Three updates of all baths at the same ticks
+    assert len(results) == 9
+    assert sorted(set(t_updates)) == [101.0, 102.0, 103.0]
+    assert results[0] == ('bath0', {'temp_set': 20.0, 'temp': 20.0, 'temp_steady': 1})
+    assert results[2] == ('bath2', {'temp_set': 5.0, 'temp': 22.0, 'temp_steady': 1})
+    assert fakes[2].written[0] == b'$1WVAR0 5,0 \r'
+    # Every bath got its own reads, the write only went to its bath
+    assert [len(f.written) for f in fakes] == [9, 9, 10]
+    assert multiplexer.next_deadline(103.5) == 104.0
+
+
+def test_adaptive_poll_rate():
+    variables = [PollVariable(100, 'temp', period=0.5, period_steady=2.0),
+                 PollVariable(29, 'temp_steady', parse='int', period=1.0, period_steady=1.0)]
+    fake = FakeBath({0: '+0020.00', 100: '+0020.00', 29: '0'})
+    bath = LeitenbergerBath(LeitenbergerProtocol(fake), variables)
+    multiplexer = LeitenbergerMultiplexer(dt_update=0.1)
+    multiplexer.add_bath(bath)
+
+    def count_reads(t_start, t_end):
+        nwritten = len(fake.written)
+        t = t_start
+        while t < t_end:
+            multiplexer.process(t_now=t)
+            t += 0.01
+        reads = [w for w in fake.written[nwritten:] if w.startswith(b'$1RVAR')]
+        return reads.count(b'$1RVAR100 \r'), reads.count(b'$1RVAR29 \r')
+
+    # Ramping
+    assert count_reads(0.0, 10.0) == (20, 10)
+    assert not bath.steady
+    fake.variables[29] = '1'
+    count_reads(10.0, 12.0)
+    assert bath.steady
+    assert count_reads(12.0, 22.0) == (5, 10)
+    # A new setpoint switches to the fast rate
+    bath.write_variable(0, 10.0)
+    assert not bath.steady
+    fake.variables[29] = '0'
+    assert count_reads(22.0, 32.0) == (20, 10)
@@ -0,0 +1,61 @@
+import numpy as np
+from redvypr_devices.leitenberger.leitenberger_sequencer import RunningWindowStatistics, SetpointSequencer
+
+
+def test_running_window_statistics():
+    rng = np.random.default_rng(0)
+    t = np.cumsum(rng.uniform(0.5, 1.5, 5000)) + 1.7e9
+    x = 20 + 0.001 * (t - t[0]) + rng.normal(0, 0.01, len(t))
+    stats = RunningWindowStatistics(window=60.0)
+    for i in range(len(t)):
+        stats.add(t[i], x[i])
+        if i % 500 == 499:
+            ind = (t >= t[i] - 60.0) & (t <= t[i])
+            assert stats.n == ind.sum()
+            assert np.isclose(stats.mean, x[ind].mean())
+            assert np.isclose(stats.std, x[ind].std(ddof=1))
+            assert np.isclose(stats.slope, np.polyfit(t[ind] - t[i], x[ind], 1)[0])
+
+
+def simulate_bath(sequencer, tau=200.0, noise=0.001, dt=1.0, t_end=20000.0, seed=0):
+    """
+    Bath approaching its setpoint exponentially, steady if closer than 0.05 K
+    """
+    rng = np.random.default_rng(seed)
+    temp = 20.0
+    setpoint = sequencer.start(0.0)
+    t = 0.0
+    setpoints = [(0.0, setpoint)]
+    while t < t_end and sequencer.state != 'done':
+        t += dt
+        temp = setpoint + (temp - setpoint) * np.exp(-dt / tau)
+        temp_meas = temp + rng.normal(0, noise)
+        data = {'temp': temp_meas, 'temp_steady': int(abs(temp - setpoint) < 0.05)}
+        setpoint_new = sequencer.update(t, data)
+        if setpoint_new is not None:
+            setpoint = setpoint_new
+            setpoints.append((t, setpoint))
+    return setpoints
+
+
+def test_sequencer():
+    sequencer = SetpointSequencer([10.0, 5.0, 15.0], window=60.0, max_std=0.005, max_drift=0.005,
+                                  max_offset=0.02, min_time=30.0, hold_time=30.0)
+    setpoints = simulate_bath(sequencer)
+    assert sequencer.state == 'done'
+    assert [s[1] for s in setpoints] == [10.0, 5.0, 15.0]
+    assert [r['reason'] for r in sequencer.results] == ['stable'] * 3
+    for r in sequencer.results:
+        assert abs(r['mean'] - r['setpoint']) < 0.02
+        assert r['t_end'] - r['t_stable'] >= 30.0
+        # Much shorter than a fixed dwell of ten time constants
+        assert r['t_end'] - r['t_start'] < 2000.0
+
+
+def test_sequencer_timeout():
+    # Too noisy to become stable
+    sequencer = SetpointSequencer([10.0], window=60.0, max_std=0.001, max_time=1000.0)
+    simulate_bath(sequencer, noise=0.01)
+    assert sequencer.state == 'done'
+    assert sequencer.results[0]['reason'] == 'timeout'
+    assert sequencer.status()['sequence_step'] == 1
@@ -0,0 +1,46 @@
+import os
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+QtWidgets = pytest.importorskip("PyQt6.QtWidgets")
+from redvypr_devices.leitenberger import leitenberger
+
+
+class FakeDevice:
+    """
+    The parts of a redvypr device used by the widgets
+    """
+    redvypr = None
+
+    def __init__(self, custom_config):
+        self.custom_config = custom_config
+        self.commands = []
+
+    def subscribe_address(self, *args, **kwargs):
+        pass
+
+    def get_metadata(self, *args, **kwargs):
+        return {}
+
+    def thread_command(self, command, data=None):
+        self.commands.append((command, data))
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def test_display_widget(app):
+    config = leitenberger.DeviceCustomConfig(sequencer=leitenberger.SequencerConfig(setpoints=[5.0, 10.0]))
+    device = FakeDevice(config)
+    widget = leitenberger.displayDeviceWidget(device=device)
+    assert widget.setpointsEdit.text() == "5.0, 10.0"
+    widget.setpointsEdit.setText("1; 2.5")
+    widget.buttonSequence.click()
+    widget.buttonSequenceStop.click()
+    widget.buttonSendcom.click()
+    assert device.commands == [("sequence_start", {"setpoints": [1.0, 2.5]}),
+                               ("sequence_stop", None),
+                               ("set", {"temp": 10.0})]
+    assert config.sequencer.setpoints == [1.0, 2.5]
@@ -1,3 +1,3 @@
-from . import sea_sun_tech, sea_sun_tech_config
+from . import sea_sun_tech, sea_sun_tech_config, sea_sun_tech_calibration
 
 redvypr_devicemodule = True
@@ -12,22 +12,25 @@ import pydantic
 import typing
 from pathlib import Path
 import multiprocessing
+from multiprocessing import shared_memory
 import threading
+import mmap
 from redvypr.data_packets import create_datadict
+from redvypr.device import RedvyprDevice
 from redvypr.redvypr_address import RedvyprAddress
 from redvypr.widgets.standard_device_widgets import RedvyprdevicewidgetSimple
 from redvypr.devices.interface.serial_single import SerialDeviceConfig, SerialDeviceWidget
 from redvypr.data_packets import check_for_command
 from redvypr.devices.plot import XYPlotWidget
 from .sea_sun_tech_config import SstDeviceConfig
-from .sea_sun_tech_hhl import HHL, pop_channel_sequence
+from .sea_sun_tech_hhl import HHL, ChannelSequenceFramer, HHLStreamDetector
+from .sea_sun_tech_stats import PipelineStatistics, SampledTrace
 
 description = 'Device to connect to Sea and Sun Technology CTD and MSS devices'
 
 
 logging.basicConfig(stream=sys.stderr)
 logger = logging.getLogger('redvypr_devices.sea_sun_tech')
-logger.setLevel(logging.DEBUG)
 
 class DeviceBaseConfig(pydantic.BaseModel):
     publishes: bool = True
@@ -38,21 +41,209 @@ class DeviceBaseConfig(pydantic.BaseModel):
 
 class DeviceCustomConfig(pydantic.BaseModel):
     input_type: typing.Literal["serial","datastream","file"] = pydantic.Field(default = "serial", description='The input data for the device')
-    input_datastream: RedvyprAddress = pydantic.Field(default = RedvyprAddress("data@"), description='The redvypr address for the input_type "datastream"')
+    input_datastream: RedvyprAddress = pydantic.Field(default = RedvyprAddress("data@"), description='The redvypr address of the rawdata for the input_type "datastream", the device subscribes to it when started, the time of the bytes is interpolated between the packet times')
     input_serial: SerialDeviceConfig = pydantic.Field(
         default_factory=SerialDeviceConfig,
         description='The serial device config for the input_type "serial"')
     input_file: Path = pydantic.Field(default=".",description="Path of the input file")
+    input_file_pacing: typing.Literal["realtime","fast"] = pydantic.Field(default="realtime", description='Replay the input file with the timing of the baud rate or as fast as possible')
+    input_file_blocksize: int = pydantic.Field(default=2**20, description='Number of bytes of the input file decoded at once with input_file_pacing "fast"')
     #sst_device: typing.Optional[SstDeviceConfig] = pydantic.Field(default = None, description='The device config')
     prbfile: typing.Optional[Path] = pydantic.Field(default=None,description="Path to the .prb file")
+    prb_cache: bool = pydantic.Field(default=True, description="Cache the validated config of the .prb file on disk as JSON, the cache is keyed by the file content")
     probe_type: typing.Literal["mss","ctm"] = pydantic.Field(default="ctm",description="Type of the sensor probe")
-    dt_poll_serial: float = pydantic.Field(default=0.01,description="Polling interval for the serial port")
+    dt_poll_serial: float = pydantic.Field(default=0.01,description="Maximum time [s] the processing loop waits for new serial data")
+    acquisition_backend: typing.Literal["thread","process"] = pydantic.Field(default="thread", description='Read the serial port in a thread or in a separate process, the process passes the data through shared memory')
     raw_data_device_offset: int = pydantic.Field(default=0,description="Offset of the device")
+    calibration_lut: typing.Optional[typing.Literal["float32","float64"]] = pydantic.Field(default=None, description="Calibrate with precomputed lookup tables of this dtype, None for the analytic calibration")
+    detection_confidence_min: float = pydantic.Field(default=0.9, description="Minimum confidence (0-1) of the HHL stream detection before the data is processed")
+    publish_nscans: int = pydantic.Field(default=250, description="Maximum number of scans per packet for concatenated (MSS) data")
+    publish_dt: typing.Optional[float] = pydantic.Field(default=None, description="Maximum time span [s] of the scans per packet for concatenated (MSS) data, None for no limit")
+    publish_latency_max: float = pydantic.Field(default=1.0, description="Maximum time [s] a scan is buffered before it is published")
+    statistics_dt: typing.Optional[float] = pydantic.Field(default=10.0, description="Interval [s] at which the pipeline statistics are published, None to disable")
+    loglevel: typing.Literal["DEBUG","INFO","WARNING","ERROR"] = pydantic.Field(default="INFO", description="Loglevel of the device, also used for the HHL decoder and the probe configuration")
+    publish_raw: bool = pydantic.Field(default=False, description="Publish the rawdata of every sensor as <sensorname>_raw in addition to the calibrated data, e.g. for a calibration")
+    trace_interval: float = pydantic.Field(default=1.0, description="Minimum time [s] between two debug messages of the same kind in the processing loop, 0 to log every message")
 
 
 redvypr_devicemodule = True
 
 
+class Device(RedvyprDevice):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def thread_start(self, config=None):
+        # The rawdata of the input_type "datastream" arrives through the subscription
+        if self.custom_config.input_type == "datastream":
+            self.subscribe_address(self.custom_config.input_datastream)
+        super().thread_start(config=config)
+
+
+class ColumnarPacketBuffer:
+    """
+    Collects calibrated scans in preallocated float64 arrays, one row per sensor plus the time,
+    and creates packets with contiguous numpy arrays once publish_nscans scans are collected
+    or the scans span more than publish_dt seconds.
+    """
+
+    def __init__(self, names, packetid, publish_nscans=250, publish_dt=None):
+        self.names = list(names)
+        self.packetid = packetid
+        self.publish_nscans = publish_nscans
+        self.publish_dt = publish_dt
+        self._allocate()
+
+    def _allocate(self):
+        # A new block is allocated for every packet, the packet keeps views of the old one
+        self.t = np.empty(self.publish_nscans)
+        self.data = np.empty((len(self.names), self.publish_nscans))
+        self.nscans = 0
+        self.t_added = None  # Local time when the first scan of the block was added
+
+    def age(self):
+        """
+        Returns the time [s] the oldest scan of the block is buffered
+        """
+        if self.t_added is None:
+            return 0.0
+        return time.time() - self.t_added
+
+    def add(self, times, data):
+        """
+        Adds scans to the buffer
+
+        Args:
+            times: The times of the scans
+            data: (nscans x nsensors) array, the columns in the order of self.names
+
+        Returns:
+            list: The packets that are ready to be published
+        """
+        packets = []
+        iscan = 0
+        if self.t_added is None and len(times) > 0:
+            self.t_added = time.time()
+        while iscan < len(times):
+            n = min(len(times) - iscan, self.publish_nscans - self.nscans)
+            window_closed = False
+            if self.publish_dt is not None:
+                t0 = self.t[0] if self.nscans > 0 else times[iscan]
+                nwindow = np.searchsorted(times[iscan:iscan + n], t0 + self.publish_dt)
+                if nwindow < n:
+                    n = nwindow if self.nscans > 0 else max(nwindow, 1)
+                    window_closed = True
+            self.t[self.nscans:self.nscans + n] = times[iscan:iscan + n]
+            self.data[:, self.nscans:self.nscans + n] = data[iscan:iscan + n].T
+            self.nscans += n
+            iscan += n
+            if window_closed or self.nscans == self.publish_nscans:
+                packets.append(self.flush())
+                if iscan < len(times):
+                    self.t_added = time.time()
+        return packets
+
+    def flush(self):
+        """
+        Creates a packet of the collected scans and starts a new block
+
+        Returns:
+            The packet or None if no scans are collected
+        """
+        if self.nscans == 0:
+            return None
+        packet = create_datadict(packetid=self.packetid, tu=time.time())
+        packet['t'] = self.t[:self.nscans]
+        for i, name in enumerate(self.names):
+            packet[name] = self.data[i, :self.nscans]
+        self._allocate()
+        return packet
+
+
+
+class SharedMemoryChunkRing:
+    """
+    Passes chunks of rawdata from a reader process to the processing thread through the slots
+    of a shared memory block. Only the slot indices are sent through multiprocessing queues,
+    the bytes and times are not pickled. put() and get() work with the same [data, data_time,
+    dt_per_byte] lists as the data_queue of read_serial(), chunks larger than a slot are split.
+    """
+
+    def __init__(self, nslots=256, slotsize=512):
+        self.nslots = nslots
+        self.slotsize = slotsize
+        self.shm = shared_memory.SharedMemory(create=True, size=nslots * (slotsize + 24))
+        self.queue_free = multiprocessing.Queue()
+        self.queue_filled = multiprocessing.Queue()
+        for islot in range(nslots):
+            self.queue_free.put(islot)
+        self._attach()
+
+    def _attach(self):
+        self.data = np.ndarray((self.nslots, self.slotsize), dtype=np.uint8, buffer=self.shm.buf)
+        self.meta = np.ndarray(self.nslots, dtype=[("nbytes", np.int64), ("t", np.float64), ("dt", np.float64)],
+                               buffer=self.shm.buf, offset=self.nslots * self.slotsize)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["shm"], state["data"], state["meta"]
+        state["shm_name"] = self.shm.name
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop("shm_name")
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self._attach()
+
+    def put(self, data_buf, timeout=None):
+        """
+        Writes a chunk into free slots, blocks if all slots are in use
+        """
+        data, data_time, dt_per_byte = data_buf
+        n = len(data)
+        for istart in range(0, n, self.slotsize):
+            iend = min(istart + self.slotsize, n)
+            islot = self.queue_free.get(timeout=timeout)
+            self.data[islot, :iend - istart] = np.frombuffer(data, dtype=np.uint8, count=iend - istart, offset=istart)
+            self.meta[islot] = (iend - istart, data_time - (n - iend) * dt_per_byte, dt_per_byte)
+            self.queue_filled.put(islot)
+
+    def get(self, timeout=None):
+        """
+        Returns the next chunk or None if stop() was called
+        """
+        islot = self.queue_filled.get(timeout=timeout)
+        if islot is None:
+            return None
+        nbytes, data_time, dt_per_byte = self.meta[islot].tolist()
+        data = self.data[islot, :nbytes].tobytes()
+        self.queue_free.put(islot)
+        return [data, data_time, dt_per_byte]
+
+    def stop(self):
+        """
+        Lets a waiting get() return None
+        """
+        self.queue_filled.put(None)
+
+    def close(self, unlink=True):
+        del self.data, self.meta
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def forward_chunks(chunk_ring, data_queue):
+    """
+    Forwards the chunks of a SharedMemoryChunkRing into data_queue until it is stopped
+    """
+    while True:
+        data_buf = chunk_ring.get()
+        if data_buf is None:
+            return
+        data_queue.put(data_buf)
+
 
 def read_serial(config, data_queue, data_queue_in):
     # Setup serial connection
@@ -99,16 +290,10 @@ def read_serial(config, data_queue, data_queue_in):
 
     nread = 512
     while True:
-        current_time = time.time()
         data = ser.read(nread)
-        # Relative Zeiten mit NumPy berechnen (rückwärts vom letzten Byte)
-        relative_times = np.arange(len(data) - 1, -1,
-                                   -1) * dt_per_byte  # [47*dt, 46*dt, ..., 0*dt]
-
-        # Absolute Zeitstempel (als Liste)
-        data_time = (current_time - relative_times).tolist()
-        #data_time = [time.time()] * len(data)
-        data_queue.put([data,data_time])
+        # Time of the last byte, the time of the other bytes is reconstructed with dt_per_byte
+        data_time = time.time()
+        data_queue.put([data, data_time, dt_per_byte])
         try:
             data_queue_in.get_nowait()
             return
@@ -117,38 +302,123 @@ def read_serial(config, data_queue, data_queue_in):
 
 
 
+class InputEnd:
+    """
+    Put into the data queue by a reader when its input ended, error is the exception of a failed
+    reader, None at the end of the input
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def read_file(config, data_queue, data_queue_in):
+    """
+    Replays a raw HHL recording, the file is memory mapped and put in blocks into data_queue,
+    the time of the bytes is reconstructed from the baud rate. An InputEnd is put into
+    data_queue when the file is replayed or the replay failed.
+    """
+    funcname = __name__ + '.read_file()'
+
+    def put(item):
+        # data_queue is bounded for file input, check regularly for a stop while waiting
+        while True:
+            try:
+                data_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if not data_queue_in.empty():
+                    return False
+
+    try:
+        baud = config["input_serial"]["baud"]
+        bits_per_byte = 10
+        dt_per_byte = bits_per_byte / baud
+        if config["input_file_pacing"] == "realtime":
+            nread = max(512, int(0.1 / dt_per_byte))  # 0.1 s of data
+        else:
+            nread = config["input_file_blocksize"]
+
+        with open(config["input_file"], "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            nbytes = len(mm)
+            logger.debug(funcname + ':Replaying {} bytes of {}'.format(nbytes, config["input_file"]))
+            t_start = time.time()
+            for istart in range(0, nbytes, nread):
+                iend = min(istart + nread, nbytes)
+                data_time = t_start + iend * dt_per_byte  # Time after the last byte was received
+                if config["input_file_pacing"] == "realtime":
+                    try:  # Wait for the bytes to "arrive" or a stop
+                        data_queue_in.get(timeout=max(data_time - time.time(), 0))
+                        mm.close()
+                        return
+                    except queue.Empty:
+                        pass
+                if not put([mm[istart:iend], data_time, dt_per_byte]) or not data_queue_in.empty():
+                    mm.close()
+                    return
+            mm.close()
+    except Exception as e:
+        logger.exception(funcname + ':Could not replay {}'.format(config["input_file"]))
+        put(InputEnd(error=e))
+        return
+    logger.debug(funcname + ':Replayed {}'.format(config["input_file"]))
+    put(InputEnd())
+
+
+def forward_datainqueue(device_info, datainqueue, data_queue):
+    """
+    Blocks on datainqueue and forwards all packets to data_queue, returns after a stop command
+    """
+    while True:
+        data = datainqueue.get()
+        data_queue.put(data)
+        command = check_for_command(data, thread_uuid=device_info['thread_uuid'])
+        if command == 'stop':
+            return
+
+
 def start(device_info, config=None, dataqueue=None, datainqueue=None, statusqueue=None):
     """
 
     """
     funcname = __name__ + '.start()'
+    # The loggers of the HHL decoder and the probe configuration are children of logger
+    logger.setLevel(config["loglevel"])
+    trace = SampledTrace(logger, interval=config["trace_interval"])
     logger.debug(funcname + ':Starting Sea Sun Tech device')
-    print('Starting',config)
+    logger.debug('Config %s', config)
 
     # Setup serial connection
     if True:
         prbfile = config["prbfile"]
         if "mss" in config["probe_type"].lower():
-            print("Configuring a MSS probe")
+            logger.info('Configuring a MSS probe')
             shear_sensitivities = {'SHE1': 3.90e-4, 'SHE2': 4.05e-4}
             ctd_cfg = SstDeviceConfig.from_prb(prbfile,
-                                               shear_sensitivities=shear_sensitivities)
+                                               shear_sensitivities=shear_sensitivities,
+                                               cache=config["prb_cache"])
 
             n_buf_process = 1000
             flag_concatenate_data = True
         else:
-            print("Configuring a CTD probe")
-            ctd_cfg = SstDeviceConfig.from_prb(prbfile)
+            logger.info('Configuring a CTD probe')
+            ctd_cfg = SstDeviceConfig.from_prb(prbfile, cache=config["prb_cache"])
             n_buf_process = 8
             flag_concatenate_data = False
 
         sensors_by_channel = {}
         for k, s in ctd_cfg.sensors.items():
             sensors_by_channel[s.channel] = s
-        print("Probe cfg", ctd_cfg)
+        logger.debug('Probe cfg %s', ctd_cfg)
         device_offset = config["raw_data_device_offset"]
+        if config["calibration_lut"] is not None:
+            ctd_cfg.calibration_lut = config["calibration_lut"]
+            deviations = ctd_cfg.verify_lookup_tables(device_offset, dtype=config["calibration_lut"])
+            logger.info('Calibration lookup tables, maximum relative deviation %.2e',
+                        max(deviations.values(), default=0.0))
         packetid = f"sst_{ctd_cfg.name}"
-        print(f"Device offset:{device_offset}")
+        logger.debug('Device offset: %d', device_offset)
 
     # Setup serial connection
     if False:
@@ -157,7 +427,7 @@ def start(device_info, config=None, dataqueue=None, datainqueue=None, statusqueu
         sensors_by_channel = {}
         for k, s in ctd_cfg.sensors.items():
             sensors_by_channel[s.channel] = s
-        print("CTD cfg", ctd_cfg)
+        logger.debug('CTD cfg %s', ctd_cfg)
         device_offset = 0
     if False:
         prbfile = "MSS038_optode.prb"
@@ -166,129 +436,209 @@ def start(device_info, config=None, dataqueue=None, datainqueue=None, statusqueu
         sensors_by_channel = {}
         for k, s in ctd_cfg.sensors.items():
             sensors_by_channel[s.channel] = s
-        print("CTD cfg", ctd_cfg)
+        logger.debug('CTD cfg %s', ctd_cfg)
         device_offset = -32768
 
     # Create the serial reader thread
-    if True:
+    if config["input_type"] == "file":
+        # Bounded queue, the file is read faster than it is processed
+        data_queue = queue.Queue(maxsize=16)
+        data_read_serial_in = queue.Queue()
+        read_process = threading.Thread(target=read_file, args=(config, data_queue, data_read_serial_in))
+        read_process.start()
+    elif config["input_type"] == "datastream":
+        # The rawdata arrives with the packets of datainqueue, no reader needed
+        data_queue = queue.Queue()
+        data_read_serial_in = queue.Queue()
+    elif config["acquisition_backend"] == "thread":
         data_queue = queue.Queue()
         data_read_serial_in = queue.Queue()
         read_process = threading.Thread(target=read_serial, args=(config, data_queue, data_read_serial_in))
         read_process.start()
     else:
-        data_queue = multiprocessing.Queue()
+        # The serial port is read in its own process, the chunks arrive through shared memory
+        data_queue = queue.Queue()
         data_read_serial_in = multiprocessing.Queue()
-        read_process = multiprocessing.Process(target=read_serial, args=(config, data_queue, data_read_serial_in))
+        chunk_ring = SharedMemoryChunkRing()
+        read_process = multiprocessing.Process(target=read_serial, args=(config, chunk_ring, data_read_serial_in))
         read_process.start()
+        forward_chunks_thread = threading.Thread(target=forward_chunks, args=(chunk_ring, data_queue),
+                                                 daemon=True)
+        forward_chunks_thread.start()
 
+    # Forward the packets of datainqueue into data_queue, the loop below blocks only on data_queue
+    forward_thread = threading.Thread(target=forward_datainqueue,
+                                      args=(device_info, datainqueue, data_queue),
+                                      daemon=True)
+    forward_thread.start()
 
-    print("Creating hhl object")
     channel_sequence = None
-    data_test_sequence = b''
     hhl = HHL()
-    print("Starting loop")
-    data_send_cat = None
+    # A file is decoded completely, its undetected data is kept in the buffer
+    detector = HHLStreamDetector(hhl, confidence_min=config["detection_confidence_min"],
+                                 keep_undetected=config["input_type"] == "file")
+    packet_buffer = None
+    statistics = PipelineStatistics()
+    statistics_dt = config["statistics_dt"]
+    dt_poll = config["dt_poll_serial"]
+    if config["input_type"] == "datastream":
+        input_datastream = RedvyprAddress(config["input_datastream"])
+        t_datastream = None  # Time of the previous rawdata packet
+    else:
+        input_datastream = None
+    logger.debug(funcname + ':Starting loop')
     while True:
+        # Wait for new data or commands, the timeout is only needed to publish buffered scans
         try:
-            data = datainqueue.get_nowait()
-        except:
-            data = None
-            pass
-        if (data is not None):
-            command = check_for_command(data, thread_uuid=device_info['thread_uuid'])
-            if (command is not None):
-                logger.debug('Got a command: {:s}'.format(str(data)))
-                #print('Command', command)
-                if command == 'stop':
-                    sstr = funcname + ': Command is for me: {:s}'.format(str(command))
-                    logger.debug(sstr)
-                    data_read_serial_in.put("Stop")
-                    try:
-                        statusqueue.put_nowait(sstr)
-                    except:
-                        pass
-                    return
-
-
-
-        decoded_data_all = []
-        channels_all = []
-        if True:
-            if not data_queue.empty():
-                data_buf = data_queue.get()
-                hhl.add_to_buffer(data_buf[0], data_time=data_buf[1])
-
-                if channel_sequence is None:
-                    data_test_sequence += data_buf[0]
-                    print("Testing for HHL device")
-                    if len(data_test_sequence) > 500:
-                        channel_sequence = hhl.inspect_rawdata(data_test_sequence)
-                        if channel_sequence:
-                            data_decoded = hhl.decode_rawdata(data_test_sequence)
-                            print("Decoded data", data_decoded)
-
-            if channel_sequence:
-                if len(hhl.buffer) > n_buf_process:
-                    decoded_data = hhl.process_buffer()
-                    decoded_data_all.extend(decoded_data)
-                    itest = 0
-                    print("Processing", len(hhl.buffer),len(decoded_data_all),len(channel_sequence))
-                    while len(decoded_data_all) > len(channel_sequence):
+            items = [data_queue.get(timeout=dt_poll)]
+        except queue.Empty:
+            items = []
+        # Process everything that has arrived in the meantime at once
+        while True:
+            try:
+                items.append(data_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        flush_input = False
+        for data in items:
+            if isinstance(data, InputEnd):
+                # The remaining data is processed and published below
+                flush_input = True
+                if data.error is not None:
+                    sstr = funcname + ': Reading the input failed: {}'.format(data.error)
+                else:
+                    sstr = funcname + ': End of the input'
+                logger.info(sstr)
+                try:
+                    statusqueue.put_nowait(sstr)
+                except:
+                    pass
+                continue
+            if isinstance(data, dict):  # A redvypr packet from datainqueue
+                command = check_for_command(data, thread_uuid=device_info['thread_uuid'])
+                if (command is not None):
+                    logger.debug('Got a command: {:s}'.format(str(data)))
+                    #print('Command', command)
+                    if command == 'stop':
+                        sstr = funcname + ': Command is for me: {:s}'.format(str(command))
+                        logger.debug(sstr)
+                        data_read_serial_in.put("Stop")
+                        if config["input_type"] == "serial" and config["acquisition_backend"] == "process":
+                            read_process.join(timeout=2)
+                            if read_process.is_alive():
+                                read_process.terminate()
+                            chunk_ring.stop()
+                            forward_chunks_thread.join(timeout=1)
+                            chunk_ring.close()
+                        try:
+                            statusqueue.put_nowait(sstr)
+                        except:
+                            pass
+                        return
+                    continue
+
+                if input_datastream is None:
+                    continue
+                # Rawdata packet of another device, one time per packet, as for a serial chunk
+                rawdata = input_datastream(data, strict=False)
+                if not isinstance(rawdata, (bytes, bytearray)) or len(rawdata) == 0:
+                    continue
+                t_packet = data['t'] if 't' in data else data['_redvypr']['t']
+                # The bytes are spread over the time since the previous packet
+                dt_per_byte = 0.0
+                if t_datastream is not None and t_packet > t_datastream:
+                    dt_per_byte = (t_packet - t_datastream) / len(rawdata)
+                t_datastream = t_packet
+                data = [rawdata, t_packet, dt_per_byte]
+
+            data_buf = data
+            hhl.add_to_buffer(data_buf[0], data_time=data_buf[1], dt_per_byte=data_buf[2])
+            statistics.count("bytes_read", len(data_buf[0]))
+            statistics.count("chunks_read")
+
+            if channel_sequence is None:
+                trace("detect", 'Testing %d bytes for a HHL device',
+                      min(len(detector.data) + len(data_buf[0]), detector.max_bytes))
+                channel_sequence = detector.process(data_buf[0])
+                if channel_sequence is not None:
+                    logger.info('Detected HHL channel sequence {} with confidence {:.2f}'.format(
+                        channel_sequence, detector.detection["confidence"]))
+                    framer = ChannelSequenceFramer(channel_sequence)
+                    calibration_plan = ctd_cfg.calibration_plan(channel_sequence,
+                                                                offset=device_offset)
+                    names_publish = list(calibration_plan.names)
+                    if config["publish_raw"]:
+                        names_publish += [name + '_raw' for name in calibration_plan.names]
+                    packet_buffer = ColumnarPacketBuffer(names_publish, packetid,
+                                                         publish_nscans=config["publish_nscans"],
+                                                         publish_dt=config["publish_dt"])
+
+        if channel_sequence:
+            if len(hhl.buffer) > n_buf_process or (flush_input and len(hhl.buffer) > 0):
+                t0 = time.perf_counter()
+                decoded_data = hhl.process_buffer()
+                t1 = time.perf_counter()
+                scan_values, scan_times = framer.process(decoded_data)
+                t2 = time.perf_counter()
+                scan_data = calibration_plan.calibrate(scan_values)
+                if config["publish_raw"]:
+                    scan_data = np.hstack((scan_data, scan_values[:, calibration_plan.iraw]))
+                t3 = time.perf_counter()
+                statistics.timing("decode", t1 - t0)
+                statistics.timing("frame", t2 - t1)
+                statistics.timing("calibrate", t3 - t2)
+                statistics.count("scans_framed", len(scan_values))
+                statistics.count("calibration_failures", int(np.count_nonzero(~np.isfinite(scan_data))))
+                trace("process", 'Processing: %d scans, %d bytes left, %d frames dropped',
+                      len(scan_values), len(hhl.ringbuffer), framer.ndropped)
+                if flag_concatenate_data:
+                    for data_send_cat in packet_buffer.add(scan_times, scan_data):
+                        dataqueue.put(data_send_cat)
+                        statistics.count("packets_published")
+                        statistics.timing("latency", time.time() - data_send_cat['t'][-1])
+                        trace("latency", 'Latency %.3f s', time.time() - data_send_cat['t'][-1])
+                else:
+                    for iscan, scan_time in enumerate(scan_times):
                         data_send = create_datadict(packetid=packetid)
-                        itest += 1
-                        if itest > 1000:
-                            print("Problem, stopping")
-                            break
-
-                        channel_sequence_data = pop_channel_sequence(decoded_data_all,
-                                                                     channel_sequence)
-                        print("Got sequence", channel_sequence_data)
-                        if channel_sequence_data is None:
-                            break
-                        else:
-                            for i_ch, ch_data in enumerate(channel_sequence_data):
-                                print("ch_data",ch_data)
-                                chnum = ch_data[0]
-                                chdata = ch_data[1]
-                                chtime = ch_data[2]
-                                if chnum == 0:
-                                    data_send['t'] = chtime
-                                if chnum in sensors_by_channel:
-                                    chname = sensors_by_channel[chnum].name
-                                    #print(f"Processing channel {chnum} ({chname})")
-                                    try:
-                                        data = sensors_by_channel[chnum].raw_to_units(chdata,offset=device_offset)
-                                        #print(f"Data:{data}")
-                                        data_send[chname] = data
-                                    except:
-                                        pass
-
-                            # Concatenate data
-                            if flag_concatenate_data:
-                                if data_send_cat is None:
-                                    data_send_cat = create_datadict(
-                                        packetid=packetid)
-                                    for k in data_send.keys():
-                                        data_send_cat[k] = [data_send[k]]
-                                else:
-                                    for k in data_send.keys():
-                                        data_send_cat[k].append(data_send[k])
-
-                                    #print(data_send_cat)
-                                    #print(len(data_send_cat["t"]))
-                                    if len(data_send_cat['t']) > 250:
-                                        print("Sending cat data")
-                                        dataqueue.put(data_send_cat)
-                                        #dataqueue.put(data_send)
-                                        data_send_cat = None
-                                #print(f"Publishing sequence:{data_send}")
-                            else:
-                                dataqueue.put(data_send)
-
-                #print("Done processing")
-
-        #time.sleep(config["dt_poll_serial"])
-        time.sleep(0.001)
+                        data_send['t'] = scan_time
+                        for i, chname in enumerate(names_publish):
+                            data_send[chname] = scan_data[iscan, i]
+                        dataqueue.put(data_send)
+                    statistics.count("packets_published", len(scan_times))
+                    if len(scan_times) > 0:
+                        statistics.timing("latency", time.time() - scan_times[-1])
+                        trace("latency", 'Latency %.3f s', time.time() - scan_times[-1])
+                statistics.timing("publish", time.perf_counter() - t3)
+
+            # Bound the latency of the concatenated data if the scans come in slowly
+            if flag_concatenate_data and packet_buffer.nscans > 0 and (
+                    flush_input or packet_buffer.age() > config["publish_latency_max"]):
+                data_send_cat = packet_buffer.flush()
+                dataqueue.put(data_send_cat)
+                statistics.count("packets_published")
+                statistics.timing("latency", time.time() - data_send_cat['t'][-1])
+                trace("latency", 'Latency %.3f s', time.time() - data_send_cat['t'][-1])
+
+        if statistics_dt is not None and statistics.due(statistics_dt):
+            statistics.counters["frames_decoded"] = hhl.ngood
+            statistics.counters["bytes_discarded"] = hhl.nbad
+            if channel_sequence:
+                statistics.counters["frames_dropped"] = framer.ndropped
+            statistics.gauge("buffer_bytes", len(hhl.ringbuffer))
+            for qname, q in [("data_queue", data_queue), ("dataqueue", dataqueue)]:
+                try:
+                    statistics.gauge(qname, q.qsize())
+                except NotImplementedError:  # multiprocessing queues on macOS
+                    pass
+            snapshot = statistics.snapshot()
+            data_stat = create_datadict(packetid=packetid + '_statistics')
+            data_stat['statistics'] = snapshot
+            dataqueue.put(data_stat)
+            try:
+                statusqueue.put_nowait(statistics.status_string(snapshot))
+            except:
+                pass
 
 
 import typing
@@ -426,11 +776,10 @@ class RedvyprDeviceWidget(RedvyprdevicewidgetSimple):
 
     def config_changed(self, *args):
         """Triggered on any configuration change."""
-        print("config changed")
         # Update the device object with the latest state
         if hasattr(self, 'device'):
             self.device.custom_config = self.config
-            print(f"Current Config: {self.device.custom_config}")
+            logger.debug('Current Config: %s', self.device.custom_config)
 
     def _sync_config_to_ui(self):
         """Loads data from the config object into the UI widgets."""
@@ -451,6 +800,7 @@ class RedvyprDeviceWidget(RedvyprdevicewidgetSimple):
             self.lbl_prb_path.setText("Not set")
 
         self._update_visibility(c.input_type)
+        self._update_subscription(c.input_type)
 
         self.serial_widget.blockSignals(False)
         self.blockSignals(False)
@@ -462,11 +812,17 @@ class RedvyprDeviceWidget(RedvyprdevicewidgetSimple):
         self.spin_poll.setVisible(is_serial)
         self.serial_widget.setVisible(is_serial)
 
+    def _update_subscription(self, input_type: str):
+        """Subscribes to the rawdata of input_datastream for the input_type "datastream"."""
+        if input_type == "datastream":
+            self.device.subscribe_address(self.config.input_datastream)
+
     # --- EVENT HANDLERS ---
 
     def _on_input_type_changed(self, text: str):
         self.config.input_type = text
         self._update_visibility(text)
+        self._update_subscription(text)
 
     def _on_probe_type_changed(self, text: str):
         self.config.probe_type = text
@@ -494,8 +850,8 @@ class RedvyprDeviceWidget(RedvyprdevicewidgetSimple):
         """Dummy handler for scanning logic."""
         if not self.config.prbfile:
             return
-        print(f"DEBUG: Scanning PRB file at {self.config.prbfile}...")
+        logger.debug('Scanning PRB file at %s', self.config.prbfile)
 
     def _new_data(self, new_data_list):
-        print("Got new data",len(new_data_list))
+        logger.debug('Got new data %d', len(new_data_list))
 
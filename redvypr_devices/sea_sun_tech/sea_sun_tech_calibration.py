@@ -0,0 +1,128 @@
+"""
+Device fitting the calibration of Sea & Sun Technology sensors in a calibration bath.
+
+The device subscribes to the reference temperature of the bath (by default the temp of the
+Leitenberger devices) and to the rawdata of the probe (the Sea & Sun device with publish_raw, the
+rawdata of a sensor is published as <sensorname>_raw). Reference and rawdata are paired in time
+windows and the fits are updated with every pair, see sea_sun_tech_fit. The fitted coefficients are written
+into a copy of the prb file when the device is stopped or with the command 'write_prb'.
+"""
+import logging
+import sys
+import time
+import typing
+from pathlib import Path
+import pydantic
+from redvypr.data_packets import check_for_command, create_datadict
+from redvypr.redvypr_address import RedvyprAddress
+from .sea_sun_tech_config import SstDeviceConfig
+from .sea_sun_tech_fit import CalibrationFitter
+
+description = 'Fits the calibration of Sea and Sun Technology sensors against a reference temperature'
+
+logging.basicConfig(stream=sys.stderr)
+logger = logging.getLogger('redvypr_devices.sea_sun_tech.calibration')
+
+
+class DeviceBaseConfig(pydantic.BaseModel):
+    publishes: bool = True
+    subscribes: bool = True
+    description: str = 'Calibration of Sea and Sun Technology sensors'
+    gui_tablabel_display: str = 'Calibration'
+
+
+class DeviceCustomConfig(pydantic.BaseModel):
+    prbfile: typing.Optional[Path] = pydantic.Field(default=None, description="Path to the .prb file of the probe")
+    prbfile_fitted: typing.Optional[Path] = pydantic.Field(default=None, description="Path of the .prb file with the fitted coefficients, None for <prbfile>_fitted.prb")
+    sensors: typing.List[str] = pydantic.Field(default=["TEMP", "NTC"], description="The names of the sensors to calibrate, only polynomial (N) and Steinhart/Hart (SHH) sensors")
+    degrees: typing.Dict[str, int] = pydantic.Field(default={}, description="Degree of the fitted polynomial per sensor, the degree of the prb file if not given")
+    raw_data_device_offset: int = pydantic.Field(default=0, description="Offset of the device")
+    reference_address: RedvyprAddress = pydantic.Field(default=RedvyprAddress("temp@d:~/leitenberger/"), description="The redvypr address of the reference temperature, by default the temp of the Leitenberger devices, the probe publishes a temp as well")
+    require_stable: bool = pydantic.Field(default=True, description="Use only reference data of a stable bath (sequence_stable, or temp_steady without a running sequence)")
+    window: float = pydantic.Field(default=10.0, description="Length of the time windows in which reference and rawdata are averaged and paired [s]")
+    dt_publish: float = pydantic.Field(default=10.0, description="Interval [s] at which the fit status is published")
+
+
+redvypr_devicemodule = True
+
+
+def packet_time(data):
+    return data['t'] if 't' in data else data['_redvypr']['t']
+
+
+def start(device_info, config=None, dataqueue=None, datainqueue=None, statusqueue=None):
+    """
+    Pairs the reference temperature with the rawdata of the sensors and fits their calibrations
+    """
+    funcname = __name__ + '.start()'
+    logger.debug(funcname + ':Starting calibration fitter')
+    prbfile = config["prbfile"]
+    prbfile_fitted = config.get("prbfile_fitted", None)
+    if prbfile_fitted is None:
+        prbfile_fitted = Path(prbfile).with_name(Path(prbfile).stem + '_fitted.prb')
+    sst_cfg = SstDeviceConfig.from_prb(prbfile)
+    names = [name for name in config["sensors"] if name in sst_cfg.sensors]
+    if len(names) < len(config["sensors"]):
+        logger.warning('Sensors not in {}: {}'.format(prbfile, set(config["sensors"]) - set(names)))
+    fitter = CalibrationFitter(sst_cfg, names, offset=config["raw_data_device_offset"],
+                               window=config["window"], degrees=config["degrees"])
+    reference_address = RedvyprAddress(config["reference_address"])
+    keys_raw = {name + '_raw': name for name in names}
+    t_publish = time.time()
+
+    def write_prb():
+        coefficients = fitter.write_prb(prbfile_fitted, prbfile)
+        sstr = 'Wrote fitted coefficients of {} from {} pairs to {}'.format(list(coefficients), fitter.npairs, prbfile_fitted)
+        logger.info(sstr)
+        try:
+            statusqueue.put_nowait(sstr)
+        except:
+            pass
+
+    while True:
+        try:
+            data = datainqueue.get(timeout=0.5)
+        except:
+            data = None
+
+        if data is not None:
+            command = check_for_command(data, thread_uuid=device_info['thread_uuid'])
+            if command is not None:
+                logger.debug('Got a command: {:s}'.format(str(data)))
+                if command == 'stop':
+                    if fitter.npairs > 0:
+                        write_prb()
+                    sstr = funcname + ': Command is for me: {:s}'.format(str(command))
+                    logger.debug(sstr)
+                    try:
+                        statusqueue.put_nowait(sstr)
+                    except:
+                        pass
+                    return
+                elif command == 'write_prb':
+                    write_prb()
+                elif command == 'reset':
+                    fitter = CalibrationFitter(sst_cfg, names, offset=config["raw_data_device_offset"],
+                                               window=config["window"], degrees=config["degrees"])
+                continue
+
+            raw = {keys_raw[k]: data[k] for k in keys_raw if k in data}
+            if len(raw) > 0:
+                fitter.add_raw(packet_time(data), raw)
+            reference = reference_address(data, strict=False)
+            if reference is not None and not isinstance(reference, (str, bytes)):
+                valid = True
+                if config["require_stable"]:
+                    valid = data.get('sequence_stable', data.get('temp_steady', 1)) != 0
+                fitter.add_reference(packet_time(data), reference, valid=valid)
+
+        if (time.time() - t_publish) > config["dt_publish"]:
+            t_publish = time.time()
+            data_publish = create_datadict(packetid='sst_calibration')
+            data_publish['npairs'] = fitter.npairs
+            for name, coefficients in fitter.coefficients().items():
+                data_publish[name + '_coeff'] = coefficients
+                rms = fitter.fits[name].rms()
+                if rms is not None:
+                    data_publish[name + '_rms'] = rms
+            dataqueue.put(data_publish)
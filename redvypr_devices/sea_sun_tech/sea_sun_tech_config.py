@@ -1,17 +1,32 @@
-from typing import Literal, Union, Optional, Annotated
+from typing import Literal, Union, Optional, Annotated, ClassVar, get_args, get_origin
 import logging
 import sys
 from typing import cast
 from pathlib import Path
 import configparser
+import hashlib
+import json
+import math
+import os
 import numpy as np
-from pydantic import BaseModel, Field
+import pydantic
+from pydantic import BaseModel, Discriminator, Field, PrivateAttr, Tag
 
-# Setup logging module
-# TODO should handle this more gracefully, having debug level logging everywhere is annoying
+# Setup logging module, the level is inherited from the device logger
 # logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-logger = logging.getLogger("redvypr_devices.sea_sun_tech_definitions")
-logger.setLevel(logging.DEBUG)
+logger = logging.getLogger("redvypr_devices.sea_sun_tech.config")
+
+
+# Version of the format of the prb cache files, increase if parse_prb_string() or the configs change
+prb_cache_version = 3
+
+
+def prb_cache_dir():
+    """
+    Returns the default directory of the cache of the configs of prb files
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return Path(cache_home) / "redvypr_devices" / "sea_sun_tech" / "prb"
 
 
 # Define standard names for sensors
@@ -22,7 +37,10 @@ mss_standard_ctd_sensornames["cond"] = ["COND"]
 
 
 
-def read_prb_file(filename):
+def read_prb_text(filename):
+    """
+    Returns the content of a prb file as a string, trying the common encodings
+    """
     encodings = ['utf-8', 'Windows-1252', 'ISO-8859-1']  # Häufige Kodierungen
     content = None
 
@@ -38,6 +56,52 @@ def read_prb_file(filename):
         raise ValueError(
             f"Konnte die Datei {filename} mit keiner der Kodierungen lesen: {encodings}")
 
+    return content
+
+
+def read_prb_file(filename):
+    return parse_prb_string(read_prb_text(filename))
+
+
+def update_prb_string(content, coefficients):
+    """
+    Replaces the coefficients of sensors in the content of a prb file, all other lines are
+    kept as they are
+
+    Args:
+        content: The content of a prb file
+        coefficients: dict of sensor names and coefficient lists, as in the prb file
+
+    Returns:
+        The updated content
+    """
+    lines = content.splitlines(keepends=True)
+    section = None
+    for i, line in enumerate(lines):
+        linestrip = line.strip()
+        if linestrip.startswith("[") and linestrip.endswith("]"):
+            section = linestrip[1:-1]
+            continue
+        if section != "Sensors" or "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        parts = value.split()
+        if len(parts) < 7 or parts[2] not in coefficients:
+            continue
+        lineend = line[len(line.rstrip("\r\n")):]
+        coeffstr = ["{:.10g}".format(c) for c in coefficients[parts[2]]]
+        lines[i] = key + "=" + " ".join(parts[:4] + coeffstr) + lineend
+    return "".join(lines)
+
+
+def parse_prb_string(content):
+    """
+    Parses the content of a prb file, or the text header of a mrd/srd file in prb format
+
+    Returns:
+        dict with one dict per section, the "Sensors" section is a dict of channel and
+        sensor dict ('sst_channel_map', 'caltype', 'name', 'unit', 'coeff')
+    """
     # ConfigParser-Objekt erstellen
     config = configparser.ConfigParser(
         interpolation=None,
@@ -51,20 +115,16 @@ def read_prb_file(filename):
     # Abschnitte und Schlüssel ausgeben
     config_dict = {}
     for section in config.sections():
-        print(f"[{section}]")
+        logger.debug("[%s]", section)
         config_dict[section] = {}
         for key, value in config[section].items():
-            print(f"{key} = {value}")
+            logger.debug("%s = %s", key, value)
             config_dict[section][key] = value
-        print()
 
-    print("Processing sensors")
+    logger.debug("Processing sensors of sections %s", config.sections())
     config_sensors = {}
 
-    print(config.sections())
-    for key, value in config["Sensors"].items():
-        print(f"{key} = {value}")
-        print("vtmp",value.split())
+    for key, value in config_dict.get("Sensors", {}).items():
         parts = value.split()
         if len(parts) < 7:  # Mindestens 7 Teile erwartet
             continue
@@ -85,7 +145,7 @@ def read_prb_file(filename):
             'coeff': poly
         }
 
-    print("sensors keys",config_sensors.keys())
+    logger.debug("Sensor channels %s", list(config_sensors.keys()))
     config_dict["Sensors"] = config_sensors
     return config_dict
 
@@ -93,12 +153,176 @@ def read_prb_file(filename):
 
 
 
+def _kernel_poly(x, coefficients):
+    """
+    Evaluates one polynomial per column of x with the Horner scheme
+
+    Args:
+        x: (nscans x ncolumns) array
+        coefficients: (ncoefficients x ncolumns) array, lowest order first
+    """
+    data = np.empty_like(x)
+    data[:] = coefficients[-1]
+    for c in coefficients[-2::-1]:
+        data *= x
+        data += c
+    return data
+
+
+def _kernel_ntc(x, coefficients):
+    """
+    Steinhart/Hart polynomial of the logarithm of x, converted from Kelvin to degC. x <= 0 has
+    no logarithm and gives nan, as the scalar kernel.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        data = _kernel_poly(np.log(x), coefficients)
+        data = 1 / data - 273.15
+    data[x <= 0] = np.nan
+    return data
+
+
+# The vectorized kernels used by the CalibrationPlan, referenced by SstSensor.kernel
+calibration_kernels = {"poly": _kernel_poly, "ntc": _kernel_ntc}
+
+
+def _scalar_kernel_poly(input_offset, coefficients):
+    """
+    Returns the polynomial of a single value, see _kernel_poly()
+    """
+    coefficient_last = coefficients[-1]
+    coefficients_reversed = coefficients[-2::-1]
+
+    def calibrate(rawdata):
+        x = rawdata + input_offset
+        data = coefficient_last
+        for c in coefficients_reversed:
+            data = data * x + c
+        return data
+
+    return calibrate
+
+
+def _scalar_kernel_ntc(input_offset, coefficients):
+    """
+    Returns the Steinhart/Hart polynomial of a single value, see _kernel_ntc()
+    """
+    calibrate_poly = _scalar_kernel_poly(0.0, coefficients)
+
+    def calibrate(rawdata):
+        x = rawdata + input_offset
+        if x <= 0:
+            return math.nan
+        data = calibrate_poly(math.log(x))
+        if data == 0:
+            return math.inf
+        return 1 / data - 273.15
+
+    return calibrate
+
+
+# The scalar kernels, functions of (input_offset, coefficients) returning calibrate(rawdata)
+scalar_kernels = {"poly": _scalar_kernel_poly, "ntc": _scalar_kernel_ntc}
+
+
+def compile_scalar_kernel(kernel, input_offset, coefficients):
+    """
+    Returns the calibration of a single value as a python function, a closure over the
+    coefficients. A call costs a few float operations without the overhead of numpy for scalars.
+
+    Args:
+        kernel: The kernel name, see calibration_kernels
+        input_offset: Added to the rawdata before the polynomial is evaluated
+        coefficients: The coefficients, lowest order first
+
+    Returns:
+        function: calibrate(rawdata) -> float
+    """
+    if kernel not in scalar_kernels:
+        # A registered kernel without scalar kernel, evaluated with an array of one value
+        kernel_array = calibration_kernels[kernel]
+        coefficients_array = np.asarray(coefficients, dtype=np.float64)
+
+        def calibrate(rawdata):
+            x = np.asarray([rawdata + input_offset], dtype=np.float64)
+            return float(kernel_array(x, coefficients_array)[0])
+
+        return calibrate
+
+    return scalar_kernels[kernel](float(input_offset), tuple(float(c) for c in coefficients))
+
+
 class SstSensor(BaseModel):
     name: str
     coefficients: list[float]
     channel: int
     unit: str = Field(default="")
     calibration_type: Literal[None]  # ["N", "SHE", "P", "SHH", "NFC", "V04", "N24"]
+    kernel: ClassVar[Optional[str]] = None
+    _compiled: dict = PrivateAttr(default_factory=dict)
+
+    def __getstate__(self):
+        # The compiled functions cannot be pickled, they are compiled again when needed
+        state = super().__getstate__()
+        state["__pydantic_private__"] = {**state["__pydantic_private__"], "_compiled": {}}
+        return state
+
+    def calibration_polynomial(self, offset=0):
+        """
+        Returns the calibration as a polynomial of the rawdata used by the kernel of the sensor
+
+        Returns:
+            tuple: (input_offset, coefficients), the kernel is evaluated for rawdata + input_offset
+            with the coefficients (lowest order first)
+        """
+        raise NotImplementedError(
+            f"Calibration type '{self.calibration_type}' has no calibration polynomial."
+        )
+
+    def compiled_calibration(self, offset=0):
+        """
+        Returns the calibration for offset as (input_offset, coefficients, calibrate_scalar), the
+        coefficients as a tuple of floats for the vectorized kernel and calibrate_scalar a
+        function for single values, see compile_scalar_kernel(). The result is cached per
+        offset together with the coefficients of the sensor, it is compiled again once the
+        coefficients changed.
+        """
+        # Looked up directly, the attribute access of pydantic private attributes is slow
+        cache = self.__pydantic_private__["_compiled"]
+        cached = cache.get(offset)
+        if cached is not None and cached[0] == self.coefficients:
+            return cached[1]
+        input_offset, coefficients = self.calibration_polynomial(offset)
+        coefficients = tuple(float(c) for c in coefficients)
+        calibrate_scalar = compile_scalar_kernel(self.kernel, input_offset, coefficients)
+        compiled = (float(input_offset), coefficients, calibrate_scalar)
+        cache[offset] = (list(self.coefficients), compiled)
+        return compiled
+
+    def raw_to_units(self, rawdata, offset=0):
+        """
+        Converts rawdata to physical units. A single value is calibrated with a compiled python
+        function, arrays with the vectorized kernel. Loops over single values are fastest with
+        the function of compiled_calibration() called directly.
+
+        Args:
+            rawdata: A single value or an array like of rawdata
+            offset: The device offset
+
+        Returns:
+            float or numpy array
+        """
+        cached = self.__pydantic_private__["_compiled"].get(offset)
+        if cached is not None and cached[0] == self.coefficients:
+            input_offset, coefficients, calibrate_scalar = cached[1]
+        else:
+            input_offset, coefficients, calibrate_scalar = self.compiled_calibration(offset)
+        rawdata_type = type(rawdata)
+        if rawdata_type is int or rawdata_type is float:
+            return calibrate_scalar(rawdata)
+        elif isinstance(rawdata, (np.integer, np.floating)):
+            return calibrate_scalar(float(rawdata))
+        x = np.asarray(rawdata, dtype=np.float64) + input_offset
+        return calibration_kernels[self.kernel](x, coefficients)
 
 
 class SstSensorNotImplemented(SstSensor):
@@ -117,14 +341,10 @@ class SstSensorNotImplemented(SstSensor):
 
 class SstSensorPoly(SstSensor):
     calibration_type: Literal["N"] = Field(default="N")
+    kernel: ClassVar[Optional[str]] = "poly"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p = np.polynomial.Polynomial(self.coefficients)
-
-    def raw_to_units(self, rawdata, offset=0):
-        data = self._p(rawdata + offset)
-        return data
+    def calibration_polynomial(self, offset=0):
+        return offset, list(self.coefficients)
 
 
 class SstShearSensor(SstSensor):
@@ -133,31 +353,27 @@ class SstShearSensor(SstSensor):
     reference_temperature: float = Field(default=-9999)
     calibration_date: str = Field(default="")
     calibration_type: Literal["SHE"] = Field(default="SHE")
+    kernel: ClassVar[Optional[str]] = "poly"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.coefficients = [None, None]
         self.coefficients[0] = 1.47133e-6 / self.sensitivity
         self.coefficients[1] = 2.94266e-6 / self.sensitivity
-        self._p = np.polynomial.Polynomial(self.coefficients)
 
-    def raw_to_units(self, rawdata, offset=0):
-        data = self._p(rawdata - offset)  # The shear sensors have the negative offset
-        return data
+    def calibration_polynomial(self, offset=0):
+        return -offset, list(self.coefficients)  # The shear sensors have the negative offset
 
 
 class SstSensorPressure(SstSensor):
     calibration_type: Literal["P"] = Field(default="P")
+    kernel: ClassVar[Optional[str]] = "poly"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p = np.polynomial.Polynomial(self.coefficients[:-1])
-
-    def raw_to_units(self, rawdata, offset=0):
-        #print("Processing pressure sensor")
-        data = self._p(rawdata + offset) - self.coefficients[-1]
-        #print(f"{min(data)},{max(data)},{self._p},{self.coefficients[-1]}")
-        return data
+    def calibration_polynomial(self, offset=0):
+        # The last coefficient is subtracted from the polynomial
+        coefficients = list(self.coefficients[:-1])
+        coefficients[0] -= self.coefficients[-1]
+        return offset, coefficients
 
 
 class SstSensorNTC(SstSensor):
@@ -166,15 +382,11 @@ class SstSensorNTC(SstSensor):
     """
 
     calibration_type: Literal["SHH"] = Field(default="SHH")
+    kernel: ClassVar[Optional[str]] = "ntc"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p = np.polynomial.Polynomial(self.coefficients[:-1])
-
-    def raw_to_units(self, rawdata, offset):
-        data = self._p(np.log(rawdata + offset))
-        data = 1 / data - 273.15  # Kelvin to degC
-        return data
+    def calibration_polynomial(self, offset=0):
+        # Polynomial of log(rawdata), the kernel converts the inverse from Kelvin to degC
+        return offset, list(self.coefficients[:-1])
 
 
 class SstSensorTurb(SstSensor):
@@ -183,15 +395,13 @@ class SstSensorTurb(SstSensor):
     """
 
     calibration_type: Literal["NFC"] = Field(default="NFC")
+    kernel: ClassVar[Optional[str]] = "poly"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p = np.polynomial.Polynomial(self.coefficients[:-1])
-
-    def raw_to_units(self, rawdata, offset):
-        p = np.polynomial.Polynomial(self.coefficients[:-2])
-        data = p(rawdata + offset) * self.coefficients[-1] + self.coefficients[-2]
-        return data
+    def calibration_polynomial(self, offset=0):
+        # Scaling and offset are folded into the polynomial
+        coefficients = [c * self.coefficients[-1] for c in self.coefficients[:-2]]
+        coefficients[0] += self.coefficients[-2]
+        return offset, coefficients
 
 
 class SstSensorOptode(SstSensor):
@@ -200,33 +410,280 @@ class SstSensorOptode(SstSensor):
     """
 
     calibration_type: Literal["V04"] = Field(default="V04")
+    kernel: ClassVar[Optional[str]] = "poly"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p1 = np.polynomial.Polynomial(
-            self.coefficients[0:2]
-        )  # Convert data to mV
-        self._p2 = np.polynomial.Polynomial(
-            self.coefficients[-2:]
-        )  # 0 Point correction with B0 and B1
-
-    def raw_to_units(self, rawdata, offset):
-        data_mV = self._p1(rawdata + offset)
-        data = self._p2(data_mV)
-        return data
+    def calibration_polynomial(self, offset=0):
+        # The first two coefficients convert the data to mV, the last two (B0 and B1) are the
+        # zero point correction. Both polynomials are linear, the composition is linear as well
+        a0, a1 = self.coefficients[0:2]
+        b0, b1 = self.coefficients[-2:]
+        return offset, [b0 + b1 * a0, b1 * a1]
 
 
 class SstSensorOptodeInternalTemp(SstSensor):
     calibration_type: Literal["N24"] = Field(default="N24")
+    kernel: ClassVar[Optional[str]] = "poly"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._p = np.polynomial.Polynomial(self.coefficients)
+    def calibration_polynomial(self, offset=0):
+        return offset, list(self.coefficients)
 
-    def raw_to_units(self, rawdata, offset=0):
-        data = self._p(rawdata + offset)
+
+def register_kernel(name, kernel, scalar_kernel=None):
+    """
+    Registers a vectorized calibration kernel, sensor classes refer to it by name with their
+    kernel class variable.
+
+    Args:
+        name: The kernel name
+        kernel: function(x, coefficients), x is an (nscans x ncolumns) or 1D array and
+            coefficients an (ncoefficients x ncolumns) array or sequence, lowest order first
+        scalar_kernel: Optional function(input_offset, coefficients) returning a function
+            calibrate(rawdata) for single values, as in scalar_kernels. Without, single values
+            are evaluated with kernel.
+    """
+    calibration_kernels[name] = kernel
+    if scalar_kernel is not None:
+        scalar_kernels[name] = scalar_kernel
+
+
+# The sensor classes of the calibration types of the prb and mrd files
+sensor_registry = {}
+
+
+def register_caltype(caltype, sensor_class):
+    """
+    Registers a sensor class for a calibration type code of the prb and mrd files, e.g. to add
+    a calibration type at runtime. The kernel of the sensor class has to be registered with
+    register_kernel(). The calibration_type field of the sensor class has to be a Literal
+    including caltype, the sensors of SstDeviceConfig and its subclasses are rebuilt to
+    validate and store the sensor class.
+
+    Args:
+        caltype: The calibration type code, e.g. "SHH"
+        sensor_class: Subclass of SstSensor
+    """
+    if sensor_class.kernel is not None and sensor_class.kernel not in calibration_kernels:
+        raise ValueError("Kernel {} of {} is not registered".format(sensor_class.kernel,
+                                                                  sensor_class.__name__))
+    annotation = sensor_class.model_fields["calibration_type"].annotation
+    if get_origin(annotation) is not Literal or caltype.upper() not in get_args(annotation):
+        raise ValueError('calibration_type of {} has to be Literal["{}"]'.format(sensor_class.__name__,
+                                                                               caltype.upper()))
+    sensor_registry[caltype.upper()] = sensor_class
+    # The device configs are defined below, they are rebuilt for caltypes registered later on
+    if "SstDeviceConfig" in globals():
+        rebuild_device_configs()
+
+
+def _sensor_tag(sensor_class):
+    return "{}.{}".format(sensor_class.__module__, sensor_class.__qualname__)
+
+
+def _sensor_discriminator(sensor):
+    """
+    Returns the tag of the sensor class of a sensor or a sensor dict, the class registered for
+    its calibration_type or SstSensorNotImplemented for an unknown calibration_type
+    """
+    if isinstance(sensor, dict):
+        caltype = sensor.get("calibration_type")
+    else:
+        caltype = getattr(sensor, "calibration_type", None)
+    if caltype is None:
+        return _sensor_tag(SstSensor)
+    return _sensor_tag(sensor_registry.get(str(caltype).upper(), SstSensorNotImplemented))
+
+
+def sensors_field_type():
+    """
+    Returns the type of the sensors of SstDeviceConfig, a union of SstSensor,
+    SstSensorNotImplemented and the registered sensor classes discriminated by their
+    calibration_type
+    """
+    sensor_classes = dict.fromkeys([SstSensor, SstSensorNotImplemented] + list(sensor_registry.values()))
+    sensor_types = tuple(Annotated[sensor_class, Tag(_sensor_tag(sensor_class))] for sensor_class in sensor_classes)
+    return dict[str, Annotated[Union[sensor_types], Discriminator(_sensor_discriminator)]]
+
+
+def rebuild_device_configs(config_class=None):
+    """
+    Rebuilds SstDeviceConfig and its subclasses with the sensor classes of the registry, see
+    register_caltype()
+    """
+    if config_class is None:
+        config_class = SstDeviceConfig
+    config_class.model_fields["sensors"].annotation = sensors_field_type()
+    config_class.model_rebuild(force=True)
+    for subclass in config_class.__subclasses__():
+        rebuild_device_configs(subclass)
+
+
+register_caltype("N", SstSensorPoly)
+register_caltype("SHE", SstShearSensor)  # "N" sensors with a name starting with SHE
+register_caltype("P", SstSensorPressure)
+register_caltype("SHH", SstSensorNTC)
+register_caltype("NFC", SstSensorTurb)
+register_caltype("V04", SstSensorOptode)
+register_caltype("N24", SstSensorOptodeInternalTemp)
+
+
+def create_sensor(channel, sensor_dict, shear_sensitivities=None):
+    """
+    Creates the sensor of a channel with the class registered for its calibration type, see
+    register_caltype(). Unknown calibration types give a SstSensorNotImplemented.
+
+    Args:
+        channel: The channel number
+        sensor_dict: dict with "name", "unit", "caltype" and "coeff", as in the
+            "Sensors" section of read_prb_file()
+        shear_sensitivities: dict of the sensitivities of the shear sensors, if None the
+            sensitivities are NaN
+
+    Returns:
+        SstSensor
+    """
+    sensorname = sensor_dict["name"]
+    caltype = sensor_dict["caltype"].upper()
+    logger.debug(
+        "Checking Channel:{}, sensorname:{}, caltype:{}".format(
+            channel, sensorname, caltype
+        )
+    )
+    if caltype == "N" and sensorname.upper().startswith("SHE"):
+        caltype = "SHE"
+    kwargs = {"channel": channel,
+              "name": sensorname,
+              "coefficients": sensor_dict["coeff"],
+              "unit": sensor_dict["unit"]}
+    try:
+        sensor_class = sensor_registry[caltype]
+    except KeyError:
+        logger.debug(f"\tsensor {sensorname} not implemented")
+        return SstSensorNotImplemented(calibration_type=caltype, **kwargs)
+
+    if caltype == "SHE":
+        if shear_sensitivities is None:
+            kwargs["sensitivity"] = np.nan
+        else:
+            kwargs["sensitivity"] = shear_sensitivities[sensorname]
+    logger.debug("\tAdding {} sensor {}".format(sensor_class.__name__, sensorname))
+    return sensor_class(**kwargs)
+
+
+class CalibrationPlan:
+    """
+    Calibrates complete scans of rawdata in one vectorized pass. The calibration of every
+    sensor is expressed as a polynomial of the rawdata (see SstSensor.calibration_polynomial()),
+    the sensors are grouped by kernel and each group is evaluated with one Horner scheme over
+    all of its columns.
+    """
+
+    def __init__(self, sensors, channel_sequence, offset=0):
+        """
+        Args:
+            sensors: dict of SstSensor objects, as in SstDeviceConfig.sensors
+            channel_sequence: The channels of the columns of the rawdata
+            offset: The device offset of the rawdata
+        """
+        channel_sequence = list(channel_sequence)
+        self.names = []
+        iraw = []
+        groups = {}
+        for sensor in sensors.values():
+            if sensor.kernel is None or sensor.channel not in channel_sequence:
+                continue
+            input_offset, coefficients = sensor.calibration_polynomial(offset)
+            group = groups.setdefault(sensor.kernel, {"icolumn": [], "iraw": [],
+                                                      "input_offset": [], "coefficients": []})
+            group["icolumn"].append(len(self.names))
+            group["iraw"].append(channel_sequence.index(sensor.channel))
+            group["input_offset"].append(input_offset)
+            group["coefficients"].append(coefficients)
+            self.names.append(sensor.name)
+            iraw.append(channel_sequence.index(sensor.channel))
+
+        # The rawdata column of each name
+        self.iraw = np.asarray(iraw, dtype=np.intp)
+
+        self.groups = []
+        for kernel, group in groups.items():
+            ncoefficients = max(len(c) for c in group["coefficients"])
+            coefficients = np.zeros((ncoefficients, len(group["coefficients"])))
+            for i, c in enumerate(group["coefficients"]):
+                coefficients[:len(c), i] = c
+            self.groups.append((calibration_kernels[kernel],
+                                np.asarray(group["icolumn"]),
+                                np.asarray(group["iraw"]),
+                                np.asarray(group["input_offset"], dtype=np.float64),
+                                coefficients))
+
+    def calibrate(self, rawdata):
+        """
+        Calibrates rawdata
+
+        Args:
+            rawdata: (nscans x nchannels) array, one column per channel of channel_sequence
+
+        Returns:
+            (nscans x nsensors) array, the order of the columns is given by self.names
+        """
+        rawdata = np.asarray(rawdata)
+        data = np.empty((len(rawdata), len(self.names)))
+        for kernel, icolumn, iraw, input_offset, coefficients in self.groups:
+            x = rawdata[:, iraw] + input_offset
+            data[:, icolumn] = kernel(x, coefficients)
         return data
 
+    def __call__(self, rawdata):
+        """
+        Calibrates rawdata and returns a dictionary with one array per sensor name
+        """
+        data = self.calibrate(rawdata)
+        return {name: data[:, i] for i, name in enumerate(self.names)}
+
+
+class LookupTablePlan(CalibrationPlan):
+    """
+    Calibrates complete scans with one lookup table per sensor. The HHL rawdata are 16 bit
+    unsigned integers, the calibrated value of each of the 65536 possible values is precomputed
+    (see SstDeviceConfig.lookup_tables()) and the calibration is a single gather. The rawdata
+    must be within 0 and 65535, as decoded from the HHL stream.
+    """
+
+    def __init__(self, sensors, channel_sequence, tables):
+        """
+        Args:
+            sensors: dict of SstSensor objects, as in SstDeviceConfig.sensors
+            channel_sequence: The channels of the columns of the rawdata
+            tables: dict of sensor names and lookup tables with 65536 entries
+        """
+        channel_sequence = list(channel_sequence)
+        self.names = []
+        iraw = []
+        for sensor in sensors.values():
+            if sensor.name not in tables or sensor.channel not in channel_sequence:
+                continue
+            self.names.append(sensor.name)
+            iraw.append(channel_sequence.index(sensor.channel))
+        self.iraw = np.asarray(iraw, dtype=np.intp)
+        # The tables one after the other, the rawdata of a sensor is shifted by its table start
+        self.table_start = np.arange(len(self.names), dtype=np.intp) * 2 ** 16
+        self.tables = np.concatenate([tables[name] for name in self.names]) if len(self.names) > 0 \
+            else np.empty(0)
+
+    def calibrate(self, rawdata):
+        """
+        Calibrates rawdata
+
+        Args:
+            rawdata: (nscans x nchannels) integer array, one column per channel of channel_sequence
+
+        Returns:
+            (nscans x nsensors) array with the dtype of the tables, the order of the columns is
+            given by self.names
+        """
+        rawdata = np.asarray(rawdata)
+        return np.take(self.tables, rawdata[:, self.iraw] + self.table_start)
+
 
 
 class SstDeviceConfig(BaseModel):
@@ -254,22 +711,7 @@ class SstDeviceConfig(BaseModel):
         default=-999.0,
         description="The sampling frequency [Hz] of the device",
     )
-    sensors: dict[
-        str,
-        Annotated[
-            Union[
-                SstSensor,
-                SstSensorPoly,
-                SstShearSensor,
-                SstSensorPressure,
-                SstSensorNTC,
-                SstSensorTurb,
-                SstSensorOptode,
-                SstSensorOptodeInternalTemp,
-            ],
-            Field(discriminator="calibration_type"),
-        ],
-    ] = Field(
+    sensors: sensors_field_type() = Field(
         default={}, description="A dictionary of the sensors mounted to the probe"
     )
     sensornames_ctd: dict[
@@ -283,6 +725,17 @@ class SstDeviceConfig(BaseModel):
         default=None,
         description="The sensorname of the pressure sensor, if None a best guess will be made",
     )
+    calibration_lut: Optional[Literal["float32", "float64"]] = Field(
+        default=None,
+        description="Calibrate with precomputed lookup tables of this dtype, None for the analytic calibration",
+    )
+    _lookup_tables: dict = PrivateAttr(default_factory=dict)
+
+    def __getstate__(self):
+        # The lookup tables are not pickled, they are computed again when needed
+        state = super().__getstate__()
+        state["__pydantic_private__"] = {**state["__pydantic_private__"], "_lookup_tables": {}}
+        return state
 
     def init_sensors_from_dict(
             self,
@@ -291,122 +744,170 @@ class SstDeviceConfig(BaseModel):
     ):
         # Fill in sensors from header
         for ch,sensor_dict in sensors.items():
-            #print("ch",ch,sensor_dict,type(sensor_dict))
-            sensorname = sensor_dict["name"]
-            unit = sensor_dict["unit"]
-            caltype = sensor_dict["caltype"].upper()
-            logger.debug(
-                "Checking Channel:{}, sensorname:{}, caltype:{}".format(
-                    ch, sensorname, caltype
-                )
-            )
-            if caltype == "N":  # Polynom
-                if sensorname.upper().startswith("SHE"):
-                    logger.debug("\tAdding shear sensor {}".format(sensorname))
-                    if shear_sensitivities is None:
-                        sensitivity = np.nan
-                    else:
-                        sensitivity = shear_sensitivities[sensorname]
-                    self.sensors[sensorname] = SstShearSensor(
-                        channel=ch,
-                        name=sensorname,
-                        coefficients=sensor_dict["coeff"],
-                        unit=unit,
-                        sensitivity=sensitivity,
-                    )
-                else:
-                    logger.debug(
-                        "\tAdding standard polynomial sensor {}".format(sensorname)
-                    )
-                    self.sensors[sensorname] = SstSensorPoly(
-                        channel=ch,
-                        name=sensorname,
-                        coefficients=sensor_dict["coeff"],
-                        unit=unit,
-                    )
-            elif caltype == "SHH":
-                logger.debug("\tAdding NTC sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorNTC(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "P":  # Pressure
-                logger.debug("\tAdding pressure sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorPressure(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "V04":  # Oxygen
-                logger.debug("\tAdding oxygen optode sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorOptode(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "N24":  # Internal temperature of oxygensensor
-                logger.debug(
-                    "\tAdding oxygen optode temperature sensor {}".format(sensorname)
-                )
-                self.sensors[sensorname] = SstSensorOptodeInternalTemp(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "NFC":  # Turbidity etc.
-                logger.debug("\tAdding NFC sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorTurb(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-
-            else:
-                logger.debug(f"\tsensor {sensorname} not implemented")
-                self.sensors[sensorname] = SstSensorNotImplemented(
-                    calibration_type=sensorname,
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
+            self.sensors[sensor_dict["name"]] = create_sensor(ch, sensor_dict,
+                                                              shear_sensitivities=shear_sensitivities)
 
     @classmethod
     def from_srd_mrd(
         cls,
         filename: str | Path,
-        shear_sensitivities: dict[str, float],
+        shear_sensitivities: dict[str, float] = None,
         offset: int = 0,
     ):
         """
-        Creating a MssDeviceConfig from a mrd file
+        Creating a SstDeviceConfig from the header of a srd or mrd file, see sea_sun_tech_mrd
         """
-        raise NotImplementedError
+        from . import sea_sun_tech_mrd
+        with open(filename, "rb") as mrd_file:
+            data = sea_sun_tech_mrd.read_mrd(filestream=mrd_file, header_only=True)
+        config = parse_prb_string(data["header"])
+        return cls.from_prb_dict(config, offset=offset, shear_sensitivities=shear_sensitivities)
 
     @classmethod
-    def from_prb(cls, filename, offset=0, shear_sensitivities = None):
+    def from_prb_dict(cls, config, offset=0, shear_sensitivities=None):
         """
-        Creating a SstDeviceConfig from a prb file
+        Creating a SstDeviceConfig from a parsed prb file, see parse_prb_string()
         """
-        config = read_prb_file(filename=filename)
         self = cls()
-        self.init_sensors_from_dict(config["Sensors"], shear_sensitivities = shear_sensitivities)
-        self.model_type = config["Probe"]["Typ"]
-        self.sn = config["Probe"]["SerialNumber"]
-        self.name = config["Probe"]["Name"]
-        self.dataformat = config["Baud"]["DataFormat"]
-        self.baudstr = config["Baud"]["COM"]
+        self.offset = offset
+        self.init_sensors_from_dict(config.get("Sensors", {}), shear_sensitivities = shear_sensitivities)
+        self.model_type = config.get("Probe", {}).get("Typ", "")
+        self.sn = config.get("Probe", {}).get("SerialNumber", "")
+        self.name = config.get("Probe", {}).get("Name", "")
+        self.dataformat = config.get("Baud", {}).get("DataFormat", "")
+        self.baudstr = config.get("Baud", {}).get("COM", "")
+        return self
+
+    @classmethod
+    def from_prb(cls, filename, offset=0, shear_sensitivities = None, cache=False):
+        """
+        Creating a SstDeviceConfig from a prb file
 
+        Args:
+            filename: The prb file
+            offset: The device offset
+            shear_sensitivities: dict of the sensitivities of the shear sensors
+            cache: Use an on-disk cache of the validated configs, True for the default
+                directory (prb_cache_dir()) or the cache directory. The config is stored as
+                JSON of its model_dump(), keyed by the hash of the file content, a changed file
+                is parsed again. The offset and the shear sensitivities are applied after the
+                config is loaded.
+        """
+        if not cache:
+            return cls.from_prb_dict(read_prb_file(filename=filename), offset=offset,
+                                     shear_sensitivities=shear_sensitivities)
+
+        cache_dir = prb_cache_dir() if cache is True else Path(cache)
+        with open(filename, "rb") as f:
+            content = f.read()
+        key = hashlib.sha256(content)
+        # The cached config depends on the class and the sensor classes of the calibration types
+        sensor_tags = {caltype: _sensor_tag(sensor_class) for caltype, sensor_class in sensor_registry.items()}
+        key.update(json.dumps([prb_cache_version, _sensor_tag(cls), sensor_tags], sort_keys=True).encode())
+        cache_file = cache_dir / (key.hexdigest() + ".json")
+        self = None
+        try:
+            with open(cache_file, "r", encoding="utf-8") as f:
+                self = cls.model_validate(json.load(f))
+            logger.debug("Loaded validated %s from cache %s", filename, cache_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning("Could not read the prb cache file %s: %s", cache_file, e)
+
+        if self is None:
+            self = cls.from_prb_dict(read_prb_file(filename=filename))
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                # Written to a temporary file first, a concurrent reader never sees a partial file
+                cache_file_tmp = cache_file.with_suffix(".tmp{}".format(os.getpid()))
+                with open(cache_file_tmp, "w", encoding="utf-8") as f:
+                    json.dump(self.model_dump(), f)
+                os.replace(cache_file_tmp, cache_file)
+            except OSError as e:
+                logger.warning("Could not write the prb cache file %s: %s", cache_file, e)
 
+        self.offset = offset
+        # The coefficients of the shear sensors are computed from their sensitivities
+        for name, sensor in self.sensors.items():
+            if isinstance(sensor, SstShearSensor):
+                sensitivity = np.nan if shear_sensitivities is None else shear_sensitivities[name]
+                self.sensors[name] = type(sensor)(**{**sensor.model_dump(), "sensitivity": sensitivity})
 
         return self
 
+    def calibration_plan(self, channel_sequence, offset=None):
+        """
+        Compiles the sensors into a CalibrationPlan for scans of channel_sequence
+
+        Args:
+            channel_sequence: The channels of the scans
+            offset: The device offset, if None self.offset is used
+        """
+        if offset is None:
+            offset = self.offset
+        if self.calibration_lut is not None:
+            tables = self.lookup_tables(offset, dtype=self.calibration_lut)
+            return LookupTablePlan(self.sensors, channel_sequence, tables)
+        return CalibrationPlan(self.sensors, channel_sequence, offset=offset)
+
+    def lookup_tables(self, offset=None, dtype="float64"):
+        """
+        Returns the lookup tables of all sensors with a calibration, the table of a sensor holds
+        the calibrated values of the rawdata 0 to 65535 with offset applied. The tables are
+        computed once per offset and dtype.
+
+        Args:
+            offset: The device offset, if None self.offset is used
+            dtype: "float32" or "float64"
+
+        Returns:
+            dict of sensor names and numpy arrays with 65536 entries
+        """
+        if offset is None:
+            offset = self.offset
+        try:
+            return self._lookup_tables[(offset, dtype)]
+        except KeyError:
+            pass
+        rawdata = np.arange(2 ** 16)
+        tables = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for sensor in self.sensors.values():
+                if sensor.kernel is None:
+                    continue
+                tables[sensor.name] = sensor.raw_to_units(rawdata, offset=offset).astype(dtype)
+        self._lookup_tables[(offset, dtype)] = tables
+        return tables
+
+    def verify_lookup_tables(self, offset=None, dtype="float64"):
+        """
+        Compares the lookup tables with the analytic calibration for all 65536 rawdata values
+
+        Returns:
+            dict of sensor names and the maximum relative deviation, values that are not finite
+            in the analytic calibration have to be identical in the table
+        """
+        if offset is None:
+            offset = self.offset
+        tables = self.lookup_tables(offset, dtype=dtype)
+        rawdata = np.arange(2 ** 16)
+        deviations = {}
+        with np.errstate(invalid="ignore", divide="ignore"):
+            for name, table in tables.items():
+                data = self.sensors[name].raw_to_units(rawdata, offset=offset)
+                finite = np.isfinite(data)
+                if not np.array_equal(table[~finite], data[~finite].astype(dtype), equal_nan=True):
+                    deviations[name] = np.inf
+                    continue
+                if not np.any(finite):
+                    deviations[name] = 0.0
+                    continue
+                # Relative to the range of the sensor, to be robust around zero
+                scale = max(np.max(np.abs(data[finite])), np.finfo(np.float64).tiny)
+                deviations[name] = float(np.max(np.abs(table[finite] - data[finite])) / scale)
+        return deviations
+
 
 
 
@@ -438,6 +939,7 @@ class MssDeviceConfig(SstDeviceConfig):
         """
         Creating a MssDeviceConfig from a mrd file
         """
+        from . import sea_sun_tech_mrd as mss_mrd
         self = cls()
         self.offset = offset
         logger.debug("Opening file:{}".format(filename))
@@ -475,79 +977,8 @@ class MssDeviceConfig(SstDeviceConfig):
                         break
 
         # Fill in sensors from header
-        for ch in header["mss"]["channels"]:
-            sensor_dict = header["mss"]["channels"][ch]
-            sensorname = sensor_dict["name"]
-            unit = sensor_dict["unit"]
-            caltype = sensor_dict["caltype"].upper()
-            logger.debug(
-                "Checking Channel:{}, sensorname:{}, caltype:{}".format(
-                    ch, sensorname, caltype
-                )
-            )
-            if caltype == "N":  # Polynom
-                if sensorname.upper().startswith("SHE"):
-                    logger.debug("\tAdding shear sensor {}".format(sensorname))
-                    sensitivity = shear_sensitivities[sensorname]
-                    self.sensors[sensorname] = SstShearSensor(
-                        channel=ch,
-                        name=sensorname,
-                        coefficients=sensor_dict["coeff"],
-                        unit=unit,
-                        sensitivity=sensitivity,
-                    )
-                else:
-                    logger.debug(
-                        "\tAdding standard polynomial sensor {}".format(sensorname)
-                    )
-                    self.sensors[sensorname] = SstSensorPoly(
-                        channel=ch,
-                        name=sensorname,
-                        coefficients=sensor_dict["coeff"],
-                        unit=unit,
-                    )
-            elif caltype == "SHH":
-                logger.debug("\tAdding NTC sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorNTC(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "P":  # Pressure
-                logger.debug("\tAdding pressure sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorPressure(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "V04":  # Oxygen
-                logger.debug("\tAdding oxygen optode sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorOptode(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "N24":  # Internal temperature of oxygensensor
-                logger.debug(
-                    "\tAdding oxygen optode temperature sensor {}".format(sensorname)
-                )
-                self.sensors[sensorname] = SstSensorOptodeInternalTemp(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
-            elif caltype == "NFC":  # Turbidity etc.
-                logger.debug("\tAdding NFC sensor {}".format(sensorname))
-                self.sensors[sensorname] = SstSensorTurb(
-                    channel=ch,
-                    name=sensorname,
-                    coefficients=sensor_dict["coeff"],
-                    unit=unit,
-                )
+        self.init_sensors_from_dict(header["mss"]["channels"],
+                                    shear_sensitivities=shear_sensitivities)
         # print('Header', header['channels'])
 
         return self
@@ -0,0 +1,372 @@
+"""
+Streaming least squares fits of sensor calibrations against a reference temperature, e.g. of a
+Leitenberger calibration bath.
+
+The raw sensor counts and the reference are averaged in common time windows, each window with
+data of both gives one pair. The pairs are added to running normal equations (A^T A and A^T y),
+the memory and the time to solve are independent of the number of pairs. The fits are
+polynomials of the rawdata (SstSensorPoly) and Steinhart/Hart polynomials of the logarithm of
+the rawdata (SstSensorNTC), the fitted coefficients can be written into a prb file.
+"""
+import logging
+import numpy as np
+from numpy.polynomial import polynomial as P
+from .sea_sun_tech_config import SstSensorPoly, SstSensorNTC, read_prb_text, update_prb_string
+
+logger = logging.getLogger("redvypr_devices.sea_sun_tech.fit")
+
+
+class RunningNormalEquations:
+    """
+    Normal equations of a linear least squares problem, updated with blocks of rows
+    """
+
+    def __init__(self, ncoefficients):
+        self.ncoefficients = ncoefficients
+        self.reset()
+
+    def reset(self):
+        self.ata = np.zeros((self.ncoefficients, self.ncoefficients))
+        self.aty = np.zeros(self.ncoefficients)
+        self.yty = 0.0
+        self.n = 0
+
+    def add(self, a, y):
+        """
+        Adds rows
+
+        Args:
+            a: (nrows x ncoefficients) array, the basis functions evaluated at the rows
+            y: (nrows) array, the target values
+        """
+        a = np.atleast_2d(np.asarray(a, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        self.ata += a.T @ a
+        self.aty += a.T @ y
+        self.yty += float(y @ y)
+        self.n += len(y)
+
+    def solve(self):
+        """
+        Returns the least squares coefficients, None if there are fewer rows than coefficients
+        """
+        if self.n < self.ncoefficients:
+            return None
+        coefficients, _, _, _ = np.linalg.lstsq(self.ata, self.aty, rcond=None)
+        return coefficients
+
+    def rms(self, coefficients):
+        """
+        Returns the root mean square of the residuals of coefficients
+        """
+        if self.n == 0 or coefficients is None:
+            return None
+        rss = self.yty - 2 * coefficients @ self.aty + coefficients @ self.ata @ coefficients
+        return float(np.sqrt(max(rss, 0.0) / self.n))
+
+
+class StreamingPolynomialFit:
+    """
+    Polynomial y = sum(c_k * x**k) fitted with running normal equations. Internally the
+    polynomial is fitted in u = (x - center)/scale to keep the normal equations well
+    conditioned, coefficients() returns the coefficients in x, lowest order first.
+    """
+
+    def __init__(self, degree=2, center=0.0, scale=1.0):
+        self.degree = degree
+        self.center = center
+        self.scale = scale
+        self.equations = RunningNormalEquations(degree + 1)
+
+    def transform_x(self, x):
+        return x
+
+    def transform_y(self, y):
+        return y
+
+    def inverse_y(self, y):
+        return y
+
+    def add(self, x, y):
+        """
+        Adds pairs of the independent variable x (the rawdata) and the target y
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        u = (self.transform_x(x) - self.center) / self.scale
+        self.equations.add(P.polyvander(u, self.degree), self.transform_y(y))
+
+    @property
+    def n(self):
+        return self.equations.n
+
+    def coefficients_scaled(self):
+        return self.equations.solve()
+
+    def coefficients(self):
+        """
+        Returns the coefficients of the polynomial in transform_x(x), lowest order first, None
+        if there are not enough pairs
+        """
+        coefficients = self.coefficients_scaled()
+        if coefficients is None:
+            return None
+        poly = np.polynomial.Polynomial(coefficients,
+                                        domain=[self.center - self.scale, self.center + self.scale])
+        coefficients = np.zeros(self.degree + 1)
+        coefficients_converted = poly.convert().coef
+        coefficients[:len(coefficients_converted)] = coefficients_converted
+        return coefficients
+
+    def predict(self, x):
+        coefficients = self.coefficients_scaled()
+        u = (self.transform_x(np.asarray(x, dtype=np.float64)) - self.center) / self.scale
+        return self.inverse_y(P.polyval(u, coefficients))
+
+    def rms(self):
+        """
+        Root mean square of the residuals, in the units of transform_y(y)
+        """
+        return self.equations.rms(self.coefficients_scaled())
+
+
+class StreamingSteinhartHartFit(StreamingPolynomialFit):
+    """
+    Steinhart/Hart fit of a NTC, 1/(T + 273.15) = sum(c_k * log(x)**k) with T in degC. The rms
+    is in 1/K.
+    """
+
+    def __init__(self, degree=3, center=np.log(2 ** 15), scale=2.0):
+        super().__init__(degree=degree, center=center, scale=scale)
+
+    def transform_x(self, x):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.log(x)
+
+    def transform_y(self, y):
+        return 1 / (y + 273.15)
+
+    def inverse_y(self, y):
+        return 1 / y - 273.15
+
+    def add(self, x, y):
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        valid = x > 0
+        if not np.all(valid):
+            logger.warning("Ignoring %d pairs with rawdata <= 0", np.count_nonzero(~valid))
+        super().add(x[valid], y[valid])
+
+
+class TimeWindowPairer:
+    """
+    Averages the reference and the raw data of several sensors in windows of window seconds
+    starting at multiples of window. A window is complete when both the reference and the raw
+    data passed its end, a complete window with data of both gives a pair.
+    """
+
+    def __init__(self, window, names):
+        self.window = window
+        self.names = list(names)
+        self.windows = {}
+        self.iwindow_reference = None
+        self.iwindow_raw = None
+        self.ndiscarded = 0
+
+    def _window(self, iwindow):
+        try:
+            return self.windows[iwindow]
+        except KeyError:
+            w = {"reference": [0.0, 0, True], "raw": {name: [0.0, 0] for name in self.names}}
+            self.windows[iwindow] = w
+            return w
+
+    def _binned(self, t, values):
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim == 0:
+            values = np.full(len(t), float(values))
+        iwindow = np.floor(t / self.window).astype(np.int64)
+        iunique, inverse = np.unique(iwindow, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(iunique))
+        counts = np.bincount(inverse, minlength=len(iunique))
+        return iunique, sums, counts
+
+    def add_reference(self, t, value, valid=True):
+        """
+        Adds reference values, windows with an invalid reference value are not used
+        """
+        iunique, sums, counts = self._binned(t, value)
+        for i, s, n in zip(iunique.tolist(), sums.tolist(), counts.tolist()):
+            ref = self._window(i)["reference"]
+            ref[0] += s
+            ref[1] += n
+            ref[2] = ref[2] and bool(valid)
+        if self.iwindow_reference is None or iunique[-1] > self.iwindow_reference:
+            self.iwindow_reference = int(iunique[-1])
+
+    def add_raw(self, t, data):
+        """
+        Adds raw data
+
+        Args:
+            t: Time or array of times of the samples
+            data: dict of sensor names and values (arrays with one value per time)
+        """
+        iwindow_max = None
+        for name in self.names:
+            if name not in data:
+                continue
+            iunique, sums, counts = self._binned(t, data[name])
+            for i, s, n in zip(iunique.tolist(), sums.tolist(), counts.tolist()):
+                raw = self._window(i)["raw"][name]
+                raw[0] += s
+                raw[1] += n
+            if iwindow_max is None or iunique[-1] > iwindow_max:
+                iwindow_max = int(iunique[-1])
+        if iwindow_max is not None and (self.iwindow_raw is None or iwindow_max > self.iwindow_raw):
+            self.iwindow_raw = iwindow_max
+
+    def pop_pairs(self):
+        """
+        Returns the pairs of the complete windows
+
+        Returns:
+            list of (window start time, reference mean, dict of sensor names and raw means)
+        """
+        if self.iwindow_reference is None or self.iwindow_raw is None:
+            return []
+        iwindow_complete = min(self.iwindow_reference, self.iwindow_raw)
+        pairs = []
+        for iwindow in sorted(i for i in self.windows if i < iwindow_complete):
+            w = self.windows.pop(iwindow)
+            ref_sum, ref_n, ref_valid = w["reference"]
+            raw = {name: s / n for name, (s, n) in w["raw"].items() if n > 0}
+            if ref_n == 0 or not ref_valid or len(raw) == 0:
+                self.ndiscarded += 1
+                continue
+            pairs.append((iwindow * self.window, ref_sum / ref_n, raw))
+        return pairs
+
+
+def create_fit(sensor, offset=0, degree=None):
+    """
+    Returns the streaming fit for a sensor, the fit is done in rawdata + input offset
+
+    Args:
+        sensor: SstSensorPoly or SstSensorNTC
+        offset: The device offset
+        degree: The degree of the polynomial, None for the degree of the current calibration
+    """
+    input_offset, coefficients = sensor.calibration_polynomial(offset)
+    if degree is None:
+        coefficients = list(coefficients)
+        while len(coefficients) > 2 and coefficients[-1] == 0:
+            coefficients.pop()
+        degree = len(coefficients) - 1
+    if isinstance(sensor, SstSensorNTC):
+        return StreamingSteinhartHartFit(degree=degree)
+    elif isinstance(sensor, SstSensorPoly):
+        return StreamingPolynomialFit(degree=degree, center=2 ** 15 + input_offset, scale=2 ** 15)
+    raise ValueError("No fit for the calibration type {} of {}".format(sensor.calibration_type,
+                                                                         sensor.name))
+
+
+def fitted_sensor_coefficients(sensor, coefficients):
+    """
+    Returns the coefficient list of the sensor, as in the prb file, for the fitted coefficients
+    """
+    coefficients = [float(c) for c in coefficients]
+    if isinstance(sensor, SstSensorNTC):
+        # The last coefficient of the prb file is not part of the Steinhart/Hart polynomial
+        nfit = max(len(sensor.coefficients) - 1, len(coefficients))
+        return coefficients + [0.0] * (nfit - len(coefficients)) + [sensor.coefficients[-1]]
+    nfit = max(len(sensor.coefficients), len(coefficients))
+    return coefficients + [0.0] * (nfit - len(coefficients))
+
+
+class CalibrationFitter:
+    """
+    Fits the calibrations of sensors of a probe against a reference temperature.
+
+    Args:
+        config: The SstDeviceConfig of the probe
+        names: The names of the sensors to calibrate
+        offset: The device offset of the rawdata
+        window: Length of the pairing windows [s]
+        degrees: Optional dict of sensor names and polynomial degrees
+    """
+
+    def __init__(self, config, names, offset=0, window=10.0, degrees=None):
+        if degrees is None:
+            degrees = {}
+        self.config = config
+        self.names = list(names)
+        self.offset = offset
+        self.pairer = TimeWindowPairer(window, self.names)
+        self.fits = {}
+        self.input_offsets = {}
+        for name in self.names:
+            sensor = config.sensors[name]
+            self.fits[name] = create_fit(sensor, offset, degrees.get(name, None))
+            self.input_offsets[name] = sensor.calibration_polynomial(offset)[0]
+        self.npairs = 0
+
+    def add_reference(self, t, temp, valid=True):
+        self.pairer.add_reference(t, temp, valid)
+        return self.update()
+
+    def add_raw(self, t, data):
+        self.pairer.add_raw(t, data)
+        return self.update()
+
+    def update(self):
+        """
+        Adds the pairs of the complete windows to the fits, returns the number of pairs added
+        """
+        pairs = self.pairer.pop_pairs()
+        for t, reference, raw in pairs:
+            for name, rawmean in raw.items():
+                self.fits[name].add(rawmean + self.input_offsets[name], reference)
+        self.npairs += len(pairs)
+        return len(pairs)
+
+    def coefficients(self):
+        """
+        Returns a dict of sensor names and their fitted coefficient lists as in the prb file,
+        sensors without enough pairs are missing
+        """
+        coefficients = {}
+        for name, fit in self.fits.items():
+            c = fit.coefficients()
+            if c is not None:
+                coefficients[name] = fitted_sensor_coefficients(self.config.sensors[name], c)
+        return coefficients
+
+    def fitted_config(self):
+        """
+        Returns a copy of the probe config with the fitted sensors
+        """
+        config = self.config.model_copy(deep=True)
+        for name, coefficients in self.coefficients().items():
+            sensor = config.sensors[name]
+            # A new sensor, the copy shares the compiled calibration of the old one
+            config.sensors[name] = type(sensor)(**{**sensor.model_dump(), "coefficients": coefficients})
+        return config
+
+    def status(self):
+        status = {"npairs": self.npairs, "ndiscarded": self.pairer.ndiscarded}
+        for name, fit in self.fits.items():
+            status[name] = {"n": fit.n, "rms": fit.rms()}
+        return status
+
+    def write_prb(self, filename, prbfile):
+        """
+        Writes the prb file prbfile with the fitted coefficients to filename
+        """
+        coefficients = self.coefficients()
+        content = update_prb_string(read_prb_text(prbfile), coefficients)
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write(content)
+        logger.info("Wrote fitted coefficients of %s to %s", list(coefficients), filename)
+        return coefficients
@@ -1,5 +1,6 @@
 import logging
 import sys
+import collections
 import numpy as np
 import time
 
@@ -7,6 +8,273 @@ import time
 # logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
 
+# Datatype of the decoded HHL frames returned by the batch decoder
+hhl_frame_dtype = np.dtype([("channel", np.int32), ("value", np.int32), ("time", np.float64)])
+
+
+def encode_hhl(channels, values):
+    """
+    Encodes channels and 16 bit values into a HHL binary datastream, the inverse of HHL.decode_HHL()
+
+    Args:
+        channels: Array like of channel numbers (0-31)
+        values: Array like of 16 bit raw values
+
+    Returns:
+        bytes: The HHL datastream with three bytes per frame
+    """
+    channels = np.asarray(channels, dtype=np.int32)
+    values = np.asarray(values, dtype=np.int32)
+    hhldata = np.empty((len(values), 3), dtype=np.uint8)
+    hhldata[:, 0] = ((values & 0x7F) << 1) | 0x01
+    hhldata[:, 1] = (((values >> 7) & 0x7F) << 1) | 0x01
+    hhldata[:, 2] = ((channels & 0x1F) << 3) | (((values >> 14) & 0x03) << 1)
+    return hhldata.tobytes()
+
+
+def decode_hhl_frames(hhldata, last_channel=-1):
+    """
+    Batch version of HHL.decode_rawdata() working on the whole buffer with numpy arrays.
+    The H/H/L flags and channel numbers are computed for every byte offset at once, the
+    "channel increases or resets to 0" rule is then applied run by run instead of frame by frame.
+    The python loop only iterates over realignment events, a clean stream is decoded in one step.
+
+    Args:
+        hhldata: bytes like object (bytes, bytearray, memoryview, uint8 array)
+        last_channel: The channel of the last decoded frame, -1 if unknown
+
+    Returns:
+        tuple: (index, channel, value, nprocessed, last_channel), index is the byte offset of each
+        frame in hhldata, nprocessed is the number of bytes that were processed, the rest
+        (hhldata[nprocessed:]) has to be processed together with new data.
+    """
+    buf = np.frombuffer(hhldata, dtype=np.uint8)
+    n = len(buf)
+    if n < 3:
+        empty = np.empty(0, dtype=np.int32)
+        return np.empty(0, dtype=np.intp), empty, empty, 0, last_channel
+
+    b0 = buf[:-2]
+    b1 = buf[1:-1]
+    b2 = buf[2:]
+    valid = ((b0 & 0x01) == 1) & ((b1 & 0x01) == 1) & ((b2 & 0x01) == 0)
+    channel = (b2 >> 3).astype(np.int32)
+    # cont[i]: A frame accepted at offset i is followed by an accepted frame at i + 3
+    cont = np.zeros(len(valid), dtype=bool)
+    cont[:-3] = valid[3:] & ((channel[3:] > channel[:-3]) | (channel[3:] == 0))
+    valid_index = np.flatnonzero(valid)
+    break_index = np.flatnonzero(valid & ~cont)
+    # The runs are always within one of the three byte alignments
+    break_index_phase = [break_index[break_index % 3 == phase] for phase in range(3)]
+
+    runs = []
+    pos = 0
+    while True:
+        ivalid = np.searchsorted(valid_index, pos)
+        if ivalid == len(valid_index):
+            break
+        istart = valid_index[ivalid]
+        if (channel[istart] > last_channel) or (channel[istart] == 0):
+            break_phase = break_index_phase[istart % 3]
+            iend = break_phase[np.searchsorted(break_phase, istart)]
+            runs.append(np.arange(istart, iend + 1, 3))
+            last_channel = int(channel[iend])
+            pos = iend + 3
+        else:  # Re-aligning
+            last_channel = -1
+            pos = istart + 1
+
+    # Invalid bytes are skipped until less than a frame is left
+    nprocessed = max(pos, n - 2)
+    if len(runs) > 0:
+        index = np.concatenate(runs)
+    else:
+        index = np.empty(0, dtype=np.intp)
+
+    channel = channel[index]
+    hhl0 = buf[index].astype(np.int32)
+    hhl1 = buf[index + 1].astype(np.int32)
+    hhl2 = buf[index + 2].astype(np.int32)
+    value = (hhl0 >> 1) | ((hhl1 & 0xFE) << 6) | ((hhl2 & 0x06) << 13)
+    return index, channel, value, nprocessed, last_channel
+
+
+class HHLDecoder:
+    """
+    Resumable HHL decoder for a stream that arrives in chunks. The alignment state (the channel
+    of the last accepted frame) and the bytes of an incomplete frame are carried from one call to
+    the next, the frames decoded chunk by chunk are identical to those of the concatenated
+    stream. Apart from the up to two carried bytes every byte is examined once.
+    """
+
+    def __init__(self, offset=0):
+        """
+        Args:
+            offset: Stream offset of the first byte that will be decoded
+        """
+        self.reset(offset)
+
+    def reset(self, offset=0):
+        """
+        Discards the state, e.g. after a gap in the stream
+
+        Args:
+            offset: Stream offset of the next byte
+        """
+        self.last_channel = -1
+        self.rest = b""  # Bytes of an incomplete frame
+        self.offset = offset  # Stream offset of the first byte of rest
+        self.nframes = 0
+        self.ndiscarded = 0
+
+    @property
+    def nbytes(self):
+        """
+        Stream offset after the last byte given to the decoder
+        """
+        return self.offset + len(self.rest)
+
+    def decode(self, data):
+        """
+        Decodes the next bytes of the stream
+
+        Args:
+            data: bytes like object, continuing the data of the last call
+
+        Returns:
+            tuple: (index, channel, value), index is the stream offset of each frame
+        """
+        if len(self.rest) > 0:
+            data = self.rest + bytes(data)
+        return self.resume(data)
+
+    def resume(self, hhldata):
+        """
+        As decode() but for a buffer that still holds the carried bytes, i.e. hhldata starts at
+        the stream offset self.offset. This avoids copying the data.
+        """
+        index, channel, value, nprocessed, self.last_channel = decode_hhl_frames(hhldata, self.last_channel)
+        index = index + self.offset
+        self.rest = bytes(hhldata[nprocessed:])
+        self.offset += nprocessed
+        self.nframes += len(index)
+        self.ndiscarded += nprocessed - 3 * len(index)
+        return index, channel, value
+
+
+def detect_hhl_stream(hhldata, minchannels=4, minsequence_repeat=2, max_bytes=16384, nscans_recent=16):
+    """
+    Detects a HHL datastream and its channel sequence. The H/H/L flags are checked for all
+    three byte alignments. The scans between two frames of channel 0 are counted and the most
+    frequent one is the channel sequence. Only the most recent nscans_recent scans of an
+    alignment are scored, a slipped byte in older data does not lower the confidence of the
+    new alignment. The alignment with the highest confidence is used.
+
+    Args:
+        hhldata: bytes like object, only the last max_bytes are inspected
+        minchannels: Minimum number of channels, used to determine the minimum number of bytes
+        minsequence_repeat: Minimum number of complete scans with the detected channel sequence
+        max_bytes: Maximum number of bytes that are inspected
+        nscans_recent: Number of the most recent scans used for the channel sequence and the
+            confidence
+
+    Returns:
+        dict: channel_sequence (None if not detected), phase (the byte offset of the first
+        scored frame in hhldata), confidence (0-1, fraction of valid frames times fraction of
+        scans matching the channel sequence), nscans (number of matching scans)
+    """
+    detection = {"channel_sequence": None, "phase": None, "confidence": 0.0, "nscans": 0}
+    buf = np.frombuffer(hhldata, dtype=np.uint8)
+    nskip = max(len(buf) - max_bytes, 0)
+    buf = buf[nskip:]
+    nmin = minsequence_repeat * (minchannels * 3 + 3)
+    if len(buf) < max(nmin, 3):
+        return detection
+
+    valid_all = ((buf[:-2] & 0x01) == 1) & ((buf[1:-1] & 0x01) == 1) & ((buf[2:] & 0x01) == 0)
+    channel_all = buf[2:] >> 3
+    best = None
+    for phase in range(3):
+        valid = valid_all[phase::3]
+        channel = channel_all[phase::3]
+        izero = np.flatnonzero(valid & (channel == 0))[-(nscans_recent + 1):]
+        if len(izero) < minsequence_repeat + 1:
+            continue
+
+        scans = collections.Counter()
+        for istart, iend in zip(izero[:-1], izero[1:]):
+            if valid[istart:iend].all() and np.all(np.diff(channel[istart:iend].astype(np.int16)) > 0):
+                scans[tuple(channel[istart:iend].tolist())] += 1
+
+        if len(scans) == 0:
+            continue
+
+        channel_sequence, nscans = scans.most_common(1)[0]
+        fraction_valid = np.count_nonzero(valid[izero[0]:izero[-1]]) / (izero[-1] - izero[0])
+        confidence = fraction_valid * nscans / (len(izero) - 1)
+        # The alignment of the newest scans wins for equal confidences, e.g. after a slip
+        score = (confidence, phase + 3 * int(izero[-1]))
+        if best is None or score > best["score"]:
+            best = {"channel_sequence": channel_sequence,
+                    "phase": nskip + phase + 3 * int(izero[0]),
+                    "confidence": confidence,
+                    "nscans": nscans,
+                    "score": score}
+
+    if best is None:
+        return detection
+
+    detection["phase"] = best["phase"]
+    detection["confidence"] = best["confidence"]
+    detection["nscans"] = best["nscans"]
+    if best["nscans"] >= minsequence_repeat:
+        detection["channel_sequence"] = list(best["channel_sequence"])
+
+    return detection
+
+
+class HHLStreamDetector:
+    """
+    Detects the channel sequence of a HHL datastream that is written chunk by chunk into the
+    buffer of a HHL object, see detect_hhl_stream(). Only the newest max_bytes are inspected.
+    While the stream is not detected, the data in the buffer beyond max_bytes is discarded,
+    unless keep_undetected is True, e.g. for a file that is decoded completely.
+    """
+
+    def __init__(self, hhl, confidence_min=0.9, max_bytes=16384, keep_undetected=False):
+        self.hhl = hhl
+        self.confidence_min = confidence_min
+        self.max_bytes = max_bytes
+        self.keep_undetected = keep_undetected
+        self.data = b''  # The newest bytes, inspected by detect_hhl_stream()
+        self.detection = None
+        self.channel_sequence = None
+
+    def process(self, data):
+        """
+        Detects the stream with data, data has to be added to the buffer of hhl before
+
+        Args:
+            data: bytes like object
+
+        Returns:
+            The channel sequence or None if the stream is not detected yet
+        """
+        if self.channel_sequence is not None:
+            return self.channel_sequence
+        # Only the newest bytes are kept, the detection cannot stall on old data
+        self.data = (self.data + bytes(data))[-self.max_bytes:]
+        self.detection = detect_hhl_stream(self.data, max_bytes=self.max_bytes)
+        if self.detection["confidence"] >= self.confidence_min and self.detection["channel_sequence"]:
+            self.channel_sequence = self.detection["channel_sequence"]
+            self.data = b''
+        elif not self.keep_undetected and len(self.hhl.ringbuffer) > self.max_bytes:
+            # Do not keep more undetected data than is inspected
+            self.hhl.ringbuffer.consume(len(self.hhl.ringbuffer) - self.max_bytes)
+
+        return self.channel_sequence
+
+
 def pop_channel_sequence(decoded_data_all, channel_sequence):
     """
     Removes the first occurrence of the `channel_sequence` from `decoded_data_all`,
@@ -42,50 +310,241 @@ def pop_channel_sequence(decoded_data_all, channel_sequence):
         return None
 
 
+class ChannelSequenceFramer:
+    """
+    Groups a stream of decoded frames (see hhl_frame_dtype) into complete scans of
+    channel_sequence. Frames that do not belong to a complete scan are dropped and counted,
+    frames that can still be the beginning of a scan are kept for the next call of process().
+    This replaces repeated calls of pop_channel_sequence() with a single pass over the frames.
+    """
+
+    def __init__(self, channel_sequence):
+        self.channel_sequence = np.asarray(channel_sequence, dtype=np.int32)
+        self.nchannels = len(self.channel_sequence)
+        self.frames = np.empty(0, dtype=hhl_frame_dtype)  # Frames of an incomplete scan
+        self.nscans = 0
+        self.ndropped = 0
+
+    def process(self, frames):
+        """
+        Processes decoded frames
+
+        Args:
+            frames: Structured array of dtype hhl_frame_dtype
+
+        Returns:
+            tuple: (values, times), values is a (nscans x nchannels) array of the raw values,
+            one column per channel of channel_sequence, times is the time of the first frame of
+            each scan.
+        """
+        if len(self.frames) > 0:
+            frames = np.concatenate((self.frames, frames))
+        nframes = len(frames)
+        nstart = nframes - self.nchannels + 1
+        if nstart > 0:
+            channel = frames["channel"]
+            match = np.ones(nstart, dtype=bool)
+            for i, ch in enumerate(self.channel_sequence):
+                match &= channel[i:i + nstart] == ch
+            scan_start = np.flatnonzero(match)
+            # Overlapping matches are only possible if the sequence repeats itself
+            if np.any(np.diff(scan_start) < self.nchannels):
+                scan_start_nonoverlap = []
+                ifree = 0
+                for i in scan_start:
+                    if i >= ifree:
+                        scan_start_nonoverlap.append(i)
+                        ifree = i + self.nchannels
+                scan_start = np.asarray(scan_start_nonoverlap, dtype=np.intp)
+        else:
+            scan_start = np.empty(0, dtype=np.intp)
+
+        index = scan_start[:, np.newaxis] + np.arange(self.nchannels)
+        values = frames["value"][index]
+        times = frames["time"][scan_start]
+        if len(scan_start) > 0:
+            iend = scan_start[-1] + self.nchannels
+        else:
+            iend = 0
+
+        # Keep the frames that can still be the beginning of a scan
+        ikeep = max(iend, nframes - self.nchannels + 1)
+        self.ndropped += ikeep - len(scan_start) * self.nchannels
+        self.nscans += len(scan_start)
+        self.frames = frames[ikeep:].copy()
+        return values, times
+
+
+class RingBuffer:
+    """
+    A preallocated byte buffer with read and write cursors. Instead of wrapping around, the
+    unread data is moved to the front once the end is reached, this keeps the unread window
+    contiguous and it can be handed out as a memoryview. The buffer only grows if the unread
+    data does not fit.
+    The time information is stored once per written chunk as the time of the last byte
+    and the time per byte, the time of single bytes is reconstructed on demand.
+    """
+
+    def __init__(self, size=65536):
+        self.data = bytearray(size)
+        self.read_pos = 0
+        self.write_pos = 0
+        self.offset = 0  # Stream offset of the byte at read_pos
+        # Chunk table: stream offset after the last byte, time of the last byte, time per byte
+        self.chunk_end = []
+        self.chunk_time = []
+        self.chunk_dt = []
+
+    def __len__(self):
+        return self.write_pos - self.read_pos
+
+    def write(self, data, data_time, dt_per_byte=0.0):
+        """
+        Writes data into the buffer
+
+        Args:
+            data: bytes like object
+            data_time: The time of the last byte of data, for compatibility an array like with
+                one time per byte is accepted as well
+            dt_per_byte: The time between two bytes, e.g. 10 bits / baud
+        """
+        n = len(data)
+        if n == 0:
+            return
+        if np.ndim(data_time) > 0:
+            if n > 1:
+                dt_per_byte = (data_time[-1] - data_time[0]) / (n - 1)
+            data_time = data_time[-1]
+        if self.write_pos + n > len(self.data):
+            self._make_room(n)
+        self.data[self.write_pos:self.write_pos + n] = data
+        self.write_pos += n
+        self.chunk_end.append(self.offset + len(self))
+        self.chunk_time.append(data_time)
+        self.chunk_dt.append(dt_per_byte)
+
+    def _make_room(self, n):
+        nunread = len(self)
+        size = len(self.data)
+        while nunread + n > size:
+            size *= 2
+        if size > len(self.data):
+            data = bytearray(size)
+        else:
+            data = self.data
+        data[0:nunread] = self.data[self.read_pos:self.write_pos]
+        self.data = data
+        self.read_pos = 0
+        self.write_pos = nunread
+
+    def view(self):
+        """
+        Returns the unread data as a memoryview, only valid until the next call of write().
+        """
+        return memoryview(self.data)[self.read_pos:self.write_pos]
+
+    def get_time(self, index):
+        """
+        Reconstructs the time of the bytes at index (relative to the unread window)
+
+        Args:
+            index: Array like of byte indices
+
+        Returns:
+            numpy array with the time of each byte
+        """
+        stream_index = np.asarray(index) + self.offset
+        chunk_end = np.asarray(self.chunk_end)
+        ichunk = np.searchsorted(chunk_end, stream_index, side="right")
+        chunk_time = np.asarray(self.chunk_time, dtype=np.float64)[ichunk]
+        chunk_dt = np.asarray(self.chunk_dt, dtype=np.float64)[ichunk]
+        return chunk_time - (chunk_end[ichunk] - 1 - stream_index) * chunk_dt
+
+    def consume(self, n):
+        """
+        Marks n bytes as read
+        """
+        self.read_pos += n
+        self.offset += n
+        if self.read_pos >= self.write_pos:
+            self.read_pos = 0
+            self.write_pos = 0
+        # Remove the chunks that are completely read
+        nchunks = 0
+        while nchunks < len(self.chunk_end) and self.chunk_end[nchunks] <= self.offset:
+            nchunks += 1
+        if nchunks > 0:
+            del self.chunk_end[:nchunks]
+            del self.chunk_time[:nchunks]
+            del self.chunk_dt[:nchunks]
+
+
 class HHL:
     """A processor for the HHL binary datastream from Sea & Sun Technology."""
 
-    def __init__(self, verbosity=logging.DEBUG, config=None):
+    def __init__(self, verbosity=None, config=None):
+        """
+        Args:
+            verbosity: Loglevel of the decoder, None inherits the level of the device logger
+            config: Optional configuration dictionary
+        """
         if config is None:
             config = {}
-        self.logger = logging.getLogger("redvypr_devices.sea_sun_tech_hhl.hhl")
-        self.logger.setLevel(verbosity)
+        self.logger = logging.getLogger("redvypr_devices.sea_sun_tech.hhl")
+        if verbosity is not None:
+            self.logger.setLevel(verbosity)
         self.config = config
-        self.buffer = b""  # a binary buffer for the rawdata
-        self.buffer_time = []
-        self.ngood = 0
-        self.nbad = 0
+        self.ringbuffer = RingBuffer()  # a binary buffer for the rawdata
+        self.decoder = HHLDecoder()
+        self.ngood = 0  # Number of frames decoded by process_buffer()
+        self.nbad = 0  # Number of bytes discarded by process_buffer() while (re)aligning
 
-    def add_to_buffer(self, data, data_time=None):
+    @property
+    def buffer(self):
+        return self.ringbuffer.view()
+
+    @property
+    def buffer_time(self):
+        return self.ringbuffer.get_time(np.arange(len(self.ringbuffer)))
+
+    def add_to_buffer(self, data, data_time=None, dt_per_byte=0.0):
         """
         Adds data to the internal buffer that is used to process the data
         Args:
-            data:
+            data: bytes like object
+            data_time: The time of the last byte, None (time.time() is used), or one time per byte
+            dt_per_byte: The time between two bytes
 
         Returns:
 
         """
-        self.buffer += data
         if data_time is None:
-            data_time = [time.time()] * len(data)
-        self.buffer_time.extend(data_time)
-
+            data_time = time.time()
+        self.ringbuffer.write(data, data_time, dt_per_byte)
 
     def process_buffer(self):
         """
-        Processes the data found in the buffer
+        Processes the data found in the buffer. The decoder state is kept between calls, only
+        the bytes of an incomplete frame stay in the buffer.
 
         Returns:
-
+            The decoded frames as a structured array of dtype hhl_frame_dtype
         """
         funcname = __name__ + ".process_buffer():"
-        nbad = 0
-
-        decoded_data_tmp = self.decode_rawdata(hhldata=self.buffer, hhldata_time=self.buffer_time)
-        decoded_data = decoded_data_tmp[0]
-        self.buffer = decoded_data_tmp[1]
-        self.buffer_time = decoded_data_tmp[2]
-        #print("Buffer lengths",len(self.buffer),len(self.buffer_time))
+        ringbuffer = self.ringbuffer
+        if ringbuffer.offset != self.decoder.offset:
+            # Bytes were removed from the buffer without being decoded, start over
+            self.decoder.reset(ringbuffer.offset)
+        index, channel, value = self.decoder.resume(ringbuffer.view())
+        index -= ringbuffer.offset
+        decoded_data = np.empty(len(index), dtype=hhl_frame_dtype)
+        decoded_data["channel"] = channel
+        decoded_data["value"] = value
+        decoded_data["time"] = ringbuffer.get_time(index)
+        nprocessed = self.decoder.offset - ringbuffer.offset
+        ringbuffer.consume(nprocessed)
+        self.ngood += len(index)
+        self.nbad += nprocessed - 3 * len(index)
         return decoded_data
 
 
@@ -93,82 +552,11 @@ class HHL:
     def inspect_rawdata(self, hhldata, minchannels=4, minsequence_repeat = 2):
         """
         Inspects a binary datastream for valid HHL format,
-        returns a channel_sequence or None
+        returns a channel_sequence or None, see detect_hhl_stream()
         """
-        funcname = __name__ + ".inspect_rawdata():"
-        flag_found_channel0 = False
-        flag_channel_sequence_done = False
-        nmin = minsequence_repeat * (minchannels * 3 + 3)
-        # check for a valid HHL packet first, if found loop over packets and seek for channel 0, if found check if buffer is still enough to create one datapacket
-        # Seek for a start, find two "H" and one "L" pattern
-        n = len(hhldata)
-        print(funcname + "Processing length", n)
-        if n >= nmin:  # We need at least 3*minchannels + numalign bytes for one complete datapacket
-            # for i in range(3):
-            data_check = hhldata
-            last_channel = -1
-            channel_sequence = []
-            current_channel_sequence = []
-            channels_found = []
-            num_sequence_found = 0
-            i = 0
-            while(len(data_check))>3:
-                data_tmp = self.decode_HHL(data_check)
-                # Check if the datastream is valid, if not delete the first byte and try again
-                if data_tmp is not None:
-                    channel = data_tmp[0]
-                    data = data_tmp[1]
-                    print(f"Found valid HHL packet after:{i},{channel=},{data=}")
-                    if flag_found_channel0 == False and channel != 0:
-                        print("Found channel, skipping looking for channel 0 first")
-                        data_check = data_check[3:]
-                        continue
-                    if flag_found_channel0 == False and channel == 0:
-                        print("Found channel 0")
-                        flag_found_channel0 = True
-
-                    # Check if there is a channel with a larger number
-                    if (channel > last_channel) and flag_channel_sequence_done == False:
-                        channel_sequence.append(channel)
-                    elif (channel < last_channel) and flag_channel_sequence_done == False:
-                        print(f"Channel sequence done:{channel_sequence}")
-                        flag_channel_sequence_done = True
-                        #return channel_sequence
-
-                    # Check for a sequence
-                    if flag_channel_sequence_done:
-                        if channel == 0:
-                            print("Starting new sequence")
-                            if len(current_channel_sequence) == len(channel_sequence):
-                                print("Sequence done", current_channel_sequence)
-                                num_sequence_found += 1
-                                if num_sequence_found >= minsequence_repeat:
-                                    print(f"Found {num_sequence_found} sequences")
-                                    return channel_sequence
-
-                            current_channel_sequence = [channel]
-                        elif channel > last_channel:
-                            current_channel_sequence.append(channel)
-
-
-
-                    if (channel > last_channel) or (channel == 0):
-                        print("Found channel",channel)
-                        last_channel = channel
-                        channels_found.append(channel)
-                        data_check = data_check[3:]
-                    else: # reset
-                        print("Resetting")
-                        channels_found = []
-                        last_channel = -1
-                        i += 1
-                        data_check = data_check[1:]
-                else:
-                    # print('Did not found valid HHL packet')
-                    i += 1
-                    data_check = data_check[1:]
-                    flag_found_channel0 = False
-                    flag_channel_sequence_done = False
+        detection = detect_hhl_stream(hhldata, minchannels=minchannels,
+                                      minsequence_repeat=minsequence_repeat)
+        return detection["channel_sequence"]
 
     def decode_rawdata(self, hhldata, hhldata_time=None):
         """
@@ -233,6 +621,28 @@ class HHL:
 
         return (data_decoded, data_check, data_check_time)
 
+    def decode_rawdata_batch(self, hhldata, hhldata_time=None):
+        """
+        Decodes rawdata with the same plausibility checks as decode_rawdata() but vectorized,
+        see decode_hhl_frames()
+
+        Returns:
+            tuple: (frames, hhldata_rest, hhldata_time_rest), frames is a structured array of
+            dtype hhl_frame_dtype, time is NaN if no hhldata_time was given.
+        """
+        index, channel, value, nprocessed, last_channel = decode_hhl_frames(hhldata)
+        frames = np.empty(len(index), dtype=hhl_frame_dtype)
+        frames["channel"] = channel
+        frames["value"] = value
+        if hhldata_time is not None and len(hhldata_time) > 0:
+            frames["time"] = np.asarray(hhldata_time)[index]
+            hhldata_time_rest = hhldata_time[nprocessed:]
+        else:
+            frames["time"] = np.nan
+            hhldata_time_rest = None
+
+        return (frames, hhldata[nprocessed:], hhldata_time_rest)
+
     def decode_HHL(self, hhldata):
         """
         Decodes a three bytes hhldata bytes array into channel, data
@@ -0,0 +1,144 @@
+"""
+Reader for Sea & Sun Technology MRD (MSS) and SRD (CTD) raw data files.
+
+The files are read under the assumption that they consist of a text header with the probe
+configuration in the format of a prb file ([Probe], [Baud], [Sensors] ...), followed by the raw
+HHL datastream as received from the probe. HHL data bytes can be text as well, the header ends
+after its last section or key=value line. Data bytes that are not aligned are skipped by the HHL
+decoder.
+The data section is read block by block, the memory needed is bounded by the block size,
+independent of the file size.
+"""
+import logging
+import re
+import numpy as np
+from .sea_sun_tech_config import SstDeviceConfig, parse_prb_string
+from .sea_sun_tech_hhl import HHLDecoder, ChannelSequenceFramer, detect_hhl_stream, hhl_frame_dtype
+
+logger = logging.getLogger("redvypr_devices.sea_sun_tech.mrd")
+
+# Bytes allowed in the header: tab, line feed, carriage return, printable ASCII and Latin-1
+_text_bytes = np.zeros(256, dtype=bool)
+_text_bytes[[0x09, 0x0A, 0x0D]] = True
+_text_bytes[0x20:0x7F] = True
+_text_bytes[0xA0:] = True
+
+
+# Lines of the header: sections, key=value lines, comments and empty lines
+_header_line = re.compile(rb"\s*(\[[^\]]*\]|[^=\[]+=.*|[#;].*)?\s*")
+
+
+def find_data_offset(buf):
+    """
+    Returns the offset of the data section in buf, the position after the last section or
+    key=value line of the header. The lines are inspected up to the first line that does not
+    belong to the header or contains a byte that cannot be text, HHL frames of text bytes
+    (e.g. "AC\\n" of channel 1) are not taken as header. Returns None if buf is text only.
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    nontext = np.flatnonzero(~_text_bytes[data])
+    if len(nontext) == 0:
+        return None
+    data_offset = 0
+    iend = 0
+    for line in bytes(buf[:nontext[0]]).split(b"\n")[:-1]:  # The last line is not complete
+        iend += len(line) + 1
+        if _header_line.fullmatch(line) is None:
+            break
+        if line.strip() and not line.lstrip().startswith((b"#", b";")):
+            data_offset = iend
+    return data_offset
+
+
+def read_mrd(filestream, header_only=False, max_header_bytes=2 ** 20):
+    """
+    Reads a mrd/srd file
+
+    Args:
+        filestream: File opened in binary mode
+        header_only: Only read the header, the file position is set to the start of the data
+        max_header_bytes: Maximum size of the header
+
+    Returns:
+        dict with "header" (str), "data_offset" (int) and "data" (bytes, None if header_only)
+    """
+    filestream.seek(0)
+    buf = filestream.read(max_header_bytes)
+    data_offset = find_data_offset(buf)
+    if data_offset is None:
+        if len(buf) == max_header_bytes:
+            raise ValueError("No data found in the first {} bytes".format(max_header_bytes))
+        data_offset = len(buf)
+    header = buf[:data_offset].decode("Windows-1252", errors="replace")
+    filestream.seek(data_offset)
+    data = None if header_only else filestream.read()
+    return {"header": header, "data_offset": data_offset, "data": data}
+
+
+def parse_header(header_raw):
+    """
+    Parses the header of a mrd/srd file
+
+    Returns:
+        dict with the sections of the header, the sensors are in header["mss"]["channels"]
+    """
+    config = parse_prb_string(header_raw)
+    header = {"sections": config, "mss": {"channels": config.get("Sensors", {})}}
+    return header
+
+
+def iter_mrd(filename, config=None, offset=0, shear_sensitivities=None, channel_sequence=None,
+             blocksize=2 ** 22):
+    """
+    Streams the data of a mrd/srd file as calibrated blocks. The file is read in blocks of
+    blocksize bytes, each block is decoded with a resumable HHLDecoder, framed into scans and
+    calibrated with a CalibrationPlan.
+
+    Args:
+        filename: The mrd/srd file
+        config: The SstDeviceConfig, if None it is created from the header of the file
+        offset: The device offset
+        shear_sensitivities: dict of the sensitivities of the shear sensors, if config is None
+        channel_sequence: The channels of a scan, if None it is detected from the first block
+        blocksize: Number of bytes read at once
+
+    Yields:
+        dict with "iscan" (the scan number), "offset" (file offset of the first byte of each
+        scan) and one array per calibrated sensor
+    """
+    with open(filename, "rb") as f:
+        data = read_mrd(f, header_only=True)
+        if config is None:
+            config = SstDeviceConfig.from_prb_dict(parse_prb_string(data["header"]), offset=offset,
+                                                   shear_sensitivities=shear_sensitivities)
+        decoder = HHLDecoder(offset=data["data_offset"])
+        framer = None
+        plan = None
+        nscans = 0
+        buf = bytearray(blocksize)
+        while True:
+            nread = f.readinto(buf)
+            if nread == 0:
+                break
+            block = memoryview(buf)[:nread]
+            if framer is None:
+                if channel_sequence is None:
+                    channel_sequence = detect_hhl_stream(block)["channel_sequence"]
+                    if channel_sequence is None:
+                        raise ValueError("No HHL datastream found in {}".format(filename))
+                    logger.debug("Detected channel sequence %s", channel_sequence)
+                framer = ChannelSequenceFramer(channel_sequence)
+                plan = config.calibration_plan(channel_sequence, offset=offset)
+            index, channel, value = decoder.decode(block)
+            frames = np.empty(len(index), dtype=hhl_frame_dtype)
+            frames["channel"] = channel
+            frames["value"] = value
+            frames["time"] = index  # The file offset takes the place of the time
+            scan_values, scan_offsets = framer.process(frames)
+            if len(scan_values) == 0:
+                continue
+            calibrated = plan(scan_values)
+            calibrated["iscan"] = np.arange(nscans, nscans + len(scan_values))
+            calibrated["offset"] = scan_offsets.astype(np.int64)
+            nscans += len(scan_values)
+            yield calibrated
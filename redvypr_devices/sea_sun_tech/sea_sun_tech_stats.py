@@ -0,0 +1,165 @@
+import bisect
+import logging
+import time
+import numpy as np
+
+
+# Bin edges [s] of the timing histograms, two bins per decade from 1 us to 100 s
+timing_edges = [float(e) for e in np.logspace(-6, 2, 17)]
+
+
+class TimingHistogram:
+    """
+    Histogram of durations with logarithmic bins, adding a value is a bisect and an increment,
+    cheap enough to be done for every processing step.
+    """
+
+    def __init__(self, edges=None):
+        if edges is None:
+            edges = timing_edges
+        self.edges = list(edges)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, dt):
+        self.counts[bisect.bisect(self.edges, dt)] += 1
+        self.n += 1
+        self.sum += dt
+        if dt > self.max:
+            self.max = dt
+
+    def quantile(self, q):
+        """
+        Returns the upper bin edge below which the fraction q of the durations lies, the
+        maximum for the overflow bin and None if the histogram is empty
+        """
+        if self.n == 0:
+            return None
+        ncum = 0
+        for i, count in enumerate(self.counts):
+            ncum += count
+            if ncum >= q * self.n:
+                break
+        if i < len(self.edges):
+            return min(self.edges[i], self.max)
+        return self.max
+
+    def summary(self):
+        summary = {"n": self.n,
+                   "mean": self.sum / self.n if self.n > 0 else None,
+                   "max": self.max,
+                   "p50": self.quantile(0.5),
+                   "p99": self.quantile(0.99),
+                   "counts": list(self.counts)}
+        return summary
+
+
+class PipelineStatistics:
+    """
+    Counters, gauges and timing histograms of the acquisition pipeline.
+
+    Counters are cumulative, the rates and histograms of snapshot() cover the time since the
+    last snapshot. Gauges hold the last value set, e.g. a queue depth.
+    """
+    counter_names = ["bytes_read", "chunks_read", "frames_decoded", "bytes_discarded",
+                     "scans_framed", "frames_dropped", "calibration_failures",
+                     "packets_published"]
+    timing_names = ["decode", "frame", "calibrate", "publish", "latency"]
+
+    def __init__(self):
+        self.counters = dict.fromkeys(self.counter_names, 0)
+        self.gauges = {}
+        self.histograms = {name: TimingHistogram() for name in self.timing_names}
+        self.t_start = time.time()
+        self.t_snapshot = self.t_start
+        self.counters_snapshot = dict(self.counters)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def timing(self, name, dt):
+        try:
+            self.histograms[name].add(dt)
+        except KeyError:
+            self.histograms[name] = TimingHistogram()
+            self.histograms[name].add(dt)
+
+    def due(self, dt):
+        """
+        Returns True if the last snapshot is older than dt seconds
+        """
+        return (time.time() - self.t_snapshot) >= dt
+
+    def snapshot(self):
+        """
+        Returns the statistics as a dictionary and starts a new interval for the rates and
+        the histograms
+        """
+        t_now = time.time()
+        dt = max(t_now - self.t_snapshot, 1e-9)
+        rates = {name: (n - self.counters_snapshot.get(name, 0)) / dt
+                 for name, n in self.counters.items()}
+        snapshot = {"t": t_now,
+                    "uptime": t_now - self.t_start,
+                    "interval": dt,
+                    "counters": dict(self.counters),
+                    "rates": rates,
+                    "gauges": dict(self.gauges),
+                    "timing": {name: h.summary() for name, h in self.histograms.items()}}
+        for h in self.histograms.values():
+            h.reset()
+        self.t_snapshot = t_now
+        self.counters_snapshot = dict(self.counters)
+        return snapshot
+
+    def status_string(self, snapshot):
+        """
+        Returns a one line summary of a snapshot for the statusqueue
+        """
+        rates = snapshot["rates"]
+        latency = snapshot["timing"]["latency"]["p99"]
+        sstr = "{:.0f} bytes/s, {:.1f} scans/s, {:d} bytes discarded, {:d} frames dropped, " \
+               "{:d} calibration failures, latency p99 {}".format(
+                   rates["bytes_read"], rates["scans_framed"],
+                   snapshot["counters"]["bytes_discarded"], snapshot["counters"]["frames_dropped"],
+                   snapshot["counters"]["calibration_failures"],
+                   "{:.3f} s".format(latency) if latency is not None else "-")
+        return sstr
+
+
+class SampledTrace:
+    """
+    Rate limited logging for the hot path. A message of a given key is logged at most once per
+    interval, the arguments are only formatted if the message is logged. The number of
+    suppressed messages is appended to the next logged one. If the level is not enabled for the
+    logger, a call costs one isEnabledFor() check.
+    """
+
+    def __init__(self, logger, interval=1.0, level=logging.DEBUG):
+        self.logger = logger
+        self.interval = interval
+        self.level = level
+        self.t_last = {}
+        self.nsuppressed = {}
+
+    def __call__(self, key, msg, *args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        t_now = time.monotonic()
+        if t_now - self.t_last.get(key, -float("inf")) < self.interval:
+            self.nsuppressed[key] = self.nsuppressed.get(key, 0) + 1
+            return
+        self.t_last[key] = t_now
+        nsuppressed = self.nsuppressed.pop(key, 0)
+        if nsuppressed > 0:
+            msg = msg + " (%d suppressed)"
+            args = args + (nsuppressed,)
+        self.logger.log(self.level, msg, *args)
@@ -0,0 +1,325 @@
+"""
+Benchmark of the Sea & Sun Technology decode -> frame -> calibrate pipeline
+
+Synthesizes CTM and MSS like HHL streams with dropped bytes, flipped flag bits and partial
+frames, equivalent to a given time of data at 2400, 115200 and 614400 baud, and measures
+throughput (bytes/s, scans/s), the realtime factor and the peak memory (tracemalloc) of every
+stage. The results are written as JSON and can be compared against a baseline file:
+
+    python benchmark_sea_sun_tech.py --output results.json
+    python benchmark_sea_sun_tech.py --compare results.json --tolerance 0.2
+
+With --compare the script exits with 1 if a benchmark is slower than the baseline by more than
+the tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from redvypr_devices.sea_sun_tech.sea_sun_tech_hhl import HHL, ChannelSequenceFramer, encode_hhl, pop_channel_sequence
+from redvypr_devices.sea_sun_tech.sea_sun_tech_config import SstDeviceConfig
+
+testdir = os.path.dirname(os.path.abspath(__file__))
+
+# The probes, the prb files are test files with the channel layout of a CTM and a MSS probe
+probes = {}
+probes["CTM"] = {"prbfile": os.path.join(testdir, "CTM_test.prb"), "offset": 0,
+                 "shear_sensitivities": None}
+probes["MSS"] = {"prbfile": os.path.join(testdir, "MSS_test.prb"), "offset": -32768,
+                 "shear_sensitivities": {'SHE1': 3.90e-4, 'SHE2': 4.05e-4}}
+
+bauds = [2400, 115200, 614400]
+bits_per_byte = 10  # 8N1
+
+
+def synthesize_hhl_stream(channel_sequence, nbytes, seed=0, corruption_rate=1e-4):
+    """
+    Synthesizes a HHL stream of approximately nbytes with random values and corruptions
+
+    Args:
+        channel_sequence: The channels of one scan
+        nbytes: The size of the stream
+        seed: Seed of the random number generator
+        corruption_rate: Probability per byte of each of the corruptions (dropped byte, flipped
+            flag bit, partial frame)
+
+    Returns:
+        bytes
+    """
+    rng = np.random.default_rng(seed)
+    nscans = max(nbytes // (3 * len(channel_sequence)), 1)
+    channels = np.tile(channel_sequence, nscans)
+    values = rng.integers(0, 2 ** 16, len(channels))
+    hhldata = np.frombuffer(encode_hhl(channels, values), dtype=np.uint8).copy()
+    ncorrupt = rng.binomial(len(hhldata), corruption_rate, 3)
+    # Flipped flag bits
+    iflip = rng.integers(0, len(hhldata), ncorrupt[0])
+    hhldata[iflip] ^= 0x01
+    # Dropped bytes
+    idrop = rng.integers(0, len(hhldata), ncorrupt[1])
+    # Partial frames, the last one or two bytes of a frame are missing
+    iframe = 3 * rng.integers(0, len(hhldata) // 3, ncorrupt[2])
+    ipartial = np.concatenate((iframe + 2, (iframe + 1)[rng.integers(0, 2, len(iframe)) == 1]))
+    keep = np.ones(len(hhldata), dtype=bool)
+    keep[idrop] = False
+    keep[ipartial] = False
+    return hhldata[keep].tobytes()
+
+
+def polynomial_reference(sensor, offset):
+    """
+    Returns a function calibrating with numpy.polynomial.Polynomial, as the sensors did before
+    they got the precomputed Horner coefficients
+    """
+    input_offset, coefficients = sensor.calibration_polynomial(offset)
+    p = np.polynomial.Polynomial(coefficients)
+    if sensor.kernel == "ntc":
+        return lambda x: 1 / p(np.log(x + input_offset)) - 273.15
+    return lambda x: p(x + input_offset)
+
+
+def measure(func, nbytes, nscans, baud, repeat=5, min_time=0.02):
+    """
+    Measures the runtime of func and the peak memory during one call. As with timeit, func is
+    called in loops of at least min_time, the fastest loop of repeat is reported.
+
+    Returns:
+        dict with the results
+    """
+    nloops = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(nloops):
+            func()
+        dt = time.perf_counter() - t0
+        if dt >= min_time:
+            break
+        nloops *= 2
+
+    runtimes = [dt / nloops]
+    for i in range(repeat - 1):
+        t0 = time.perf_counter()
+        for j in range(nloops):
+            func()
+        runtimes.append((time.perf_counter() - t0) / nloops)
+
+    tracemalloc.start()
+    func()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    runtime = max(min(runtimes), 1e-9)
+    bytes_per_s = nbytes / runtime
+    result = {"nbytes": nbytes,
+              "nscans": nscans,
+              "time": runtime,
+              "bytes_per_s": bytes_per_s,
+              "scans_per_s": nscans / runtime,
+              "realtime_factor": bytes_per_s / (baud / bits_per_byte),
+              "peak_memory": peak_memory}
+    return result
+
+
+def benchmark_probe(probe, baud, duration=1.0, legacy_max_bytes=20000, repeat=5, seed=0):
+    """
+    Benchmarks all stages for duration seconds of data of a probe at baud
+
+    Args:
+        probe: Name of the probe in probes
+        baud: The baudrate
+        duration: The time of data [s]
+        legacy_max_bytes: The legacy list based functions are quadratic in the size of their
+            input, the data is truncated to this size for them
+        repeat: Number of repetitions, the fastest is reported
+
+    Returns:
+        dict of benchmark name and results
+    """
+    probeinfo = probes[probe]
+    cfg = SstDeviceConfig.from_prb(probeinfo["prbfile"],
+                                   shear_sensitivities=probeinfo["shear_sensitivities"])
+    channel_sequence = sorted(sensor.channel for sensor in cfg.sensors.values())
+    offset = probeinfo["offset"]
+    nbytes = max(int(duration * baud / bits_per_byte), 3 * len(channel_sequence))
+    hhldata = synthesize_hhl_stream(channel_sequence, nbytes, seed=seed)
+    hhldata_time = np.arange(len(hhldata)) * bits_per_byte / baud
+    hhldata_legacy = hhldata[:legacy_max_bytes]
+    hhldata_time_legacy = list(hhldata_time[:legacy_max_bytes])
+
+    hhl = HHL()
+    frames, _, _ = hhl.decode_rawdata_batch(hhldata, hhldata_time=hhldata_time)
+    framer = ChannelSequenceFramer(channel_sequence)
+    rawdata, _ = framer.process(frames)
+    nscans = len(rawdata)
+    frames_legacy, _, _ = hhl.decode_rawdata(hhldata_legacy, hhldata_time=hhldata_time_legacy)
+    rawdata_legacy = rawdata[:len(frames_legacy) // len(channel_sequence)]
+    plan = cfg.calibration_plan(channel_sequence, offset=offset)
+    cfg.calibration_lut = "float32"
+    plan_lut = cfg.calibration_plan(channel_sequence, offset=offset)
+    sensors = [(channel_sequence.index(sensor.channel), sensor) for sensor in cfg.sensors.values()
+               if sensor.kernel is not None]
+    sensors_polynomial = [(i, polynomial_reference(sensor, offset)) for i, sensor in sensors]
+    sensors_compiled = [(i, sensor.compiled_calibration(offset)[2]) for i, sensor in sensors]
+    rawdata_legacy_scalar = rawdata_legacy.tolist()
+
+    def decode_rawdata():
+        HHL().decode_rawdata(hhldata_legacy, hhldata_time=hhldata_time_legacy)
+
+    def decode_rawdata_batch():
+        HHL().decode_rawdata_batch(hhldata, hhldata_time=hhldata_time)
+
+    def process_buffer():
+        # Chunks as delivered by the serial reader
+        hhl_chunked = HHL()
+        chunksize = 4096
+        for i in range(0, len(hhldata), chunksize):
+            chunk = hhldata[i:i + chunksize]
+            hhl_chunked.add_to_buffer(chunk, data_time=hhldata_time[i + len(chunk) - 1],
+                                      dt_per_byte=bits_per_byte / baud)
+            hhl_chunked.process_buffer()
+
+    def pop_channel_sequence_legacy():
+        decoded_data_all = list(frames_legacy)
+        while pop_channel_sequence(decoded_data_all, channel_sequence) is not None:
+            pass
+
+    def channel_sequence_framer():
+        ChannelSequenceFramer(channel_sequence).process(frames)
+
+    def raw_to_units():
+        # Scan by scan, as done before the calibration plan
+        for scan in rawdata_legacy_scalar:
+            for i, sensor in sensors:
+                sensor.raw_to_units(scan[i], offset=offset)
+
+    def raw_to_units_compiled():
+        for scan in rawdata_legacy_scalar:
+            for i, calibrate_scalar in sensors_compiled:
+                calibrate_scalar(scan[i])
+
+    def raw_to_units_polynomial():
+        for scan in rawdata_legacy_scalar:
+            for i, p in sensors_polynomial:
+                p(scan[i])
+
+    def raw_to_units_array():
+        for i, sensor in sensors:
+            sensor.raw_to_units(rawdata[:, i], offset=offset)
+
+    def calibration_plan():
+        plan.calibrate(rawdata)
+
+    def lookup_table_plan():
+        plan_lut.calibrate(rawdata)
+
+    nscans_legacy = len(rawdata_legacy)
+    nbytes_legacy = len(hhldata_legacy)
+    benchmarks = {"decode_rawdata": (decode_rawdata, nbytes_legacy, nscans_legacy),
+                  "decode_rawdata_batch": (decode_rawdata_batch, len(hhldata), nscans),
+                  "process_buffer": (process_buffer, len(hhldata), nscans),
+                  "pop_channel_sequence": (pop_channel_sequence_legacy, nbytes_legacy, nscans_legacy),
+                  "channel_sequence_framer": (channel_sequence_framer, len(hhldata), nscans),
+                  "raw_to_units": (raw_to_units, nbytes_legacy, nscans_legacy),
+                  "raw_to_units_compiled": (raw_to_units_compiled, nbytes_legacy, nscans_legacy),
+                  "raw_to_units_polynomial": (raw_to_units_polynomial, nbytes_legacy, nscans_legacy),
+                  "raw_to_units_array": (raw_to_units_array, len(hhldata), nscans),
+                  "calibration_plan": (calibration_plan, len(hhldata), nscans),
+                  "lookup_table_plan": (lookup_table_plan, len(hhldata), nscans),
+                  }
+
+    results = {}
+    # The random rawdata is partly outside of the range of the NTC calibration
+    with np.errstate(invalid="ignore", divide="ignore"):
+        for name, (func, nbytes_func, nscans_func) in benchmarks.items():
+            results["{}_{}_{}".format(probe, baud, name)] = measure(func, nbytes_func, nscans_func,
+                                                                    baud, repeat=repeat)
+    return results
+
+
+def run(duration=1.0, legacy_max_bytes=20000, repeat=5):
+    """
+    Runs the benchmarks of all probes and baudrates
+
+    Returns:
+        dict with information about the environment and the results
+    """
+    results = {}
+    for probe in probes:
+        for baud in bauds:
+            results.update(benchmark_probe(probe, baud, duration=duration,
+                                           legacy_max_bytes=legacy_max_bytes, repeat=repeat))
+
+    benchmark = {"time": time.time(),
+                 "python": platform.python_version(),
+                 "numpy": np.__version__,
+                 "machine": platform.machine(),
+                 "duration": duration,
+                 "results": results}
+    return benchmark
+
+
+def compare(results, results_baseline, tolerance=0.2):
+    """
+    Compares the throughput of results with results_baseline
+
+    Returns:
+        List of the names of the benchmarks that are slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        try:
+            result_baseline = results_baseline[name]
+        except KeyError:
+            continue
+        ratio = result["bytes_per_s"] / result_baseline["bytes_per_s"]
+        flag = ""
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+            flag = "REGRESSION"
+        print("{:45s} {:8.2f} {}".format(name, ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=float, default=1.0, help="Time of data per benchmark [s]")
+    parser.add_argument("--legacy-max-bytes", type=int, default=20000,
+                        help="Maximum size of the data for the legacy list based functions")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--compare", help="JSON file with baseline results")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed relative loss of throughput compared to the baseline")
+    args = parser.parse_args(argv)
+
+    benchmark = run(duration=args.duration, legacy_max_bytes=args.legacy_max_bytes, repeat=args.repeat)
+    print("{:45s} {:>14s} {:>14s} {:>10s} {:>12s}".format("Benchmark", "bytes/s", "scans/s",
+                                                          "realtime", "peak memory"))
+    for name, result in benchmark["results"].items():
+        print("{:45s} {:14.0f} {:14.0f} {:10.1f} {:12d}".format(name, result["bytes_per_s"],
+                                                                result["scans_per_s"],
+                                                                result["realtime_factor"],
+                                                                result["peak_memory"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(benchmark, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            benchmark_baseline = json.load(f)
+        print("Throughput relative to {}".format(args.compare))
+        regressions = compare(benchmark["results"], benchmark_baseline["results"],
+                              tolerance=args.tolerance)
+        if len(regressions) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
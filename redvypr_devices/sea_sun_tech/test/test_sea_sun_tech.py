@@ -1,7 +1,12 @@
+import os
 from redvypr_devices import sea_sun_tech
 from redvypr_devices.sea_sun_tech.sea_sun_tech_config import SstDeviceConfig
 
-prbfile = "CTM1215.prb"
+prbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CTM_test.prb")
 
-ctd_cfg = SstDeviceConfig.from_prb(prbfile)
-print("CTD cfg",ctd_cfg)
\ No newline at end of file
+
+def test_ctd_cfg():
+    ctd_cfg = SstDeviceConfig.from_prb(prbfile)
+    print("CTD cfg",ctd_cfg)
+    assert ctd_cfg.name == "CTMTEST"
+    assert len(ctd_cfg.sensors) == 8
@@ -0,0 +1,19 @@
+from redvypr.data_packets import create_datadict
+from redvypr_devices.sea_sun_tech.sea_sun_tech_calibration import DeviceCustomConfig, packet_time
+
+
+def test_packet_time():
+    assert packet_time({'t': 5.0}) == 5.0
+    data = create_datadict(packetid='test')
+    assert packet_time(data) == data['_redvypr']['t']
+
+
+def test_reference_address():
+    # Only the temp of the Leitenberger devices is the reference, not the temp of the probe
+    reference_address = DeviceCustomConfig().reference_address
+    data_bath = create_datadict(device='leitenberger_1')
+    data_bath['temp'] = 20.0
+    data_probe = create_datadict(device='sea_sun_tech_1', packetid='sst_MSS038')
+    data_probe['temp'] = 19.0
+    assert reference_address(data_bath, strict=False) == 20.0
+    assert reference_address(data_probe, strict=False) is None
@@ -0,0 +1,251 @@
+import numpy as np
+import pytest
+from redvypr_devices.sea_sun_tech import sea_sun_tech_config
+from typing import Literal
+from redvypr_devices.sea_sun_tech.sea_sun_tech_config import (MssDeviceConfig, SstDeviceConfig, SstSensor,
+                                                             SstSensorNotImplemented, register_caltype,
+                                                             register_kernel)
+
+# A probe file with one sensor of each calibration type
+prb_content = """
+[Probe]
+Typ=MSS90L
+SerialNumber=038
+Name=MSS038
+
+[Baud]
+DataFormat=HHL
+COM=614400
+
+[Sensors]
+S0=0 N COUNT _ 0 1 0
+S1=1 P PRESS dbar -1.5 2.5e-3 1e-9 0.2
+S2=2 SHH NTC degC 3.3e-3 2.6e-4 3.4e-6 1e-7 0
+S3=3 N COND mS/cm 0.1 1.1e-3 0
+S4=4 NFC TURB NTU 0.5 1e-3 2e-9 2.0 0.1
+S5=5 V04 OXY ml/l 0.2 4e-3 1.1 0.9
+S6=6 N24 OXYTEMP degC -5 1e-3 0
+S7=7 N SHE1 s-1 0 1 0
+S8=8 XYZ UNKNOWN _ 0 1 0
+"""
+
+
+@pytest.fixture
+def prbfile(tmp_path):
+    filename = tmp_path / "MSS038.prb"
+    filename.write_text(prb_content)
+    return filename
+
+
+def test_from_prb(prbfile):
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    assert cfg.name == "MSS038"
+    assert cfg.sensors["NTC"].calibration_type == "SHH"
+    assert cfg.sensors["SHE1"].calibration_type == "SHE"
+    assert len(cfg.sensors) == 9
+
+
+@pytest.mark.parametrize("offset", [0, -32768])
+def test_calibration_plan(prbfile, offset):
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    channel_sequence = list(range(9))
+    rawdata = np.random.default_rng(0).integers(20000, 60000, (100, len(channel_sequence)))
+    rawdata = rawdata - offset
+    plan = cfg.calibration_plan(channel_sequence, offset=offset)
+    data = plan(rawdata)
+    assert "UNKNOWN" not in data
+    for name, sensor in cfg.sensors.items():
+        if name == "UNKNOWN":
+            continue
+        data_ref = sensor.raw_to_units(rawdata[:, sensor.channel], offset=offset)
+        np.testing.assert_allclose(data[name], data_ref, rtol=1e-10)
+
+
+def raw_to_units_reference(sensor, rawdata, offset):
+    """
+    The calibrations written out with numpy polynomials
+    """
+    c = sensor.coefficients
+    P = np.polynomial.Polynomial
+    if sensor.calibration_type == "P":
+        return P(c[:-1])(rawdata + offset) - c[-1]
+    elif sensor.calibration_type == "SHH":
+        return 1 / P(c[:-1])(np.log(rawdata + offset)) - 273.15
+    elif sensor.calibration_type == "NFC":
+        return P(c[:-2])(rawdata + offset) * c[-1] + c[-2]
+    elif sensor.calibration_type == "V04":
+        return P(c[-2:])(P(c[0:2])(rawdata + offset))
+    elif sensor.calibration_type == "SHE":
+        return P(c)(rawdata - offset)
+    else:
+        return P(c)(rawdata + offset)
+
+
+@pytest.mark.parametrize("offset", [0, -32768])
+def test_raw_to_units(prbfile, offset):
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    rawdata = np.random.default_rng(0).integers(20000, 60000, 50) - offset
+    for name, sensor in cfg.sensors.items():
+        if name == "UNKNOWN":
+            with pytest.raises(NotImplementedError):
+                sensor.raw_to_units(rawdata[0], offset=offset)
+            continue
+        data_ref = raw_to_units_reference(sensor, rawdata, offset)
+        data = sensor.raw_to_units(rawdata, offset=offset)
+        np.testing.assert_allclose(data, data_ref, rtol=1e-10)
+        # Scalar fast path
+        data_scalar = [sensor.raw_to_units(int(r), offset=offset) for r in rawdata]
+        assert all(isinstance(d, float) for d in data_scalar)
+        np.testing.assert_allclose(data_scalar, data, rtol=1e-12)
+        assert isinstance(sensor.raw_to_units(rawdata[0], offset=offset), float)
+        calibrate_scalar = sensor.compiled_calibration(offset)[2]
+        assert [calibrate_scalar(int(r)) for r in rawdata] == data_scalar
+
+
+@pytest.mark.parametrize("offset", [0, -32768])
+def test_raw_to_units_ntc_nonpositive(prbfile, offset):
+    # x = rawdata + offset <= 0 has no logarithm, scalar and array path give nan
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    sensor = cfg.sensors["NTC"]
+    rawdata = np.array([-100, -1, 0, 1, 30000]) - offset
+    data = sensor.raw_to_units(rawdata, offset=offset)
+    data_scalar = [sensor.raw_to_units(int(r), offset=offset) for r in rawdata]
+    assert np.all(np.isnan(data[:3]))
+    assert np.all(np.isfinite(data[3:]))
+    np.testing.assert_array_equal(data_scalar, data)
+    plan = cfg.calibration_plan([sensor.channel], offset=offset)
+    np.testing.assert_array_equal(plan.calibrate(rawdata[:, np.newaxis])[:, 0], data)
+
+
+@pytest.mark.parametrize("offset", [0, -32768])
+def test_raw_to_units_coefficients_changed(prbfile, offset):
+    # The compiled calibration follows the coefficients of the sensor
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    sensor = cfg.sensors["COND"]
+    rawdata = 40000 - offset
+    assert sensor.raw_to_units(rawdata, offset=offset) == pytest.approx(raw_to_units_reference(sensor, rawdata, offset))
+    sensor.coefficients = [1.0, 2.0]
+    assert sensor.raw_to_units(rawdata, offset=offset) == 1.0 + 2.0 * 40000
+    sensor.coefficients[0] = 3.0
+    assert sensor.raw_to_units(rawdata, offset=offset) == 3.0 + 2.0 * 40000
+    assert sensor.compiled_calibration(offset)[1] == (3.0, 2.0)
+    sensor_copy = sensor.model_copy(update={"coefficients": [0.0, 1.0]})
+    assert sensor_copy.raw_to_units(rawdata, offset=offset) == 40000
+    assert sensor.raw_to_units(rawdata, offset=offset) == 3.0 + 2.0 * 40000
+    np.testing.assert_array_equal(sensor.raw_to_units(np.array([rawdata]), offset=offset), 3.0 + 2.0 * 40000)
+
+
+@pytest.mark.parametrize("offset", [0, -32768])
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+def test_lookup_tables(prbfile, offset, dtype):
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    deviations = cfg.verify_lookup_tables(offset, dtype=dtype)
+    assert set(deviations) == set(cfg.sensors) - {"UNKNOWN"}
+    rtol = 1e-6 if dtype == "float32" else 1e-14
+    assert max(deviations.values()) < rtol
+
+    channel_sequence = list(range(9))
+    rawdata = np.random.default_rng(0).integers(0, 2 ** 16, (100, len(channel_sequence)))
+    plan_ref = cfg.calibration_plan(channel_sequence, offset=offset)
+    data_ref = plan_ref.calibrate(rawdata)
+    cfg.calibration_lut = dtype
+    plan = cfg.calibration_plan(channel_sequence, offset=offset)
+    data = plan.calibrate(rawdata)
+    assert data.dtype == np.dtype(dtype)
+    assert plan.names == plan_ref.names
+    np.testing.assert_allclose(data, data_ref, rtol=10 * rtol, atol=0, equal_nan=True)
+
+
+def test_from_prb_cache(prbfile, tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    shear_sensitivities = {"SHE1": 3.9e-4}
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities, cache=cache_dir)
+    assert len(list(cache_dir.glob("*.json"))) == 1
+
+    def read_prb_file(filename):
+        raise AssertionError("The prb file should not be parsed")
+
+    def create_sensor(*args, **kwargs):
+        raise AssertionError("The sensors should not be created from the prb file")
+
+    with monkeypatch.context() as m:
+        m.setattr(sea_sun_tech_config, "read_prb_file", read_prb_file)
+        m.setattr(sea_sun_tech_config, "create_sensor", create_sensor)
+        cfg_cached = SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities,
+                                              cache=cache_dir)
+        cfg_offset = SstDeviceConfig.from_prb(prbfile, offset=-32768, shear_sensitivities=shear_sensitivities,
+                                              cache=cache_dir)
+    assert cfg_cached == SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities)
+    assert cfg_cached.sensors["NTC"].raw_to_units(30000) == cfg.sensors["NTC"].raw_to_units(30000)
+    assert isinstance(cfg_cached.sensors["UNKNOWN"], SstSensorNotImplemented)
+    # The offset is applied to the cached config, as without a cache
+    assert cfg_offset.offset == -32768
+    assert cfg_offset == SstDeviceConfig.from_prb(prbfile, offset=-32768, shear_sensitivities=shear_sensitivities)
+    assert SstDeviceConfig.from_prb(prbfile, offset=-32768, cache=False).offset == -32768
+    # The config class is part of the key
+    assert isinstance(MssDeviceConfig.from_prb(prbfile, cache=cache_dir), MssDeviceConfig)
+    assert len(list(cache_dir.glob("*.json"))) == 2
+
+    # A changed file is parsed again, other arguments use the cached file
+    prbfile.write_text(prb_content.replace("Name=MSS038", "Name=MSS039"))
+    assert SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities,
+                                    cache=cache_dir).name == "MSS039"
+    cfg_she = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 4e-4}, cache=cache_dir)
+    assert cfg_she.sensors["SHE1"].sensitivity == 4e-4
+    assert cfg_she.sensors["SHE1"].coefficients == [1.47133e-6 / 4e-4, 2.94266e-6 / 4e-4]
+    assert len(list(cache_dir.glob("*.json"))) == 3
+    # No pickles are written or loaded
+    assert len(list(cache_dir.glob("*.pickle"))) == 0
+
+
+@pytest.fixture
+def restore_registry():
+    """
+    Restores the registered caltypes and kernels and the device configs after a test
+    """
+    sensor_registry = dict(sea_sun_tech_config.sensor_registry)
+    calibration_kernels = dict(sea_sun_tech_config.calibration_kernels)
+    yield
+    sea_sun_tech_config.sensor_registry.clear()
+    sea_sun_tech_config.sensor_registry.update(sensor_registry)
+    sea_sun_tech_config.calibration_kernels.clear()
+    sea_sun_tech_config.calibration_kernels.update(calibration_kernels)
+    sea_sun_tech_config.rebuild_device_configs()
+
+
+def test_register_caltype(prbfile, restore_registry):
+    def kernel_exp(x, coefficients):
+        return np.exp(sea_sun_tech_config.calibration_kernels["poly"](x, coefficients))
+
+    class SstSensorExp(SstSensor):
+        calibration_type: Literal["XYZ"] = "XYZ"
+        kernel = "exp"
+
+        def calibration_polynomial(self, offset=0):
+            return offset, list(self.coefficients)
+
+    class SstSensorStr(SstSensor):
+        calibration_type: str = "XYZ"
+
+    with pytest.raises(ValueError):
+        register_caltype("XYZ", SstSensorExp)
+    register_kernel("exp", kernel_exp)
+    # The calibration_type has to be a Literal to discriminate the sensors
+    with pytest.raises(ValueError):
+        register_caltype("XYZ", SstSensorStr)
+    register_caltype("XYZ", SstSensorExp)
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+    sensor = cfg.sensors["UNKNOWN"]
+    assert isinstance(sensor, SstSensorExp)
+    assert sensor.raw_to_units(2) == pytest.approx(np.exp(2))
+    plan = cfg.calibration_plan(list(range(9)))
+    data = plan(np.full((3, 9), 2))
+    np.testing.assert_allclose(data["UNKNOWN"], np.exp(2))
+    # The registered sensor is validated and stored
+    for config_class in [SstDeviceConfig, MssDeviceConfig]:
+        cfg = config_class.from_prb(prbfile, shear_sensitivities={"SHE1": 3.9e-4})
+        cfg_copy = config_class.model_validate(cfg.model_dump())
+        assert isinstance(cfg_copy.sensors["UNKNOWN"], SstSensorExp)
+        assert cfg_copy == cfg
+        cfg_copy = config_class.model_validate_json(cfg.model_dump_json())
+        assert isinstance(cfg_copy.sensors["UNKNOWN"], SstSensorExp)
@@ -0,0 +1,90 @@
+import os
+import queue
+import threading
+import numpy as np
+import pytest
+from redvypr.data_packets import commandpacket
+from redvypr_devices.sea_sun_tech.sea_sun_tech_hhl import encode_hhl
+
+# The device module needs the serial interface of redvypr
+sea_sun_tech = pytest.importorskip("redvypr_devices.sea_sun_tech.sea_sun_tech", exc_type=ImportError)
+
+prbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MSS_test.prb")
+channel_sequence = list(range(16))
+
+
+def replay_config(input_file, **kwargs):
+    config = sea_sun_tech.DeviceCustomConfig(input_type="file", input_file=input_file, input_file_pacing="fast",
+                                             prbfile=prbfile, prb_cache=False, probe_type="mss",
+                                             statistics_dt=None, **kwargs)
+    return config.model_dump()
+
+
+def test_read_file(tmp_path):
+    filename = tmp_path / "test.hhl"
+    filename.write_bytes(bytes(range(256)) * 10)
+    data_queue = queue.Queue()
+    sea_sun_tech.read_file(replay_config(filename, input_file_blocksize=1000), data_queue, queue.Queue())
+    items = list(data_queue.queue)
+    assert b"".join(item[0] for item in items[:-1]) == filename.read_bytes()
+    assert isinstance(items[-1], sea_sun_tech.InputEnd) and items[-1].error is None
+    # A failed replay is reported
+    data_queue = queue.Queue()
+    sea_sun_tech.read_file(replay_config(tmp_path / "missing.hhl"), data_queue, queue.Queue())
+    items = list(data_queue.queue)
+    assert len(items) == 1 and isinstance(items[0].error, FileNotFoundError)
+
+
+def test_start_file(tmp_path):
+    # The number of scans is not a multiple of publish_nscans, the last packet is flushed at the end
+    nscans = 1010
+    channels = np.tile(channel_sequence, nscans)
+    filename = tmp_path / "test.hhl"
+    filename.write_bytes(encode_hhl(channels, np.random.default_rng(0).integers(0, 2 ** 16, len(channels))))
+    device_info = {"thread_uuid": "sst_test"}
+    dataqueue = queue.Queue()
+    datainqueue = queue.Queue()
+    statusqueue = queue.Queue()
+    config = replay_config(filename, publish_nscans=250, publish_latency_max=1000.0)
+    thread = threading.Thread(target=sea_sun_tech.start,
+                              args=(device_info, config, dataqueue, datainqueue, statusqueue))
+    thread.start()
+    nscans_published = 0
+    try:
+        while nscans_published < nscans:
+            data = dataqueue.get(timeout=10)
+            nscans_published += len(data["t"])
+    finally:
+        datainqueue.put(commandpacket(command="stop", thread_uuid="sst_test"))
+        thread.join(timeout=10)
+    assert nscans_published == nscans
+    assert not thread.is_alive()
+    assert any("End of the input" in sstr for sstr in statusqueue.queue)
+
+
+def test_start_datastream():
+    # 10 scans per rawdata packet, one packet every 0.1 s
+    nscans = 500
+    channels = np.tile(channel_sequence, nscans)
+    hhldata = encode_hhl(channels, np.random.default_rng(0).integers(0, 2 ** 16, len(channels)))
+    nbytes_packet = 10 * len(channel_sequence) * 3
+    device_info = {"thread_uuid": "sst_test"}
+    dataqueue = queue.Queue()
+    datainqueue = queue.Queue()
+    config = sea_sun_tech.DeviceCustomConfig(input_type="datastream", input_datastream="data@",
+                                             prbfile=prbfile, prb_cache=False, probe_type="mss",
+                                             statistics_dt=None, publish_nscans=100).model_dump()
+    for i in range(0, len(hhldata), nbytes_packet):
+        datainqueue.put({"data": hhldata[i:i + nbytes_packet], "t": 1000.0 + 0.1 * (i // nbytes_packet)})
+    thread = threading.Thread(target=sea_sun_tech.start,
+                              args=(device_info, config, dataqueue, datainqueue, queue.Queue()))
+    thread.start()
+    times = []
+    try:
+        while len(times) < 400:
+            times.extend(dataqueue.get(timeout=10)["t"])
+    finally:
+        datainqueue.put(commandpacket(command="stop", thread_uuid="sst_test"))
+        thread.join(timeout=10)
+    # The scans of a packet are spread over the time since the previous packet
+    np.testing.assert_allclose(np.diff(times[50:]), 0.01)
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+from redvypr_devices.sea_sun_tech.sea_sun_tech_config import SstDeviceConfig, read_prb_file
+from redvypr_devices.sea_sun_tech.sea_sun_tech_fit import (CalibrationFitter, StreamingPolynomialFit,
+                                                           StreamingSteinhartHartFit, TimeWindowPairer)
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+ctm_prbfile = os.path.join(test_dir, "CTM_test.prb")
+
+
+def test_streaming_polynomial_fit():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 65535, 1000)
+    y = -5.1 + 6.6e-4 * x + 1.1e-10 * x ** 2 + rng.normal(0, 1e-4, len(x))
+    fit = StreamingPolynomialFit(degree=2, center=2 ** 15, scale=2 ** 15)
+    for i in range(0, len(x), 100):
+        fit.add(x[i:i + 100], y[i:i + 100])
+    assert np.allclose(fit.coefficients(), np.polynomial.polynomial.polyfit(x, y, 2), rtol=1e-6)
+    assert np.isclose(fit.rms(), 1e-4, rtol=0.1)
+    # Steinhart/Hart
+    temp = np.linspace(-2, 35, 50)
+    fit = StreamingSteinhartHartFit(degree=3)
+    x = np.exp(9 + (35 - temp) / 30)
+    fit.add(x, temp)
+    assert np.allclose(fit.predict(x), temp, atol=1e-3)
+
+
+def test_time_window_pairer():
+    pairer = TimeWindowPairer(10.0, ["TEMP"])
+    pairer.add_reference([0.0, 5.0, 12.0], [1.0, 3.0, 5.0])
+    pairer.add_raw(np.arange(0, 25, 0.5), {"TEMP": np.arange(0, 25, 0.5)})
+    assert pairer.pop_pairs() == [(0.0, 2.0, {"TEMP": 4.75})]
+    # Window 1 is complete once the reference passed it, it is invalid
+    pairer.add_reference(15.0, 6.0, valid=False)
+    pairer.add_reference(21.0, 7.0)
+    assert pairer.pop_pairs() == []
+    assert pairer.ndiscarded == 1
+
+
+def inverse_calibration(sensor):
+    """
+    Returns a function converting temperature into rawdata for sensor
+    """
+    x = np.arange(1.0, 65536.0)
+    t = sensor.raw_to_units(x)
+    isort = np.argsort(t)
+    return lambda temp: np.interp(temp, t[isort], x[isort])
+
+
+def test_calibration_fitter(tmp_path):
+    config = SstDeviceConfig.from_prb(ctm_prbfile)
+    # The true calibrations differ from the prb file
+    truth = config.model_copy(deep=True)
+    truth.sensors["TEMP"] = type(config.sensors["TEMP"])(
+        **{**config.sensors["TEMP"].model_dump(), "coefficients": [-5.1, 6.6e-4, 1.1e-10, 0]})
+    truth.sensors["NTC"] = type(config.sensors["NTC"])(
+        **{**config.sensors["NTC"].model_dump(), "coefficients": [1.0e-3, 2.4e-4, 1e-6, 1.5e-7, 0]})
+    inverse = {name: inverse_calibration(truth.sensors[name]) for name in ["TEMP", "NTC"]}
+    rng = np.random.default_rng(1)
+    fitter = CalibrationFitter(config, ["TEMP", "NTC"], window=10.0)
+    t = 0.0
+    setpoints = [2.0, 10.0, 18.0, 26.0, 34.0]
+    temp = setpoints[0]
+    for setpoint in setpoints:
+        # Ramp, the reference is not valid, then a plateau of 300 s
+        for i in range(400):
+            stable = i >= 100
+            temp = setpoint if stable else temp + (setpoint - temp) * 0.05
+            fitter.add_reference(t, temp + rng.normal(0, 1e-3), valid=stable)
+            t_raw = t + np.arange(8) / 8
+            raw = {name: np.round(inverse[name](np.full(8, temp))
+                                  + rng.normal(0, 0.5, 8)) for name in ["TEMP", "NTC"]}
+            fitter.add_raw(t_raw, raw)
+            t += 1.0
+    assert 140 <= fitter.npairs <= 150
+    fitted = fitter.fitted_config()
+    temp_test = np.linspace(0, 35, 20)
+    for name in ["TEMP", "NTC"]:
+        raw_test = inverse[name](temp_test)
+        assert np.allclose(fitted.sensors[name].raw_to_units(raw_test), temp_test, atol=5e-3)
+        # The original calibration is untouched
+        assert config.sensors[name].coefficients != fitted.sensors[name].coefficients
+    assert len(fitted.sensors["NTC"].coefficients) == 5
+
+    prbfile_out = tmp_path / "CTM_test_cal.prb"
+    coefficients = fitter.write_prb(prbfile_out, ctm_prbfile)
+    prb = read_prb_file(prbfile_out)
+    prb_orig = read_prb_file(ctm_prbfile)
+    for channel, sensor_dict in prb["Sensors"].items():
+        if sensor_dict["name"] in coefficients:
+            assert np.allclose(sensor_dict["coeff"], coefficients[sensor_dict["name"]], rtol=1e-9)
+        else:
+            assert sensor_dict == prb_orig["Sensors"][channel]
+    assert prb["Probe"] == prb_orig["Probe"]
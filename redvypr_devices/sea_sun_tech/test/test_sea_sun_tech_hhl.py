@@ -0,0 +1,202 @@
+import numpy as np
+from redvypr_devices.sea_sun_tech.sea_sun_tech_hhl import HHL, HHLDecoder, HHLStreamDetector, RingBuffer, ChannelSequenceFramer, detect_hhl_stream, encode_hhl, pop_channel_sequence
+
+
+def create_hhl_stream(channel_sequence, nscans, seed=0, ncorrupt=0):
+    """
+    Creates a HHL datastream of nscans with random values and optionally corrupted bytes
+    """
+    rng = np.random.default_rng(seed)
+    channels = np.tile(channel_sequence, nscans)
+    values = rng.integers(0, 2**16, len(channels))
+    hhldata = bytearray(encode_hhl(channels, values))
+    for i in rng.integers(0, len(hhldata) - ncorrupt, ncorrupt):
+        if i % 2:
+            hhldata[i] ^= 0x01  # Flip a flag bit
+        else:
+            del hhldata[i]  # Drop a byte
+    return bytes(hhldata)
+
+
+def test_encode_decode_hhl():
+    hhl = HHL()
+    hhldata = encode_hhl([0, 5, 31], [0, 12345, 65535])
+    assert hhl.decode_HHL(hhldata[0:3]) == [0, 0]
+    assert hhl.decode_HHL(hhldata[3:6]) == [5, 12345]
+    assert hhl.decode_HHL(hhldata[6:9]) == [31, 65535]
+
+
+def test_decode_rawdata_batch_identical():
+    hhl = HHL()
+    for seed in range(5):
+        hhldata = create_hhl_stream([0, 1, 2, 3, 5, 8], 50, seed=seed, ncorrupt=20)
+        # Leading garbage and a partial frame at the end
+        hhldata = b"\x03\x07\x11\x00" + hhldata + b"\x03"
+        hhldata_time = list(np.arange(len(hhldata)) * 0.1)
+        decoded, rest, rest_time = hhl.decode_rawdata(hhldata, hhldata_time=hhldata_time)
+        frames, rest_batch, rest_time_batch = hhl.decode_rawdata_batch(hhldata, hhldata_time=hhldata_time)
+        assert [tuple(f) for f in frames.tolist()] == decoded
+        assert rest_batch == rest
+        assert rest_time_batch == rest_time
+
+
+def test_decode_rawdata_batch_without_time():
+    hhl = HHL()
+    hhldata = create_hhl_stream([0, 1, 2, 31], 10, ncorrupt=3)
+    decoded, rest, _ = hhl.decode_rawdata(hhldata)
+    frames, rest_batch, rest_time = hhl.decode_rawdata_batch(hhldata)
+    assert list(zip(frames["channel"].tolist(), frames["value"].tolist())) == decoded
+    assert np.all(np.isnan(frames["time"]))
+    assert rest_batch == rest
+    assert rest_time is None
+
+
+def test_ringbuffer():
+    ringbuffer = RingBuffer(size=8)
+    ringbuffer.write(b"abcdef", 10.0, dt_per_byte=1.0)
+    ringbuffer.consume(4)
+    ringbuffer.write(b"ghij", [2.0, 3.0, 4.0, 5.0])  # Moves the unread data to the front
+    assert len(ringbuffer.data) == 8
+    ringbuffer.write(b"klmnop", 6.0)  # Grows the buffer
+    assert bytes(ringbuffer.view()) == b"efghijklmnop"
+    data_time = ringbuffer.get_time(np.arange(len(ringbuffer)))
+    assert data_time.tolist() == [9.0, 10.0, 2.0, 3.0, 4.0, 5.0] + [6.0] * 6
+    ringbuffer.consume(len(ringbuffer))
+    assert len(ringbuffer) == 0
+    assert len(ringbuffer.chunk_end) == 0
+
+
+def test_process_buffer_chunks():
+    hhl = HHL()
+    hhldata = create_hhl_stream([0, 1, 2, 3], 200)
+    for i in range(0, len(hhldata), 100):
+        hhl.add_to_buffer(hhldata[i:i + 100], data_time=float(i))
+        frames = hhl.process_buffer()
+        assert len(hhl.buffer) < 3
+    assert len(frames) > 0
+    assert frames["time"][-1] == float(i)
+
+
+def test_decoder_chunks_identical():
+    # Chunked decoding gives the same frames as decoding the concatenated stream at once
+    rng = np.random.default_rng(2)
+    for seed in range(5):
+        hhldata = create_hhl_stream([0, 1, 2, 3, 5, 8], 200, seed=seed, ncorrupt=30)
+        frames, _, _ = HHL().decode_rawdata_batch(hhldata)
+        chunk_ends = np.sort(rng.integers(0, len(hhldata), 40)).tolist() + [len(hhldata)]
+        decoder = HHLDecoder()
+        hhl = HHL()
+        decoded = []
+        decoded_buffer = []
+        istart = 0
+        for iend in chunk_ends:
+            index, channel, value = decoder.decode(hhldata[istart:iend])
+            decoded.extend(zip(index.tolist(), channel.tolist(), value.tolist()))
+            hhl.add_to_buffer(hhldata[istart:iend], data_time=float(iend - 1), dt_per_byte=1.0)
+            frames_buffer = hhl.process_buffer()
+            decoded_buffer.extend(zip(frames_buffer["time"].astype(int).tolist(),
+                                      frames_buffer["channel"].tolist(),
+                                      frames_buffer["value"].tolist()))
+            istart = iend
+        assert [d[1:] for d in decoded] == list(zip(frames["channel"].tolist(), frames["value"].tolist()))
+        # The time of a frame is the time of its first byte, here its stream offset
+        assert decoded_buffer == decoded
+        assert len(decoder.rest) <= 2
+        assert decoder.nbytes == len(hhldata)
+        assert hhl.ngood == decoder.nframes
+        assert hhl.nbad == decoder.ndiscarded
+
+
+def test_channel_sequence_framer():
+    channel_sequence = [0, 1, 2, 5]
+    hhldata = create_hhl_stream(channel_sequence, 300, ncorrupt=10)
+    frames, _, _ = HHL().decode_rawdata_batch(hhldata, hhldata_time=np.arange(len(hhldata)))
+    # Reference with pop_channel_sequence
+    decoded_data_all = frames.tolist()
+    scans_ref = []
+    while True:
+        scan = pop_channel_sequence(decoded_data_all, channel_sequence)
+        if scan is None:
+            break
+        scans_ref.append(scan)
+
+    framer = ChannelSequenceFramer(channel_sequence)
+    values = []
+    times = []
+    for i in range(0, len(frames), 7):
+        values_chunk, times_chunk = framer.process(frames[i:i + 7])
+        values.extend(values_chunk.tolist())
+        times.extend(times_chunk.tolist())
+
+    assert values == [[f[1] for f in scan] for scan in scans_ref]
+    assert times == [scan[0][2] for scan in scans_ref]
+    assert framer.nscans == len(scans_ref)
+    assert framer.nscans * len(channel_sequence) + framer.ndropped + len(framer.frames) == len(frames)
+
+
+def test_detect_hhl_stream():
+    channel_sequence = [0, 1, 2, 3, 4, 7, 12]
+    hhldata = b"\x01\x03\x05" + create_hhl_stream(channel_sequence, 20, ncorrupt=2)
+    detection = detect_hhl_stream(hhldata)
+    assert detection["channel_sequence"] == channel_sequence
+    assert 0.5 < detection["confidence"] <= 1.0
+    assert HHL().inspect_rawdata(hhldata) == channel_sequence
+    # Too short and random data
+    assert detect_hhl_stream(hhldata[:30])["channel_sequence"] is None
+    noise = np.random.default_rng(1).integers(0, 256, 20000).astype(np.uint8).tobytes()
+    detection = detect_hhl_stream(noise)
+    assert detection["confidence"] < 0.1
+
+
+def test_detect_hhl_stream_slip():
+    # A byte is inserted after 300 scans and lost again 100 scans later, the slipped scans
+    # lower the confidence until they are out of the recent scans
+    channel_sequence = [0, 1, 2, 3, 4, 7, 12]
+    hhldata = (create_hhl_stream(channel_sequence, 300, seed=1) + b"\x01"
+               + create_hhl_stream(channel_sequence, 100, seed=2)[:-1]
+               + create_hhl_stream(channel_sequence, 300, seed=3))
+    assert len(hhldata) < 16384
+    detection = detect_hhl_stream(hhldata)
+    assert detection["channel_sequence"] == channel_sequence
+    assert detection["confidence"] == 1.0
+    # The 16 scans before the last scan, which is not closed by a frame of channel 0
+    assert detection["phase"] == len(hhldata) - 17 * len(channel_sequence) * 3
+
+
+def replay_file(filename, blocksize, keep_undetected):
+    """
+    Replays a file in blocks as the device does for a file input with the pacing "fast"
+    """
+    hhl = HHL()
+    detector = HHLStreamDetector(hhl, keep_undetected=keep_undetected)
+    framer = None
+    values = []
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(blocksize)
+            if len(data) == 0:
+                return values
+            hhl.add_to_buffer(data, data_time=0.0)
+            if detector.process(data) is not None:
+                if framer is None:
+                    framer = ChannelSequenceFramer(detector.channel_sequence)
+                values.extend(framer.process(hhl.process_buffer())[0].tolist())
+
+
+def test_detect_hhl_stream_file(tmp_path):
+    # The first block of the file is too corrupted for a detection
+    channel_sequence = [0, 1, 2, 3, 4, 7, 12]
+    hhldata = (create_hhl_stream(channel_sequence, 2000, seed=1, ncorrupt=300)
+               + create_hhl_stream(channel_sequence, 1000, seed=2))
+    blocksize = 32768
+    assert detect_hhl_stream(hhldata[:blocksize])["confidence"] < 0.9
+    filename = tmp_path / "corrupted_start.hhl"
+    filename.write_bytes(hhldata)
+    hhl = HHL()
+    hhl.add_to_buffer(hhldata, data_time=0.0)
+    values_ref = ChannelSequenceFramer(channel_sequence).process(hhl.process_buffer())[0].tolist()
+    # The undetected data of the file is kept and decoded after the detection
+    values = replay_file(filename, blocksize, keep_undetected=True)
+    assert values == values_ref
+    # A stream keeps only the inspected bytes
+    assert len(replay_file(filename, blocksize, keep_undetected=False)) < len(values_ref)
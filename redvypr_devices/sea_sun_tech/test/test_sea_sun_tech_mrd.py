@@ -0,0 +1,73 @@
+import os
+import numpy as np
+import pytest
+from redvypr_devices.sea_sun_tech.sea_sun_tech_config import SstDeviceConfig, MssDeviceConfig
+from redvypr_devices.sea_sun_tech.sea_sun_tech_hhl import HHL, ChannelSequenceFramer, encode_hhl
+from redvypr_devices.sea_sun_tech.sea_sun_tech_mrd import find_data_offset, iter_mrd, read_mrd
+
+prbfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MSS_test.prb")
+shear_sensitivities = {'SHE1': 3.90e-4, 'SHE2': 4.05e-4}
+channel_sequence = list(range(16))
+
+
+@pytest.fixture
+def mrdfile(tmp_path):
+    with open(prbfile, "rb") as f:
+        header = f.read()
+    rng = np.random.default_rng(0)
+    channels = np.tile(channel_sequence, 500)
+    hhldata = bytearray(encode_hhl(channels, rng.integers(0, 2 ** 16, len(channels))))
+    for i in rng.integers(0, len(hhldata), 10):
+        del hhldata[i]  # Dropped bytes
+    filename = tmp_path / "test.MRD"
+    filename.write_bytes(header + bytes(hhldata))
+    return filename, len(header), bytes(hhldata)
+
+
+def test_read_mrd(mrdfile):
+    filename, nheader, hhldata = mrdfile
+    with open(filename, "rb") as f:
+        data = read_mrd(f)
+    assert data["data_offset"] == nheader
+    assert data["data"] == hhldata
+    assert find_data_offset(b"[Probe]\nTyp=MSS\n") is None
+    cfg = SstDeviceConfig.from_srd_mrd(filename, shear_sensitivities=shear_sensitivities)
+    assert cfg == SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities)
+    cfg = MssDeviceConfig.from_mrd(filename, shear_sensitivities=shear_sensitivities)
+    assert cfg.sensornames_ctd == {"press": "PRESS", "temp": "NTC", "cond": "COND"}
+
+
+def test_iter_mrd(mrdfile):
+    filename, nheader, hhldata = mrdfile
+    cfg = SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities)
+    frames, _, _ = HHL().decode_rawdata_batch(hhldata, hhldata_time=np.arange(len(hhldata)) + nheader)
+    values, offsets = ChannelSequenceFramer(channel_sequence).process(frames)
+    data_ref = cfg.calibration_plan(channel_sequence)(values)
+
+    blocks = list(iter_mrd(filename, shear_sensitivities=shear_sensitivities, blocksize=1000))
+    assert len(blocks) > 10
+    data = {key: np.concatenate([block[key] for block in blocks]) for key in blocks[0]}
+    np.testing.assert_array_equal(data["iscan"], np.arange(len(values)))
+    np.testing.assert_array_equal(data["offset"], offsets)
+    for name in data_ref:
+        np.testing.assert_array_equal(data[name], data_ref[name])
+
+
+def test_read_mrd_text_frames(tmp_path):
+    # The recording starts with channel 1, its first frame "AC\n" is text
+    with open(prbfile, "rb") as f:
+        header = f.read()
+    channels = list(range(1, 16)) + channel_sequence * 10
+    values = np.random.default_rng(1).integers(0, 2 ** 16, len(channels))
+    values[0] = 20640
+    hhldata = encode_hhl(channels, values)
+    assert hhldata[:3] == b"AC\n"
+    filename = tmp_path / "test.MRD"
+    filename.write_bytes(header + hhldata)
+    with open(filename, "rb") as f:
+        data = read_mrd(f)
+    assert data["data_offset"] == len(header)
+    cfg = SstDeviceConfig.from_srd_mrd(filename, shear_sensitivities=shear_sensitivities)
+    assert cfg == SstDeviceConfig.from_prb(prbfile, shear_sensitivities=shear_sensitivities)
+    blocks = list(iter_mrd(filename, shear_sensitivities=shear_sensitivities))
+    assert sum(len(block["iscan"]) for block in blocks) == 10
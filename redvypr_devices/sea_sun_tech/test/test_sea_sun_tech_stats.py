@@ -0,0 +1,66 @@
+import logging
+import numpy as np
+from redvypr_devices.sea_sun_tech.sea_sun_tech_hhl import HHL, encode_hhl
+from redvypr_devices.sea_sun_tech.sea_sun_tech_stats import PipelineStatistics, SampledTrace, TimingHistogram
+
+
+def test_timing_histogram():
+    histogram = TimingHistogram()
+    for dt in [1e-4] * 98 + [0.5, 200.0]:
+        histogram.add(dt)
+    summary = histogram.summary()
+    assert summary["n"] == 100
+    assert summary["max"] == 200.0
+    assert 1e-4 <= summary["p50"] < 1e-3
+    assert 0.5 <= summary["p99"] <= 1.0
+    assert sum(summary["counts"]) == 100
+    assert TimingHistogram().quantile(0.5) is None
+
+
+def test_pipeline_statistics():
+    statistics = PipelineStatistics()
+    statistics.count("bytes_read", 1000)
+    statistics.count("chunks_read")
+    statistics.timing("decode", 0.001)
+    statistics.gauge("data_queue", 3)
+    snapshot = statistics.snapshot()
+    assert snapshot["counters"]["bytes_read"] == 1000
+    assert snapshot["rates"]["bytes_read"] > 0
+    assert snapshot["gauges"]["data_queue"] == 3
+    assert snapshot["timing"]["decode"]["n"] == 1
+    assert isinstance(statistics.status_string(snapshot), str)
+    # Counters are cumulative, rates and histograms are per interval
+    snapshot = statistics.snapshot()
+    assert snapshot["counters"]["bytes_read"] == 1000
+    assert snapshot["rates"]["bytes_read"] == 0
+    assert snapshot["timing"]["decode"]["n"] == 0
+
+
+def test_hhl_counters():
+    hhl = HHL()
+    hhldata = encode_hhl([0, 1, 2, 3] * 10, np.arange(40))
+    hhl.add_to_buffer(b"\x00\x00" + hhldata)
+    frames = hhl.process_buffer()
+    assert hhl.ngood == len(frames) == 40
+    assert hhl.nbad == 2
+
+
+def test_sampled_trace(caplog):
+    logger = logging.getLogger("redvypr_devices.sea_sun_tech.test")
+    logger.setLevel(logging.DEBUG)
+    trace = SampledTrace(logger, interval=3600)
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        for i in range(100):
+            trace("process", "Processing %d", i)
+        trace("latency", "Latency %.3f s", 0.1)
+    assert [r.getMessage() for r in caplog.records] == ["Processing 0", "Latency 0.100 s"]
+    assert trace.nsuppressed["process"] == 99
+    # Every message with an interval of 0, nothing if the level is disabled
+    caplog.clear()
+    trace = SampledTrace(logger, interval=0)
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        trace("process", "Processing %d", 1)
+        trace("process", "Processing %d", 2)
+    logger.setLevel(logging.INFO)
+    trace("process", "Processing %d", 3)
+    assert [r.getMessage() for r in caplog.records] == ["Processing 1", "Processing 2"]